@@ -0,0 +1,850 @@
+import asyncio
+import concurrent.futures
+import functools
+import time
+import atsha204a
+import eeprom
+import littlefs_builder
+import provisioner
+import pyftdi.i2c
+import questMarker
+import utils
+import zd24c64a
+from atsha204a import atasha204A_command, atasha204A_zone
+
+
+def transport_executor(name: str = "i2c") -> concurrent.futures.ThreadPoolExecutor:
+    """A single thread executor, the transfers of one provisioner run on it one at a time and in order"""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+
+class async_i2c_port:
+    """Awaitable I2cPort, the blocking pyftdi transfers run on the transport executor"""
+
+    i2c_port: pyftdi.i2c.I2cPort
+    executor: concurrent.futures.Executor
+
+    def __init__(self, i2c_port: pyftdi.i2c.I2cPort, executor: concurrent.futures.Executor):
+        self.i2c_port = i2c_port
+        self.executor = executor
+
+    async def _run(self, function: callable, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs))
+
+    async def write(self, out: "bytes|bytearray|list[int]", relax: bool = True, start: bool = True):
+        return await self._run(self.i2c_port.write, out, relax=relax, start=start)
+
+    async def read(self, readlen: int = 0, relax: bool = True, start: bool = True) -> bytes:
+        return await self._run(self.i2c_port.read, readlen, relax=relax, start=start)
+
+    async def exchange(self, out: "bytes|bytearray|list[int]" = b'', readlen: int = 0,
+                       relax: bool = True, start: bool = True) -> bytes:
+        return await self._run(self.i2c_port.exchange, out, readlen, relax=relax, start=start)
+
+    async def poll(self, write: bool = False, relax: bool = True, start: bool = True) -> bool:
+        return await self._run(self.i2c_port.poll, write=write, relax=relax, start=start)
+
+
+class async_provisioner:
+    """
+    Awaitable wrapper for a provisioner (or a mux_channel or emulated_provisioner),
+    transfers and GPIO writes run on its transport executor, give mux channels of one
+    provisioner the same executor
+    """
+
+    device: provisioner.provisioner
+    executor: concurrent.futures.Executor
+
+    def __init__(self, device: provisioner.provisioner, executor: "concurrent.futures.Executor|None" = None):
+        self.device = device
+        self._owns_executor = executor is None
+        self.executor = executor or transport_executor()
+
+    @property
+    def url(self) -> str:
+        return self.device.url
+
+    async def _run(self, function: callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(function, *args))
+
+    def get_i2c_port(self, address: int, shift=False) -> async_i2c_port:
+        return async_i2c_port(self.device.get_i2c_port(address, shift), self.executor)
+
+    async def set_gpio_mode(self, pin: provisioner.provisioner_pinmap, output: bool):
+        await self._run(self.device.set_gpio_mode, pin, output)
+
+    async def set_gpio_pin(self, pin: provisioner.provisioner_pinmap, state: bool):
+        await self._run(self.device.set_gpio_pin, pin, state)
+
+    async def get_gpio_pin(self, pin: provisioner.provisioner_pinmap):
+        return await self._run(self.device.get_gpio_pin, pin)
+
+    async def set_status_led(self, status: bool):
+        await self._run(self.device.set_status_led, status)
+
+    async def wait_for_detect(self, timeout: "float|None" = None) -> bool:
+        # waiting for the operator can take minutes, run it off the transport thread
+        # so the transfers for other boards on the same executor carry on
+        return await asyncio.get_running_loop().run_in_executor(None, self.device.wait_for_detect, timeout)
+
+    async def wait_for_no_detect(self, timeout: "float|None" = None) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(None, self.device.wait_for_no_detect, timeout)
+
+    def close(self):
+        """Stops the transport executor if it was created here"""
+        if self._owns_executor:
+            self.executor.shutdown()
+
+
+class async_atsha204A_session:
+    """atsha204A_session for the async driver, use with async with"""
+
+    chip: "async_atsha204A"
+    sleep: bool
+
+    def __init__(self, chip: "async_atsha204A", sleep: bool = True):
+        self.chip = chip
+        self.sleep = sleep
+
+    async def __aenter__(self) -> "async_atsha204A":
+        self.chip.session_depth += 1
+        await self.chip.ensure_awake()
+        return self.chip
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.chip.session_depth -= 1
+        if self.chip.session_depth == 0:
+            if self.sleep:
+                await self.chip.sendSleep()
+            else:
+                await self.chip.sendIdle()
+
+
+class async_atsha204A:
+    """
+    The atsha204A command layer with awaitable execution waits, packets, response checks,
+    read/write planning and the snapshot are shared with atsha204a.atsha204A
+    """
+
+    i2c_port: async_i2c_port
+    wake_port: "async_i2c_port|None"
+    snapshot: atsha204a.atsha204A_snapshot
+
+    execution_times: "dict[atasha204A_command, tuple[float, float]]"
+    two_phase_read: bool
+
+    last_wake: "float|None"  # monotonic time of the last wake, None while asleep or idle
+    session_depth: int
+
+    def __init__(self, i2c_port: async_i2c_port,
+                 execution_times: "dict[atasha204A_command, tuple[float, float]]|None" = None,
+                 two_phase_read: bool = False,
+                 wake_port: "async_i2c_port|None" = None):
+        """See atsha204a.atsha204A"""
+        self.i2c_port = i2c_port
+        self.wake_port = wake_port
+        self.two_phase_read = two_phase_read
+        self.snapshot = atsha204a.atsha204A_snapshot()
+
+        self.last_wake = None
+        self.session_depth = 0
+
+        self.execution_times = dict(atsha204a.COMMAND_EXECUTION_TIME)
+        if execution_times is not None:
+            self.execution_times.update(execution_times)
+
+#
+# Helper commands
+#
+
+    async def sendWake(self):
+        """Sends a wake message to the ATSHA204A IC"""
+        try:
+            if self.wake_port is not None:
+                await self.wake_port.write([0x00])
+            else:
+                await self.i2c_port.write(0x00)
+        except pyftdi.i2c.I2cNackError:
+            # nothing acknowledges the wake pulse itself
+            pass
+
+        await asyncio.sleep(atsha204a.WAKE_DELAY)
+        self.last_wake = time.monotonic()
+
+    async def sendIdle(self):
+        """Puts the chip into idle, which restarts the watchdog and keeps TempKey"""
+        await self._send_word_address(atsha204a.WORD_ADDRESS_IDLE)
+
+    async def sendSleep(self):
+        """Puts the chip to sleep, clearing TempKey"""
+        await self._send_word_address(atsha204a.WORD_ADDRESS_SLEEP)
+
+    async def _send_word_address(self, word_address: int):
+        try:
+            await self.i2c_port.write([word_address])
+        except pyftdi.i2c.I2cNackError:
+            # already asleep
+            pass
+        self.last_wake = None
+
+    async def ensure_awake(self, duration: float = 0.0):
+        """Wakes the chip unless it is known to be awake for at least duration seconds more"""
+        if self.last_wake is not None:
+            remaining = self.last_wake + atsha204a.WATCHDOG_TIMEOUT - atsha204a.WATCHDOG_MARGIN - time.monotonic()
+            if remaining > duration:
+                return
+            await self.sendIdle()
+
+        await self.sendWake()
+
+    def session(self, sleep: bool = True) -> async_atsha204A_session:
+        """Context that keeps the chip awake and puts it to sleep (or idle) afterwards"""
+        return async_atsha204A_session(self, sleep)
+
+    async def sendCommand(self, oppcode: atasha204A_command, param1: int,
+                          param2: int, data: "list[int]", response_length: "int|None" = None):
+        """Sends a command to the Chip and awaits the response"""
+        if response_length is None:
+            response_length = atsha204a.expected_response_length(oppcode, param1)
+
+        command = atsha204a.build_command(oppcode, param1, param2, data)
+
+        await self.ensure_awake(self.execution_times[oppcode][1])
+
+        try:
+            await self.i2c_port.write(command)
+        except pyftdi.i2c.I2cNackError:
+            # the watchdog or a brown out has put the chip to sleep
+            self.last_wake = None
+            raise atsha204a.atsha204A_asleep_error(self.sendWake)
+
+        response = await self.wait_for_response(oppcode, response_length)
+
+        status = atsha204a.validate_response(response)
+        if status == atsha204a.STATUS_WAKE:
+            # the command woke the chip rather than running
+            self.last_wake = time.monotonic()
+        atsha204a.raise_for_status(status)
+
+        return response
+
+    async def wait_for_response(self, oppcode: atasha204A_command, response_length: int):
+        """
+        Awaits the typical execution time for the command then polls
+        with a short backoff until the maximum execution time has passed
+        returns None if the chip never acknowledged a read
+        """
+        typical, maximum = self.execution_times[oppcode]
+        deadline = time.monotonic() + maximum + atsha204a.POLL_TIMEOUT_MARGIN
+
+        await asyncio.sleep(typical)
+
+        interval = atsha204a.POLL_INTERVAL_MIN
+        while True:
+            try:
+                if self.two_phase_read:
+                    return await self.read_response_two_phase()
+                return await self.i2c_port.read(response_length)
+            except pyftdi.i2c.I2cNackError:
+                # chip is still executing the command
+                pass
+
+            if time.monotonic() >= deadline:
+                return None
+
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, atsha204a.POLL_INTERVAL_MAX)
+
+    async def read_response_two_phase(self):
+        """Reads the response count byte and then only the remaining bytes of the packet"""
+        count = await self.i2c_port.read(1)
+
+        # no data or an invalid count, let the caller report it
+        if count[0] < 2 or count[0] == 0xFF:
+            return count
+
+        return bytes(count) + bytes(await self.i2c_port.read(count[0] - 1))
+
+#
+# ATSHA204A crypto commands
+#
+
+    async def command_checkmac(self, slot: int, client_chal: "bytearray|list[int]",
+                               client_resp: "bytearray|list[int]", other_Data: "bytearray|list[int]",
+                               use_client_chal: bool = True, use_slot: bool = True,
+                               tempkey_src: bool = False, use_otp: bool = False):
+        """Performs a checkmac command on the chip"""
+        param1 = 0x00
+        if not use_client_chal:
+            param1 |= 0x01
+        if not use_slot:
+            param1 |= 0x02
+        if tempkey_src:
+            param1 |= 0x04
+        if use_otp:
+            param1 |= 0x20
+
+        data = list(client_chal) + list(client_resp) + list(other_Data)
+
+        mem = await self.sendCommand(atasha204A_command.CHECK_MAC, param1, slot, data)
+        return mem[1]
+
+    async def command_gendig(self, zone: atasha204A_zone, slot: int, data=[]):
+        """Performs a gendig command on the chip"""
+        mem = await self.sendCommand(atasha204A_command.GEN_DIG, zone.value, slot, data)
+        return mem[1]
+
+    async def command_lock(self, lock_data, crc=None, skip_crc=False):
+        param1 = 0x00
+        if lock_data:
+            param1 |= 0x01
+        if skip_crc:
+            param1 |= 0x01 << 7
+
+        # the lock bytes are part of the config zone
+        self.snapshot.invalidate(atasha204A_zone.CONFIG, atsha204a.CONFIG_LOCK_VALUE // atsha204a.WORD_SIZE, 1)
+
+        mem = await self.sendCommand(atasha204A_command.LOCK, param1, crc, [])
+        return mem[1]
+
+    async def command_mac(self, slot_id: int, challenge: bytearray,
+                          include_sn: bool = False, include_otp_low: bool = False,
+                          include_otp_high: bool = False, tempkey_srcflag: bool = False,
+                          use_tempkey_start: bool = False, use_tempkey_end: bool = False) -> bytearray:
+        """Performs a sha mac calculation"""
+        param1 = 0x00
+        if include_sn:
+            param1 |= 0x40
+        if include_otp_low:
+            param1 |= 0x20
+        if include_otp_high:
+            param1 |= 0x10
+        if tempkey_srcflag:
+            param1 |= 0x04
+        if use_tempkey_start:
+            param1 |= 0x02
+        if use_tempkey_end:
+            param1 |= 0x01
+
+        response = await self.sendCommand(atasha204A_command.MAC, param1, slot_id, challenge)
+        return response[1:33]
+
+    async def command_nonce(self, nonceMode, input=[]):
+        """Generates a nonce on the chip"""
+        mem = await self.sendCommand(atasha204A_command.NONCE, nonceMode, 0x0000, input)
+
+        if (nonceMode == 0x03):
+            return mem[1]
+        else:
+            return mem[1:33]
+
+    async def command_read(self, zone: atasha204A_zone, block: int, offset: int, four_byte=False):
+        """Reads a block of memory from the IC"""
+        param1 = zone.value
+        if not four_byte:
+            param1 += 0x80  # 32 byte read flag
+
+        mem = await self.sendCommand(atasha204A_command.READ, param1, (block << 3) + offset, [])
+
+        if four_byte:
+            return mem[1:5]
+        else:
+            return mem[1:33]
+
+    async def command_write(self, zone: atasha204A_zone, block: int, offset: int,
+                            data: "bytearray|list[int]", mac: "bytearray|list[int]|None" = None,
+                            four_byte: bool = False, encrypted: bool = False):
+        """Writes a block of memory to the IC"""
+        param1 = zone.value
+        if encrypted:
+            param1 |= 1 << 6  # encrypted write flag
+        if not four_byte:
+            param1 += 1 << 7  # 32 byte read flag
+
+        command_data = list(data)
+        if (mac is not None):
+            command_data += list(mac)
+
+        # the written words are unknown from here even if the write fails
+        self.snapshot.invalidate(zone, (block << 3) + offset, 1 if four_byte else atsha204a.WORDS_PER_BLOCK)
+
+        mem = await self.sendCommand(atasha204A_command.WRITE, param1, (block << 3) + offset, command_data)
+
+        # write only returns a status byte
+        return mem[1]
+
+#
+# Top level commands
+#
+
+    async def get_serial_number(self) -> bytes:
+        """Gets the serial number from the ATSHA204A"""
+        mem = await self.read_range(atasha204A_zone.CONFIG, 0, 13)
+        return mem[0:4] + mem[8:13]
+
+    async def checkChipID(self):
+        """Checks if the Fixed bytes in the serial are correct"""
+        serial = await self.get_serial_number()
+        return serial[0] == 0x01 and serial[1] == 0x23 and serial[8] == 0xEE
+
+    async def read_range(self, zone: atasha204A_zone, start: int, length: int) -> bytes:
+        """Reads an arbitrary byte range of a zone, see atsha204A.read_range"""
+        if length <= 0:
+            return bytes()
+
+        first_word = start // atsha204a.WORD_SIZE
+        last_word = (start + length - 1) // atsha204a.WORD_SIZE
+        words = range(first_word, last_word + 1)
+
+        missing = [word for word in words if self.snapshot.get(zone, word) is None]
+
+        for block, offset, four_byte in atsha204a.plan_reads(zone, missing):
+            mem = await utils.auto_retry_async(self.command_read, 5, zone, block, offset, four_byte=four_byte)
+            self.snapshot.store(zone, (block << 3) + offset, mem)
+
+        data = b''.join(self.snapshot.get(zone, word) for word in words)
+
+        skip = start - first_word * atsha204a.WORD_SIZE
+        return data[skip:skip + length]
+
+    async def write_range(self, zone: atasha204A_zone, start: int, data: "bytes|bytearray|list[int]") -> int:
+        """Writes a word aligned byte range of a zone, see atsha204A.write_range"""
+        if start % atsha204a.WORD_SIZE:
+            raise ValueError("write start {} is not word aligned".format(start))
+
+        current = await self.read_range(zone, start, len(data))
+
+        writes = atsha204a.plan_writes(zone, start // atsha204a.WORD_SIZE, current, data)
+        for block, offset, block_data, four_byte in writes:
+            await utils.auto_retry_async(self.command_write, 5, zone, block, offset, block_data, four_byte=four_byte)
+
+        return len(writes)
+
+    async def read_config(self):
+        """Reads the entire configuration zone"""
+        return list(await self.read_range(atasha204A_zone.CONFIG, 0, atsha204a.ZONE_SIZE[atasha204A_zone.CONFIG]))
+
+    async def read_otp(self) -> bytes:
+        """Reads the entire OTP zone"""
+        return await self.read_range(atasha204A_zone.OTP, 0, atsha204a.ZONE_SIZE[atasha204A_zone.OTP])
+
+    async def is_config_locked(self) -> bool:
+        """Checks the LockConfig byte of the config zone"""
+        return (await self.read_config())[atsha204a.CONFIG_LOCK_CONFIG] != atsha204a.LOCK_UNLOCKED
+
+    async def is_data_locked(self) -> bool:
+        """Checks the LockValue byte covering the data and OTP zones"""
+        return (await self.read_config())[atsha204a.CONFIG_LOCK_VALUE] != atsha204a.LOCK_UNLOCKED
+
+    async def _session_key(self, key_slot: int, key: "bytearray|list[int]", serial: bytes,
+                           nonce_type: int, nonce: "bytearray|list[int]") -> bytes:
+        # NONCE then GENDIG over the key slot, the TempKey that leaves is the session key
+        random = await self.command_nonce(nonce_type, nonce)
+        await self.command_gendig(atasha204A_zone.DATA, key_slot, [0x15, 0x02, key_slot, 0x00])
+        return atsha204a.gendig_session_key(key, key_slot, serial, atsha204a.nonce_tempkey(random, nonce, nonce_type))
+
+    async def encrypted_read(self, readslot: int, readkey_slot: int, readkey: "bytearray|list[int]",
+                             nonce_type: int = 0x00, nonce: "bytearray|list[int]" = [0x00]*20):
+        """Performs a sequence of commands to perform an encrtpted read"""
+        serial = await self.get_serial_number()
+        session_key = await self._session_key(readkey_slot, readkey, serial, nonce_type, nonce)
+
+        data = await self.command_read(atasha204A_zone.DATA, readslot, 0)
+        return bytes(a ^ b for a, b in zip(data, session_key))
+
+    async def encrypted_write(self, write_slot: int, data: "bytearray|list[int]", writekey_slot: int,
+                              writekey: "bytearray|list[int]", nonce_type: int = 0x00,
+                              nonce: "bytearray|list[int]" = [0x00]*20):
+        """Performs a sequence of commands to perform an encrypted write"""
+        serial = await self.get_serial_number()
+        session_key = await self._session_key(writekey_slot, writekey, serial, nonce_type, nonce)
+
+        xored = bytes(a ^ b for a, b in zip(data, session_key))
+        await self.command_write(
+            atasha204A_zone.DATA, write_slot, 0, xored,
+            atsha204a.encrypted_write_mac(session_key, write_slot, serial, data),
+            encrypted=False  # it is actualy encrypted but encryption is ignored after zones are locked
+        )
+
+    async def generate_diversified_key(self, root_key: "bytearray|list[int]", target_slot: int):
+        """Geneates a diversified key for the device"""
+        return atsha204a.diversified_key(root_key, target_slot, await self.get_serial_number())
+
+    async def check_key(self, slot: int, key: "bytearray|list[int]"):
+        """Checks a key matches the expected value"""
+        client_chal, client_resp, otherdata = atsha204a.checkmac_inputs(slot, key)
+        await self.command_checkmac(slot, client_chal, client_resp, otherdata)
+
+
+class async_zd24c64a:
+    """zd24c64a with awaitable transfers, the write cycle is ACK polled between other boards' transfers"""
+
+    i2c_port: async_i2c_port
+
+    def __init__(self, i2c_port: async_i2c_port):
+        self.i2c_port = i2c_port
+
+    async def writeAddr(self, address: int, data: "bytearray|list[int]"):
+        output = [(address >> 8) & 0xFF, address & 0xFF]
+        await self.i2c_port.write(output + list(data))
+
+    async def readAddr(self, address: int, length: int):
+        output = [(address >> 8) & 0xFF, address & 0xFF]
+        await self.i2c_port.write(output)
+        return await self.i2c_port.read(length)
+
+    async def wait_for_write_cycle(self, timeout: float = zd24c64a.WRITE_CYCLE_TIMEOUT) -> float:
+        """ACK polls until the internal write cycle completes, returns the time waited"""
+        start = time.monotonic()
+        while True:
+            # a poll awaited behind other boards' transfers must not give up on a finished write
+            expired = time.monotonic() - start > timeout
+            if await self.i2c_port.poll(write=True):
+                return time.monotonic() - start
+            if expired:
+                raise IOError("EEPROM write cycle did not complete")
+
+    async def write_image(self, offset: int,
+                          data: "bytes|bytearray|memoryview|list[int]") -> "list[tuple[int, int, float]]":
+        """Writes data of any length as page writes, returns (address, length, seconds) for each page"""
+        if offset < 0 or offset + len(data) > zd24c64a.SIZE:
+            raise ValueError("image does not fit in the EEPROM")
+
+        return await self.write_pages(offset, data, zd24c64a.pages(offset, len(data)))
+
+    async def write_pages(self, offset: int, data: "bytes|bytearray|memoryview|list[int]",
+                          page_list: "list[tuple[int, int]]") -> "list[tuple[int, int, float]]":
+        """Writes the listed (address, length) pages of an image that starts at offset"""
+        data = memoryview(bytes(data)) if isinstance(data, list) else memoryview(data)
+
+        timings = list()
+        for address, length in page_list:
+            x = address - offset
+
+            start = time.monotonic()
+            await self.writeAddr(address, data[x:x + length])
+            await self.wait_for_write_cycle()
+            timings.append((address, length, time.monotonic() - start))
+
+        return timings
+
+    async def diff_pages(self, offset: int, data: "bytes|bytearray|memoryview|list[int]",
+                         chunk_size: int = zd24c64a.READ_CHUNK_SIZE) -> "list[tuple[int, int]]":
+        """Reads the current contents and returns the (address, length) pages that differ from data"""
+        data = memoryview(bytes(data)) if isinstance(data, list) else memoryview(data)
+
+        differing = list()
+        for chunk_start in range(0, len(data), chunk_size):
+            chunk_length = min(chunk_size, len(data) - chunk_start)
+            current = memoryview(await self.readAddr(offset + chunk_start, chunk_length))
+            zd24c64a.diff_chunk(differing, offset + chunk_start, current, data[chunk_start:chunk_start + chunk_length])
+
+        return differing
+
+    async def verify_image(self, offset: int, expected: "bytes|bytearray|memoryview|list[int]",
+                           chunk_size: int = zd24c64a.READ_CHUNK_SIZE) -> "int|None":
+        """Reads back and compares, returns the address of the first byte that differs or None"""
+        expected = memoryview(bytes(expected)) if isinstance(expected, list) else memoryview(expected)
+
+        for chunk_start in range(0, len(expected), chunk_size):
+            chunk_length = min(chunk_size, len(expected) - chunk_start)
+            current = await self.readAddr(offset + chunk_start, chunk_length)
+
+            mismatch = zd24c64a.first_difference(
+                offset + chunk_start, current, expected[chunk_start:chunk_start + chunk_length])
+            if mismatch is not None:
+                return mismatch
+
+        return None
+
+    async def update_image(self, offset: int, data: "bytes|bytearray|memoryview|list[int]",
+                           dry_run: bool = False) -> "tuple[list[tuple[int, int]], list[tuple[int, int, float]]]":
+        """Writes only the pages that differ, returns the differing pages and the write timings"""
+        differing = await self.diff_pages(offset, data)
+        if dry_run:
+            return (differing, [])
+        return (differing, await self.write_pages(offset, data, differing))
+
+
+class async_quest_marker:
+    """
+    quest_marker for an event loop, each board is a task so one loop drives every fixture,
+    the OTP contents, lock CRCs and EEPROM images are the same helpers quest_marker uses
+    """
+
+    _provisioner: async_provisioner
+    crypto: async_atsha204A
+    eeprom: async_zd24c64a
+    image_batch: "eeprom.image_batch|None"
+    filesystem_builder: "littlefs_builder.littlefs_builder|None"
+    log: "callable"
+    _image: "tuple[int, bytearray|memoryview]|None"  # (serial, contents) for the board in the fixture
+    stage_timings: "dict[str, float]"  # seconds taken by each stage the last provision ran
+    check_failures: "list[str]"  # what the last check_config found wrong
+
+    def __init__(self, provisioner_device: "provisioner.provisioner|async_provisioner",
+                 execution_times: "dict[atasha204A_command, tuple[float, float]]|None" = None,
+                 image_batch: "eeprom.image_batch|None" = None,
+                 filesystem_builder: "littlefs_builder.littlefs_builder|None" = None,
+                 log: "callable" = print):
+        """See questMarker.quest_marker, a plain provisioner gets its own transport executor"""
+        if not isinstance(provisioner_device, async_provisioner):
+            provisioner_device = async_provisioner(provisioner_device)
+
+        self._provisioner = provisioner_device
+        self.image_batch = image_batch
+        self.filesystem_builder = filesystem_builder
+        self.log = log
+        self._image = None
+        self.stage_timings = dict()
+        self.check_failures = list()
+
+        self.eeprom = async_zd24c64a(self._provisioner.get_i2c_port(0x57))
+        self.crypto = async_atsha204A(
+            self._provisioner.get_i2c_port(0xC8, shift=True),
+            execution_times,
+            wake_port=self._provisioner.get_i2c_port(0x00))
+
+    def board_removed(self):
+        """Drops any cached chip contents so the next board is read fresh"""
+        self.crypto.snapshot.invalidate()
+        self.crypto.last_wake = None
+        self._image = None
+
+    async def wait_until_ready(self, timeout: float = questMarker.READY_TIMEOUT) -> bool:
+        """Probes a newly inserted board until both chips acknowledge, False if they do not within timeout"""
+        start = time.monotonic()
+        while True:
+            await self.crypto.sendWake()
+            if await self.crypto.i2c_port.poll(write=True) and await self.eeprom.i2c_port.poll(write=True):
+                return True
+
+            if time.monotonic() - start >= timeout:
+                return False
+            await asyncio.sleep(questMarker.READY_POLL_INTERVAL)
+
+    async def set_status_led(self, status: bool):
+        """Sets the Status LED on the board"""
+        await self._provisioner.set_gpio_pin(questMarker.PIN_STATUS_LED, not status)
+
+    async def set_eeprom_wp(self, protected: bool):
+        """Sets the wprom write protect status"""
+        if protected:
+            await self._provisioner.set_gpio_mode(questMarker.PIN_EEPROM_WP, False)
+        else:
+            await self._provisioner.set_gpio_mode(questMarker.PIN_EEPROM_WP, True)
+            await self._provisioner.set_gpio_pin(questMarker.PIN_EEPROM_WP, False)
+
+    async def write_crypto_config(self):
+        """Configures the config zone for the atsha204A and locks it"""
+        config = await self.crypto.read_config()
+
+        await self.crypto.write_range(atasha204A_zone.CONFIG, 16, questMarker.ATSHA_CONFIG)
+
+        await utils.auto_retry_async(self.crypto.command_lock, 5, False, questMarker.config_lock_crc(config))
+
+    async def write_crypto_data(self, serial, keys):
+        """writes the data to the atsha204A"""
+        otp_low, otp_high = questMarker.otp_data(serial)
+
+        div_key = await self.crypto.generate_diversified_key(keys[0x00], 0x00)
+        await utils.auto_retry_async(self.crypto.command_write, 5, atasha204A_zone.DATA, 0, 0, div_key)
+
+        for x in range(1, 16):
+            await utils.auto_retry_async(self.crypto.command_write, 5, atasha204A_zone.DATA, x, 0, keys[x])
+
+        await utils.auto_retry_async(self.crypto.command_write, 5, atasha204A_zone.OTP, 0, 0, otp_low)
+        await utils.auto_retry_async(self.crypto.command_write, 5, atasha204A_zone.OTP, 1, 0, otp_high)
+
+        await utils.auto_retry_async(
+            self.crypto.command_lock, 5, True, questMarker.data_lock_crc(div_key, keys, otp_low, otp_high))
+
+    async def eeprom_image(self, serial) -> "bytearray|memoryview":
+        """
+        Gets the complete EEPROM contents for serial, kept until the board is removed,
+        built on the default executor so the other boards' transfers carry on meanwhile
+        """
+        if self._image is None or self._image[0] != serial:
+            image = await asyncio.get_running_loop().run_in_executor(
+                None, questMarker.board_image, serial, self.image_batch, self.filesystem_builder)
+            self._image = (serial, image)
+        return self._image[1]
+
+    async def write_eeprom(self, serial, incremental=False, dry_run=False,
+                           image: "bytearray|memoryview|None" = None) -> "list[tuple[int, int, float|None]]":
+        """Writes the eeprom contents, see quest_marker.write_eeprom"""
+        if image is None:
+            image = await self.eeprom_image(serial)
+        image = memoryview(image)
+
+        # filesystem first then the header, so a valid header marks a completed write
+        regions = ((eeprom.FS_OFFSET, image[eeprom.FS_OFFSET:]), (0, image[:eeprom.FS_OFFSET]))
+
+        if dry_run:
+            differing = list()
+            for offset, data in regions:
+                if incremental:
+                    differing += (await self.eeprom.update_image(offset, data, dry_run=True))[0]
+                else:
+                    differing += zd24c64a.pages(offset, len(data))
+            return [(address, length, None) for address, length in differing]
+
+        await self.set_eeprom_wp(False)
+
+        try:
+            timings = list()
+            for offset, data in regions:
+                if incremental:
+                    timings += (await self.eeprom.update_image(offset, data))[1]
+                else:
+                    timings += await self.eeprom.write_image(offset, data)
+        finally:
+            await self.set_eeprom_wp(True)
+
+        return timings
+
+    async def get_provision_state(self, serial) -> "tuple[int, list[questMarker.provision_stage]]":
+        """Detects which provisioning stages are still needed, see quest_marker.get_provision_state"""
+        pending = list()
+
+        if not await self.crypto.is_config_locked():
+            pending.append(questMarker.provision_stage.CRYPTO_CONFIG)
+        elif (await self.crypto.read_config())[16:84] != questMarker.ATSHA_CONFIG:
+            raise RuntimeError("config zone is locked with a different configuration")
+
+        if not await self.crypto.is_data_locked():
+            pending.append(questMarker.provision_stage.CRYPTO_DATA)
+        else:
+            serial, atsha_serial = await self.get_serial_numbers()
+
+        expected_header = bytearray(eeprom.FS_OFFSET)
+        eeprom.compile_header(serial, expected_header)
+
+        eeprom_header = await utils.auto_retry_async(self.eeprom.readAddr, 5, 0, eeprom.FS_OFFSET)
+        if bytes(eeprom_header) != expected_header:
+            pending.append(questMarker.provision_stage.EEPROM)
+
+        return (serial, pending)
+
+    async def provision(self, keys, serial) -> int:
+        """Performs first time setup for the hexpansion, resuming a partially provisioned board"""
+        async with self.crypto.session():
+            serial, pending = await self.get_provision_state(serial)
+
+            self.stage_timings = dict()
+            for stage in questMarker.provision_stage:
+                if stage not in pending:
+                    self.log("{} already complete ({:04X})".format(stage.value, serial))
+                    continue
+
+                start = time.monotonic()
+                if stage == questMarker.provision_stage.CRYPTO_CONFIG:
+                    await self.write_crypto_config()
+                elif stage == questMarker.provision_stage.CRYPTO_DATA:
+                    await self.write_crypto_data(serial, keys)
+                elif stage == questMarker.provision_stage.EEPROM:
+                    timings = await self.write_eeprom(serial, image=await self.eeprom_image(serial))
+                    for address, length, seconds in zd24c64a.slow_pages(timings):
+                        self.log("slow EEPROM page {:04X} ({} bytes) took {:.1f}ms".format(
+                            address, length, seconds * 1000))
+                self.stage_timings[stage.value] = time.monotonic() - start
+
+            return serial
+
+    async def update(self, keys, incremental=True, dry_run=False) -> "list[tuple[int, int, float|None]]":
+        """Rewrites the EEPROM for the board serial, returns the (address, length, seconds) pages written"""
+        board_serial, atsha_serial = await self.get_serial_numbers()
+        return await self.write_eeprom(board_serial, incremental, dry_run)
+
+    def _check_failed(self, message: str):
+        self.log(message)
+        self.check_failures.append(message)
+
+    async def check_config(self, keys, image: "bytearray|memoryview|None" = None):
+        """Validates the configurtion of a board, see quest_marker.check_config"""
+        configCorrect = True
+        self.check_failures = list()
+
+        if (await self.crypto.read_config())[16:84] != questMarker.ATSHA_CONFIG:
+            self._check_failed("config mismatch")
+            configCorrect = False
+
+        div_key = await self.crypto.generate_diversified_key(keys[0x00], 0x00)
+        for x in range(0, 16):
+            try:
+                await utils.auto_retry_async(self.crypto.check_key, 5, x, div_key if x == 0 else keys[x])
+            except Exception:
+                self._check_failed("Incorrect key in slot {}".format(x))
+                configCorrect = False
+
+        board_serial, atsha_serial = await self.get_serial_numbers()
+
+        if image is None:
+            image = await self.eeprom_image(board_serial)
+        mismatch = await self.eeprom.verify_image(0, image)
+
+        if mismatch is not None and mismatch < eeprom.FS_OFFSET:
+            self._check_failed("EEPROM header mismatch at {:04X}".format(mismatch))
+            configCorrect = False
+        elif mismatch is not None:
+            self._check_failed("EEPROM litltefs mismatch at {:04X}".format(mismatch))
+            configCorrect = False
+
+        return configCorrect
+
+    async def perform_challenge(self, badge_mac: "bytearray|list[int]",
+                                slot: int = 0x00) -> "tuple[bytearray, bytearray]":
+        """performs a challenge against the badge"""
+        random = await self.crypto.command_nonce(0x01, questMarker.challenge_data(badge_mac))
+        response = await self.crypto.command_mac(slot, [], use_tempkey_end=True)
+        return (random, response)
+
+    async def get_serial_numbers(self):
+        atsha_serial = await self.crypto.get_serial_number()
+
+        # OTP starts "SN:XXXX"
+        otp_serial = await self.crypto.read_range(atasha204A_zone.OTP, 3, 4)
+
+        return (int(str(otp_serial, "ascii"), 16), atsha_serial)
+
+
+# Provisions emulated boards on several fixtures from one event loop if run on its own
+if __name__ == "__main__":
+    import os
+    import sys
+    import emulator
+
+    fixture_count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    board_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    keys = {slot: os.urandom(32) for slot in range(16)}
+
+    async def run_fixture(index: int):
+        device = async_provisioner(emulator.emulated_provisioner(boards=board_count))
+        quest_marker = async_quest_marker(device, log=lambda message: print("[{}] {}".format(index, message)))
+
+        for x in range(board_count):
+            await device.wait_for_detect()
+            board_start = time.monotonic()
+            await quest_marker.wait_until_ready()
+
+            serial = await quest_marker.provision(keys, index * board_count + x)
+            checks = await quest_marker.check_config(keys)
+            await quest_marker.crypto.sendSleep()
+
+            print("[{}] {:04X} {} in {:.2f}s".format(
+                index, serial, "passed" if checks else "FAILED", time.monotonic() - board_start))
+
+            await device.wait_for_no_detect()
+            quest_marker.board_removed()
+
+        device.close()
+
+    async def run_all():
+        await asyncio.gather(*(run_fixture(index) for index in range(fixture_count)))
+
+    start = time.monotonic()
+    asyncio.run(run_all())
+    print("{} boards on {} fixtures in {:.2f}s".format(
+        fixture_count * board_count, fixture_count, time.monotonic() - start))
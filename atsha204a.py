@@ -28,11 +28,464 @@ class atasha204A_zone(enum.Enum):
     DATA = 0x02
 
 
+# Command execution times in seconds (typical, maximum) from the ATSHA204A datasheet
+COMMAND_EXECUTION_TIME = {
+    atasha204A_command.CHECK_MAC: (0.012, 0.038),
+    atasha204A_command.DERIVE_KEY: (0.014, 0.062),
+    atasha204A_command.DEV_REV: (0.0004, 0.002),
+    atasha204A_command.GEN_DIG: (0.011, 0.043),
+    atasha204A_command.HMAC: (0.027, 0.069),
+    atasha204A_command.LOCK: (0.005, 0.024),
+    atasha204A_command.MAC: (0.012, 0.035),
+    atasha204A_command.NONCE: (0.022, 0.060),
+    atasha204A_command.PAUSE: (0.0004, 0.002),
+    atasha204A_command.RANDOM: (0.011, 0.050),
+    atasha204A_command.READ: (0.0004, 0.004),
+    atasha204A_command.SHA: (0.011, 0.022),
+    atasha204A_command.UPDATE_EXTRA: (0.008, 0.012),
+    atasha204A_command.WRITE: (0.004, 0.042),
+}
+
+# Response packet sizes (count, data, crc) returned by each command
+STATUS_RESPONSE_LENGTH = 4  # single status/result byte
+RESPONSE_LENGTH = {
+    atasha204A_command.CHECK_MAC: STATUS_RESPONSE_LENGTH,
+    atasha204A_command.DERIVE_KEY: STATUS_RESPONSE_LENGTH,
+    atasha204A_command.DEV_REV: 7,
+    atasha204A_command.GEN_DIG: STATUS_RESPONSE_LENGTH,
+    atasha204A_command.HMAC: 35,
+    atasha204A_command.LOCK: STATUS_RESPONSE_LENGTH,
+    atasha204A_command.MAC: 35,
+    atasha204A_command.NONCE: 35,
+    atasha204A_command.PAUSE: STATUS_RESPONSE_LENGTH,
+    atasha204A_command.RANDOM: 35,
+    atasha204A_command.READ: 35,
+    atasha204A_command.SHA: 35,
+    atasha204A_command.UPDATE_EXTRA: STATUS_RESPONSE_LENGTH,
+    atasha204A_command.WRITE: STATUS_RESPONSE_LENGTH,
+}
+
+
+def expected_response_length(oppcode: atasha204A_command, param1: int) -> int:
+    """Gets the size of the response packet for a command and mode"""
+    if oppcode == atasha204A_command.READ and not (param1 & 0x80):
+        return 7  # 4 byte read
+    if oppcode == atasha204A_command.NONCE and (param1 & 0x03) == 0x03:
+        return STATUS_RESPONSE_LENGTH  # pass-through nonce
+    if oppcode == atasha204A_command.SHA and (param1 & 0x01) == 0x00:
+        return STATUS_RESPONSE_LENGTH  # SHA init
+    return RESPONSE_LENGTH[oppcode]
+
+
+# Response polling after the typical execution time has passed
+POLL_INTERVAL_MIN = 0.001  # first retry delay after a NACK
+POLL_INTERVAL_MAX = 0.008  # backoff limit between polls
+POLL_TIMEOUT_MARGIN = 0.020  # allowance past the maximum execution time for bus latency
+
+
+def _reflect_byte(d: int) -> int:
+    """Reverses the bit order of a byte"""
+    d = ((d & 0x55) << 1) | ((d & 0xAA) >> 1)
+    d = ((d & 0x33) << 2) | ((d & 0xCC) >> 2)
+    d = ((d & 0x0F) << 4) | ((d & 0xF0) >> 4)
+    return d
+
+
+def _crc_table_entry(index: int) -> int:
+    """Calculates the CRC register update for a single (reflected) input byte"""
+    crc = index << 8
+    for j in range(0, 8):
+        if (crc & 0x8000) > 0:
+            crc = (crc << 1) ^ 0x8005
+        else:
+            crc = crc << 1
+    return crc & 0xFFFF
+
+
+# bytes.translate table used to reflect every input byte in one pass
+_CRC_REFLECT = bytes(_reflect_byte(x) for x in range(256))
+
+# CRC register update indexed by (crc >> 8) ^ reflected byte
+_CRC_TABLE = tuple(_crc_table_entry(x) for x in range(256))
+
+
+def _calculate_crc_bitwise(data: "bytearray|list[int]", offset: int, length: int):
+    """Bit by bit reference implementation of the ATSHA204A CRC"""
+    crc = 0x0000
+    for i in range(0, length):
+        d = _reflect_byte(data[offset + i])
+
+        crc ^= d << 8
+        for j in range(0, 8):
+            if (crc & 0x8000) > 0:
+                crc = (crc << 1) ^ 0x8005
+            else:
+                crc = crc << 1
+
+    return crc & 0xFFFF
+
+
+class atsha204A_crc:
+    """Table driven incremental CRC-16 (poly 0x8005) as used by the ATSHA204A"""
+
+    value: int
+
+    def __init__(self, value: int = 0x0000):
+        self.value = value
+
+    def update(self, data: "bytes|bytearray|memoryview|list[int]", offset: int = 0, length: "int|None" = None):
+        """Adds data to the running CRC, returns self so calls can be chained"""
+        if length is None:
+            length = len(data) - offset
+
+        # reflect all the input bytes at once, slicing a memoryview avoids an extra copy
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            reflected = bytes(memoryview(data)[offset:offset + length]).translate(_CRC_REFLECT)
+        else:
+            reflected = bytes(data[offset:offset + length]).translate(_CRC_REFLECT)
+
+        table = _CRC_TABLE
+        crc = self.value
+        for d in reflected:
+            crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ d]
+
+        self.value = crc
+        return self
+
+
+# The watchdog puts the chip to sleep this long after waking whatever it is doing (datasheet minimum)
+WATCHDOG_TIMEOUT = 0.7
+WATCHDOG_MARGIN = 0.05  # wake again before the watchdog could expire
+WAKE_DELAY = 0.0025  # time from the wake pulse until the chip accepts commands
+
+# Word address (first byte of a write) for each packet type
+WORD_ADDRESS_SLEEP = 0x01
+WORD_ADDRESS_IDLE = 0x02
+WORD_ADDRESS_COMMAND = 0x03
+
+# Status codes that mean the command never ran and can be sent again
+STATUS_WAKE = 0x11  # the chip has just woken up
+STATUS_COMMS_ERROR = 0xFF  # the chip received a corrupt command
+TRANSIENT_STATUS = (STATUS_WAKE, STATUS_COMMS_ERROR)
+
+
+class atsha204A_error(RuntimeError):
+    """Error status returned by the chip after executing a command"""
+
+    status: int
+
+    def __init__(self, status: int):
+        super().__init__("Chip returned an error {}".format(hex(status)))
+        self.status = status
+
+
+class atsha204A_asleep_error(IOError):
+    """
+    The chip did not acknowledge a command because it is asleep,
+    recover wakes it so a retry can go straight away
+    """
+
+    recover: callable
+
+    def __init__(self, recover: callable):
+        super().__init__("Chip is asleep")
+        self.recover = recover
+
+
+class atsha204A_session:
+    """
+    Keeps the chip awake for a sequence of commands and sends it to
+    sleep (or idle, which keeps TempKey) when the outermost session ends
+    """
+
+    chip: "atsha204A"
+    sleep: bool
+
+    def __init__(self, chip: "atsha204A", sleep: bool = True):
+        self.chip = chip
+        self.sleep = sleep
+
+    def __enter__(self) -> "atsha204A":
+        self.chip.session_depth += 1
+        self.chip.ensure_awake()
+        return self.chip
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.chip.session_depth -= 1
+        if self.chip.session_depth == 0:
+            if self.sleep:
+                self.chip.sendSleep()
+            else:
+                self.chip.sendIdle()
+
+
+# Zone sizes in bytes, reads and writes address 4 byte words within 32 byte blocks
+ZONE_SIZE = {
+    atasha204A_zone.CONFIG: 88,
+    atasha204A_zone.OTP: 64,
+    atasha204A_zone.DATA: 512,
+}
+WORD_SIZE = 4
+BLOCK_SIZE = 32
+WORDS_PER_BLOCK = BLOCK_SIZE // WORD_SIZE
+
+# Config zone words that the WRITE command can change (serial/revision and lock words are fixed)
+CONFIG_WRITABLE_WORDS = range(4, 21)
+
+# Config zone lock bytes, 0x55 while the zone is unlocked
+CONFIG_LOCK_VALUE = 86
+CONFIG_LOCK_CONFIG = 87
+LOCK_UNLOCKED = 0x55
+
+
+def plan_reads(zone: atasha204A_zone, words: "list[int]") -> "list[tuple[int, int, bool]]":
+    """
+    Plans the fewest READ commands that cover the given word indexes
+    returns (block, offset, four_byte) for each command, a block is read
+    in one 32 byte read when more than one of its words is needed and the
+    whole block lies inside the zone
+    """
+    blocks = dict()
+    for word in sorted(set(words)):
+        if word < 0 or (word + 1) * WORD_SIZE > ZONE_SIZE[zone]:
+            raise ValueError("word {} is outside the {} zone".format(word, zone.name))
+        blocks.setdefault(word // WORDS_PER_BLOCK, []).append(word % WORDS_PER_BLOCK)
+
+    reads = list()
+    for block, offsets in blocks.items():
+        full_block = (block + 1) * BLOCK_SIZE <= ZONE_SIZE[zone]
+        if full_block and len(offsets) > 1:
+            reads.append((block, 0, False))
+        else:
+            reads += [(block, offset, True) for offset in offsets]
+
+    return reads
+
+
+def plan_writes(zone: atasha204A_zone, first_word: int,
+                current: "bytes|bytearray|list[int]",
+                target: "bytes|bytearray|list[int]") -> "list[tuple[int, int, bytes, bool]]":
+    """
+    Plans the fewest WRITE commands to change current into target starting at a word index
+    returns (block, offset, data, four_byte) for each command, words that already match are
+    skipped and a block is written in one 32 byte write when more than one of its words differ,
+    the range covers the whole block and every word of the block is writable
+    """
+    if len(current) != len(target) or len(target) % WORD_SIZE:
+        raise ValueError("write data must be whole words matching the current contents")
+
+    blocks = dict()
+    for x in range(0, len(target) // WORD_SIZE):
+        word = first_word + x
+        span = slice(x * WORD_SIZE, (x + 1) * WORD_SIZE)
+        if list(current[span]) != list(target[span]):
+            blocks.setdefault(word // WORDS_PER_BLOCK, []).append(word)
+
+    last_word = first_word + len(target) // WORD_SIZE - 1
+
+    writes = list()
+    for block, words in blocks.items():
+        block_words = range(block * WORDS_PER_BLOCK, (block + 1) * WORDS_PER_BLOCK)
+        full_block = (
+            (block + 1) * BLOCK_SIZE <= ZONE_SIZE[zone] and
+            block_words[0] >= first_word and block_words[-1] <= last_word and
+            (zone != atasha204A_zone.CONFIG or all(word in CONFIG_WRITABLE_WORDS for word in block_words))
+        )
+
+        if full_block and len(words) > 1:
+            x = (block_words[0] - first_word) * WORD_SIZE
+            writes.append((block, 0, bytes(target[x:x + BLOCK_SIZE]), False))
+        else:
+            for word in words:
+                x = (word - first_word) * WORD_SIZE
+                writes.append((block, word % WORDS_PER_BLOCK, bytes(target[x:x + WORD_SIZE]), True))
+
+    return writes
+
+
+class atsha204A_snapshot:
+    """
+    Cached copy of the chip contents that only change when the chip is written,
+    kept as 4 byte words per zone, invalidate whenever a different chip may be on the bus
+    """
+
+    words: "dict[tuple[atasha204A_zone, int], bytes]"
+
+    def __init__(self):
+        self.invalidate()
+
+    def get(self, zone: atasha204A_zone, word: int) -> "bytes|None":
+        """Gets a cached word or None if it has not been read"""
+        return self.words.get((zone, word))
+
+    def store(self, zone: atasha204A_zone, first_word: int, data: "bytes|bytearray"):
+        """Caches data read from the chip starting at a word index"""
+        for x in range(0, len(data) // WORD_SIZE):
+            self.words[(zone, first_word + x)] = bytes(data[x * WORD_SIZE:(x + 1) * WORD_SIZE])
+
+    def invalidate(self, zone: "atasha204A_zone|None" = None, first_word: int = 0, count: "int|None" = None):
+        """Drops cached words of a zone (optionally only a range of words) or everything"""
+        if zone is None:
+            self.words = dict()
+            return
+
+        for (cached_zone, word) in list(self.words):
+            if cached_zone != zone or word < first_word:
+                continue
+            if count is None or word < first_word + count:
+                del self.words[(cached_zone, word)]
+
+
+def build_command(oppcode: atasha204A_command, param1: int, param2: int, data: "bytes|bytearray|list[int]"):
+    """Builds a command packet, word address, count, oppcode, parameters, data and CRC"""
+    command = [
+        WORD_ADDRESS_COMMAND,  # command flag
+        0x07 + len(data),  # count (includes fixed values)
+        oppcode.value,  # command oppcode
+        param1,  # paramter 1 value
+        param2 & 0xff,  # paramater 2 value LSB
+        param2 >> 8  # parameter 2 value MSB
+    ]
+    command += list(data)  # add data to command
+
+    crc = atsha204A.calculate_crc(command, 1, len(command) - 1)
+
+    command += [
+        crc & 0xFF,
+        crc >> 8,
+    ]
+    return command
+
+
+def validate_response(response: "bytes|None") -> "int|None":
+    """
+    Checks a response packet is complete and its CRC matches,
+    returns the status byte of a status packet or None for a data packet
+    """
+    if response is None:
+        raise IOError("No response from chip")
+
+    if (response[0] == 0xFF):
+        raise IOError("chip returned no data")
+
+    if (response[0] < STATUS_RESPONSE_LENGTH or response[0] > len(response)):
+        raise IOError("chip response length {} invalid for {} byte read".format(response[0], len(response)))
+
+    resp_crc = atsha204A.calculate_crc(response, 0, response[0]-2)
+
+    if ((resp_crc & 0xFF) != response[response[0]-2] or (resp_crc >> 8 & 0xFF) != response[response[0]-1]):
+        raise IOError("chip response CRC mismatch {} {} != {} {}".format(
+            hex(resp_crc & 0xFF), hex(resp_crc >> 8 & 0xFF),
+            hex(response[response[0]-2]), hex(response[response[0]-1])
+        ))
+
+    if response[0] == STATUS_RESPONSE_LENGTH:
+        return response[1]
+    return None
+
+
+def raise_for_status(status: "int|None"):
+    """Raises for a status byte that reports the command did not run or failed"""
+    if status in TRANSIENT_STATUS:
+        raise IOError("Chip did not execute the command {}".format(hex(status)))
+
+    if status is not None and status != 0x00:
+        raise atsha204A_error(status)
+
+
+def nonce_tempkey(random: "bytes|bytearray|list[int]", nonce: "bytes|bytearray|list[int]", nonce_type: int) -> bytes:
+    """Calculates the TempKey a NONCE command leaves from its random output and input"""
+    if nonce_type == 0x03:
+        return bytes(nonce)
+
+    noncedata = list(random) + list(nonce) + [0x16, 0x00, 0x00]
+    return hashlib.sha256(bytes(noncedata)).digest()
+
+
+def gendig_session_key(key: "bytes|bytearray|list[int]", key_slot: int,
+                       serial: "bytes|bytearray", tempkey: "bytes|bytearray|list[int]") -> bytes:
+    """Calculates the TempKey a GENDIG over a data slot leaves, the session key for encrypted reads and writes"""
+    hashdata = list(key)
+    hashdata += [0x15, 0x02, key_slot, 0x00, serial[8], serial[0], serial[1]]
+    hashdata += [0x00]*25 + list(tempkey)
+
+    return hashlib.sha256(bytes(hashdata)).digest()
+
+
+def encrypted_write_mac(session_key: bytes, write_slot: int, serial: "bytes|bytearray",
+                        data: "bytes|bytearray|list[int]") -> bytes:
+    """Calculates the input MAC that authorises an encrypted write of data to a slot"""
+    write_addr = write_slot << 3
+    return hashlib.sha256(bytes(
+        list(session_key) +
+        [0x12, 0x82, write_addr & 0xFF, (write_slot >> 8) & 0xFF, serial[8], serial[0], serial[1]] +
+        [0x00]*25 + list(data)
+    )).digest()
+
+
+def diversified_key(root_key: "bytes|bytearray|list[int]", target_slot: int, serial: "bytes|bytearray") -> bytes:
+    """
+    Derives the key for a device from the root key and its serial number
+    Uses implementation in Atmel-8841A-CryptoAuth-ATSHA204-Unique-Keys-ApplicationNote_042013
+    """
+    serial_pad = [0x00] * (32 - 9)
+
+    generation_hash_data = list(root_key)
+    generation_hash_data += [0x1C, 0x04, target_slot & 0xFF, (target_slot >> 8) & 0xFF]
+    generation_hash_data += [0xEE, 0x01, 0x23]
+    generation_hash_data += [0x00] * 25
+    generation_hash_data += list(serial) + list(serial_pad)
+
+    return hashlib.sha256(bytes(generation_hash_data)).digest()
+
+
+def checkmac_inputs(slot: int, key: "bytes|bytearray|list[int]") -> "tuple[list[int], bytes, list[int]]":
+    """Calculates the (client_chal, client_resp, other_data) of a CHECKMAC that passes if slot holds key"""
+    client_chal = [0x00]*32
+
+    otherdata = [0x08, 0x00, slot, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
+
+    # perform a local mac command
+    macdata = list(key) + list(client_chal)
+    macdata += otherdata[0:4] + [0x00]*8 + otherdata[4:7]
+    macdata += [0xEE] + otherdata[7:11] + [0x01, 0x23] + otherdata[11:13]
+    client_resp = hashlib.sha256(bytes(macdata)).digest()
+
+    return (client_chal, client_resp, otherdata)
+
+
 class atsha204A:
     i2c_port: pyftdi.i2c.I2cPort
+    wake_port: "pyftdi.i2c.I2cPort|None"
+    snapshot: atsha204A_snapshot
+
+    execution_times: "dict[atasha204A_command, tuple[float, float]]"
+    two_phase_read: bool
 
-    def __init__(self, i2c_port: pyftdi.i2c.I2cPort):
+    last_wake: "float|None"  # monotonic time of the last wake, None while asleep or idle
+    session_depth: int
+
+    def __init__(self, i2c_port: pyftdi.i2c.I2cPort,
+                 execution_times: "dict[atasha204A_command, tuple[float, float]]|None" = None,
+                 two_phase_read: bool = False,
+                 wake_port: "pyftdi.i2c.I2cPort|None" = None):
+        """
+        Creates the chip interface, execution_times overrides the
+        (typical, maximum) wait for any command in COMMAND_EXECUTION_TIME
+        two_phase_read reads the count byte of each response before the rest of the packet
+        wake_port is a port at address 0x00 used to hold SDA low long enough to wake the chip
+        """
         self.i2c_port = i2c_port
+        self.wake_port = wake_port
+        self.two_phase_read = two_phase_read
+        self.snapshot = atsha204A_snapshot()
+
+        self.last_wake = None
+        self.session_depth = 0
+
+        self.execution_times = dict(COMMAND_EXECUTION_TIME)
+        if execution_times is not None:
+            self.execution_times.update(execution_times)
 
 #
 # Helper commands
@@ -40,86 +493,129 @@ class atsha204A:
 
     def sendWake(self):
         """Sends a wake message to the ATSHA204A IC"""
-        self.i2c_port.write(0x00)
+        try:
+            if self.wake_port is not None:
+                self.wake_port.write([0x00])
+            else:
+                self.i2c_port.write(0x00)
+        except pyftdi.i2c.I2cNackError:
+            # nothing acknowledges the wake pulse itself
+            pass
+
+        time.sleep(WAKE_DELAY)
+        self.last_wake = time.monotonic()
+
+    def sendIdle(self):
+        """Puts the chip into idle, which restarts the watchdog and keeps TempKey"""
+        self._send_word_address(WORD_ADDRESS_IDLE)
+
+    def sendSleep(self):
+        """Puts the chip to sleep, clearing TempKey"""
+        self._send_word_address(WORD_ADDRESS_SLEEP)
+
+    def _send_word_address(self, word_address: int):
+        try:
+            self.i2c_port.write([word_address])
+        except pyftdi.i2c.I2cNackError:
+            # already asleep
+            pass
+        self.last_wake = None
+
+    def ensure_awake(self, duration: float = 0.0):
+        """
+        Wakes the chip unless it is known to be awake for at least duration seconds more,
+        goes through idle first when awake so TempKey survives restarting the watchdog
+        """
+        if self.last_wake is not None:
+            remaining = self.last_wake + WATCHDOG_TIMEOUT - WATCHDOG_MARGIN - time.monotonic()
+            if remaining > duration:
+                return
+            self.sendIdle()
+
+        self.sendWake()
+
+    def session(self, sleep: bool = True) -> atsha204A_session:
+        """Context that keeps the chip awake and puts it to sleep (or idle) afterwards"""
+        return atsha204A_session(self, sleep)
 
     def sendCommand(self, oppcode: atasha204A_command, param1: int,
-                    param2: int, data: "list[int]", response_length: int):
-        """Sends a command to the Chip and recieves a response"""
-
-        command = [
-            0x03,  # command flag
-            0x07 + len(data),  # count (includes fixed values)
-            oppcode.value,  # command oppcode
-            param1,  # paramter 1 value
-            param2 & 0xff,  # paramater 2 value LSB
-            param2 >> 8  # parameter 2 value MSB
-        ]
-        command += data  # add data to command
-
-        crc = atsha204A.calculate_crc(command, 1, len(command) - 1)
-
-        command += [
-            crc & 0xFF,
-            crc >> 8,
-        ]
+                    param2: int, data: "list[int]", response_length: "int|None" = None):
+        """
+        Sends a command to the Chip and recieves a response
+        response_length defaults to the expected packet size for the command and mode
+        """
+        if response_length is None:
+            response_length = expected_response_length(oppcode, param1)
+
+        command = build_command(oppcode, param1, param2, data)
 
         # print("Sent command" + ' '.join('{:02x}'.format(x) for x in command))
 
-        self.i2c_port.write(command)
+        self.ensure_awake(self.execution_times[oppcode][1])
+
+        try:
+            self.i2c_port.write(command)
+        except pyftdi.i2c.I2cNackError:
+            # the watchdog or a brown out has put the chip to sleep
+            self.last_wake = None
+            raise atsha204A_asleep_error(self.sendWake)
+
+        response = self.wait_for_response(oppcode, response_length)
+
+        # print("Response" + ' '.join('{:02x}'.format(x) for x in response))
+
+        status = validate_response(response)
+        if status == STATUS_WAKE:
+            # the command woke the chip rather than running
+            self.last_wake = time.monotonic()
+        raise_for_status(status)
+
+        # time.sleep(0.5)
+        return response
+
+    def wait_for_response(self, oppcode: atasha204A_command, response_length: int):
+        """
+        Waits the typical execution time for the command then polls
+        with a short backoff until the maximum execution time has passed
+        returns None if the chip never acknowledged a read
+        """
+        typical, maximum = self.execution_times[oppcode]
+        deadline = time.monotonic() + maximum + POLL_TIMEOUT_MARGIN
+
+        time.sleep(typical)
 
-        response = None
-        for x in range(10):
-            time.sleep(0.02)
+        interval = POLL_INTERVAL_MIN
+        while True:
             try:
-                # todo check incoming CRC
-                # print("reading")
-                response = self.i2c_port.read(response_length)
-                break
+                if self.two_phase_read:
+                    return self.read_response_two_phase()
+                return self.i2c_port.read(response_length)
             except pyftdi.i2c.I2cNackError:
-                # print("read error")
+                # chip is still executing the command
                 pass
-        if response is None:
-            raise Exception("No response from chip")
 
-        # print("Response" + ' '.join('{:02x}'.format(x) for x in response))
-
-        if (response[0] == 0xFF):
-            raise IOError("chip returned no data")
+            if time.monotonic() >= deadline:
+                return None
 
-        resp_crc = atsha204A.calculate_crc(response, 0, response[0]-2)
+            time.sleep(interval)
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
 
-        if ((resp_crc & 0xFF) != response[response[0]-2] or (resp_crc >> 8 & 0xFF) != response[response[0]-1]):
-            raise IOError("chip response CRC mismatch {} {} != {} {}".format(
-                hex(resp_crc & 0xFF), hex(resp_crc >> 8 & 0xFF),
-                hex(response[response[0]-2]), hex(response[response[0]-1])
-            ))
+    def read_response_two_phase(self):
+        """Reads the response count byte and then only the remaining bytes of the packet"""
+        count = self.i2c_port.read(1)
 
-        if (response[0] == 0x04 and response[1] != 0x00):
-            raise RuntimeError("Chip returned an error {}".format(hex(response[1])))
+        # no data or an invalid count, let the caller report it
+        if count[0] < 2 or count[0] == 0xFF:
+            return count
 
-        # time.sleep(0.5)
-        return response
+        # the chip continues from its output buffer pointer on the next read
+        return bytes(count) + bytes(self.i2c_port.read(count[0] - 1))
 
-    def calculate_crc(data: "bytearray|list[int]", offset: int, length: int):
+    def calculate_crc(data: "bytes|bytearray|memoryview|list[int]", offset: int, length: int):
         """Calculates the CRC for the ATSHA204A
         (poly 0805, start at 0x0000, reflect input,
         dont reflect output, no output exor)"""
-        crc = 0x0000
-        for i in range(0, length):
-            d = data[offset + i]
-
-            d = ((d & 0x55) << 1) | ((d & 0xAA) >> 1)
-            d = ((d & 0x33) << 2) | ((d & 0xCC) >> 2)
-            d = ((d & 0x0F) << 4) | ((d & 0xF0) >> 4)
-
-            crc ^= d << 8
-            for j in range(0, 8):
-                if (crc & 0x8000) > 0:
-                    crc = (crc << 1) ^ 0x8005
-                else:
-                    crc = crc << 1
-
-        return crc & 0xFFFF
+        return atsha204A_crc().update(data, offset, length).value
 
 #
 # ATSHA204A crypto commands
@@ -153,8 +649,7 @@ class atsha204A:
 
         mem = self.sendCommand(
             atasha204A_command.CHECK_MAC,  # read command
-            param1, param2, data,
-            38)
+            param1, param2, data)
 
         return mem[1]
 
@@ -170,8 +665,7 @@ class atsha204A:
 
         mem = self.sendCommand(
             atasha204A_command.GEN_DIG,  # read command
-            param1, param2, data,
-            38)
+            param1, param2, data)
 
         return mem[1]
 
@@ -185,10 +679,12 @@ class atsha204A:
 
         param2 = crc
 
+        # the lock bytes are part of the config zone
+        self.snapshot.invalidate(atasha204A_zone.CONFIG, CONFIG_LOCK_VALUE // WORD_SIZE, 1)
+
         mem = self.sendCommand(
             atasha204A_command.LOCK,  # read command
-            param1, param2, [],
-            38)
+            param1, param2, [])
 
         return mem[1]
 
@@ -222,8 +718,7 @@ class atsha204A:
 
         response = self.sendCommand(
             atasha204A_command.MAC,  # read command
-            param1, param2, challenge,
-            38)
+            param1, param2, challenge)
 
         return response[1:33]
 
@@ -236,8 +731,7 @@ class atsha204A:
 
         mem = self.sendCommand(
             atasha204A_command.NONCE,  # read command
-            param1, param2, input,
-            38)
+            param1, param2, input)
 
         if (nonceMode == 0x03):
             return mem[1]
@@ -256,8 +750,7 @@ class atsha204A:
 
         mem = self.sendCommand(
             atasha204A_command.READ,  # read command
-            param1, param2, [],
-            38)
+            param1, param2, [])
 
         if four_byte:
             return mem[1:5]
@@ -288,22 +781,22 @@ class atsha204A:
         if (mac is not None):
             command_data += list(mac)
 
+        # the written words are unknown from here even if the write fails
+        self.snapshot.invalidate(zone, (block << 3) + offset, 1 if four_byte else WORDS_PER_BLOCK)
+
         mem = self.sendCommand(
             atasha204A_command.WRITE,  # read command
-            param1, param2, command_data,
-            38)
+            param1, param2, command_data)
 
-        if four_byte:
-            return mem[1:5]
-        else:
-            return mem[1:33]
+        # write only returns a status byte
+        return mem[1]
 
 #
 # Top level commands
 #
-    def get_serial_number(self) -> bytearray:
+    def get_serial_number(self) -> bytes:
         """Gets the serial number from the ATSHA204A"""
-        mem = self.command_read(atasha204A_zone.CONFIG, 0, 0)
+        mem = self.read_range(atasha204A_zone.CONFIG, 0, 13)
 
         serial_number = mem[0:4] + mem[8:13]
         return serial_number
@@ -317,20 +810,64 @@ class atsha204A:
         else:
             return False
 
+    def read_range(self, zone: atasha204A_zone, start: int, length: int) -> bytes:
+        """
+        Reads an arbitrary byte range of a zone with the fewest READ commands,
+        words already in the snapshot are not read again
+        """
+        if length <= 0:
+            return bytes()
+
+        first_word = start // WORD_SIZE
+        last_word = (start + length - 1) // WORD_SIZE
+        words = range(first_word, last_word + 1)
+
+        missing = [word for word in words if self.snapshot.get(zone, word) is None]
+
+        for block, offset, four_byte in plan_reads(zone, missing):
+            mem = utils.auto_retry(self.command_read, 5, zone, block, offset, four_byte=four_byte)
+            self.snapshot.store(zone, (block << 3) + offset, mem)
+
+        data = b''.join(self.snapshot.get(zone, word) for word in words)
+
+        skip = start - first_word * WORD_SIZE
+        return data[skip:skip + length]
+
+    def write_range(self, zone: atasha204A_zone, start: int, data: "bytes|bytearray|list[int]") -> int:
+        """
+        Writes a word aligned byte range of a zone with the fewest WRITE commands,
+        compares against the current contents (read through the snapshot) and skips matching words
+        returns the number of write commands used
+        """
+        if start % WORD_SIZE:
+            raise ValueError("write start {} is not word aligned".format(start))
+
+        current = self.read_range(zone, start, len(data))
+
+        writes = plan_writes(zone, start // WORD_SIZE, current, data)
+        for block, offset, block_data, four_byte in writes:
+            utils.auto_retry(
+                self.command_write, 5,
+                zone, block, offset, block_data, four_byte=four_byte
+                )
+
+        return len(writes)
+
     def read_config(self):
         """Reads the entire configuration zone"""
+        return list(self.read_range(atasha204A_zone.CONFIG, 0, ZONE_SIZE[atasha204A_zone.CONFIG]))
+
+    def read_otp(self) -> bytes:
+        """Reads the entire OTP zone"""
+        return self.read_range(atasha204A_zone.OTP, 0, ZONE_SIZE[atasha204A_zone.OTP])
 
-        config = list()
-        config += list(utils.auto_retry(self.command_read, 5, atasha204A_zone.CONFIG, 0, 0))
-        config += list(utils.auto_retry(self.command_read, 5, atasha204A_zone.CONFIG, 1, 0))
-        config += list(utils.auto_retry(self.command_read, 5, atasha204A_zone.CONFIG, 2, 0, four_byte=True))
-        config += list(utils.auto_retry(self.command_read, 5, atasha204A_zone.CONFIG, 2, 1, four_byte=True))
-        config += list(utils.auto_retry(self.command_read, 5, atasha204A_zone.CONFIG, 2, 2, four_byte=True))
-        config += list(utils.auto_retry(self.command_read, 5, atasha204A_zone.CONFIG, 2, 3, four_byte=True))
-        config += list(utils.auto_retry(self.command_read, 5, atasha204A_zone.CONFIG, 2, 4, four_byte=True))
-        config += list(utils.auto_retry(self.command_read, 5, atasha204A_zone.CONFIG, 2, 5, four_byte=True))
+    def is_config_locked(self) -> bool:
+        """Checks the LockConfig byte of the config zone"""
+        return self.read_config()[CONFIG_LOCK_CONFIG] != LOCK_UNLOCKED
 
-        return (config)
+    def is_data_locked(self) -> bool:
+        """Checks the LockValue byte covering the data and OTP zones"""
+        return self.read_config()[CONFIG_LOCK_VALUE] != LOCK_UNLOCKED
 
     def encrypted_read(
             self,
@@ -351,25 +888,8 @@ class atsha204A:
         self.command_gendig(atasha204A_zone.DATA, readkey_slot,
                             [0x15, 0x02, readkey_slot, 0x00])
 
-        # calculate the contents of the atsha204a tempkey
-        chip_nonce = None
-        if nonce_type != 0x03:
-            noncedata = list(random) + list(nonce) + [0x16, 0x00, 0x00]
-
-            chip_nonce = hashlib.sha256(
-                bytes(noncedata)
-            ).digest()
-        else:
-            chip_nonce = nonce
-
         # calculate the result of the gendig command to get the tempkey value used as a session key
-        hashdata = list(readkey)
-        hashdata += [0x15, 0x02, readkey_slot, 0x00, serial[8], serial[0], serial[1]]
-        hashdata += [0x00]*25 + list(chip_nonce)
-
-        session_key = hashlib.sha256(
-            bytes(hashdata)
-        ).digest()
+        session_key = gendig_session_key(readkey, readkey_slot, serial, nonce_tempkey(random, nonce, nonce_type))
 
         # read the data from the chip
         data = self.command_read(atasha204A_zone.DATA, readslot, 0)
@@ -399,43 +919,18 @@ class atsha204A:
         self.command_gendig(atasha204A_zone.DATA, writekey_slot,
                             [0x15, 0x02, writekey_slot, 0x00])
 
-        # calculate the contents of the atsha204a tempkey
-        chip_nonce = None
-        if nonce_type != 0x03:
-            noncedata = list(random) + list(nonce) + [0x16, 0x00, 0x00]
-
-            chip_nonce = hashlib.sha256(
-                bytes(noncedata)
-            ).digest()
-        else:
-            chip_nonce = nonce
-
         # calculate the result of the gendig command to get the tempkey value used as a session key
-        hashdata = list(writekey)
-        hashdata += [0x15, 0x02, writekey_slot, 0x00, serial[8], serial[0], serial[1]]
-        hashdata += [0x00]*25 + list(chip_nonce)
-
-        session_key = hashlib.sha256(
-            bytes(hashdata)
-        ).digest()
+        session_key = gendig_session_key(writekey, writekey_slot, serial, nonce_tempkey(random, nonce, nonce_type))
 
         # xor the data with the session_key
         xored = bytes(a ^ b for a, b in zip(data, session_key))
 
-        # calculate the mac value
-        write_addr = write_slot << 3
-        mac = hashlib.sha256(bytes(
-            list(session_key) +
-            [0x12, 0x82, write_addr & 0xFF, (write_slot >> 8) & 0xFF, serial[8], serial[0], serial[1]] +
-            [0x00]*25 + list(data)
-        )).digest()
-
         # perform the write command
         self.command_write(
             atasha204A_zone.DATA,
             write_slot, 0,
             xored,
-            mac,
+            encrypted_write_mac(session_key, write_slot, serial, data),
             encrypted=False  # it is actualy encrypted but encryption is ignored after zones are locked
         )
 
@@ -448,35 +943,36 @@ class atsha204A:
         Geneates a diversified key for the device
         Uses implementation in Atmel-8841A-CryptoAuth-ATSHA204-Unique-Keys-ApplicationNote_042013
         """
-        serial = self.get_serial_number()
-
-        serial_pad = [0x00] * (32 - 9)
-
-        generation_hash_data = list(root_key)
-        generation_hash_data += [0x1C, 0x04, target_slot & 0xFF, (target_slot >> 8) & 0xFF]
-        generation_hash_data += [0xEE, 0x01, 0x23]
-        generation_hash_data += [0x00] * 25
-        generation_hash_data += list(serial) + list(serial_pad)
-
-        diversified_key = hashlib.sha256(bytes(
-            generation_hash_data
-        )).digest()
-
-        return diversified_key
+        return diversified_key(root_key, target_slot, self.get_serial_number())
 
     def check_key(self, slot: int, key: "bytearray|list[int]"):
         """Checks a key matches the expected value"""
 
-        client_chal = [0x00]*32
+        client_chal, client_resp, otherdata = checkmac_inputs(slot, key)
 
-        otherdata = [0x08, 0x00, slot, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
+        self.command_checkmac(slot, client_chal, client_resp, otherdata)
 
-        # perform a local mac command
-        macdata = list(key) + list(client_chal)
-        macdata += otherdata[0:4] + [0x00]*8 + otherdata[4:7]
-        macdata += [0xEE] + otherdata[7:11] + [0x01, 0x23] + otherdata[11:13]
-        client_resp = hashlib.sha256(
-            bytes(macdata)
-        ).digest()
 
-        self.command_checkmac(slot, client_chal, client_resp, otherdata)
+# Checks the table driven CRC against the reference and benchmarks them if run on its own
+if __name__ == "__main__":
+    import os
+    import timeit
+
+    for length in range(0, 600, 7):
+        sample = list(os.urandom(length))
+        assert atsha204A.calculate_crc(sample, 0, length) == _calculate_crc_bitwise(sample, 0, length)
+        assert atsha204A.calculate_crc(bytes(sample), 0, length) == _calculate_crc_bitwise(sample, 0, length)
+
+    incremental = atsha204A_crc()
+    for x in range(0, len(sample), 32):
+        incremental.update(memoryview(bytes(sample))[x:x+32])
+    assert incremental.value == _calculate_crc_bitwise(sample, 0, len(sample))
+
+    # typical command frame and the data zone + OTP lock CRC stream
+    for name, length in (("command", 38), ("lock", 576)):
+        sample = list(os.urandom(length))
+        runs = 2000
+        bitwise = timeit.timeit(lambda: _calculate_crc_bitwise(sample, 0, length), number=runs) / runs
+        table = timeit.timeit(lambda: atsha204A.calculate_crc(sample, 0, length), number=runs) / runs
+        print("{} ({} bytes): bitwise {:.1f}us, table {:.1f}us ({:.1f}x)".format(
+            name, length, bitwise * 1e6, table * 1e6, bitwise / table))
@@ -1,14 +1,40 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
 import utils
 
 
 FS_OFFSET = 32
 FS_PAGE_SZE = 32
 FS_TOTAL = 1024*8
+FS_SIZE = FS_TOTAL - FS_OFFSET
 VID = 0xF055
 PID = 0x4247
 
 LITTLEFS_BLOCK_SIZE = 512
 LITTLEFS_BLOCK_COUNT = int((FS_TOTAL-32)/LITTLEFS_BLOCK_SIZE)
+LITTLEFS_MAGIC = b'littlefs'
+LITTLEFS_MAGIC_OFFSET = 8
+LITTLEFS_GEOMETRY = struct.Struct("<II")  # block size and count in the superblock entry
+LITTLEFS_GEOMETRY_OFFSET = 24
+
+# hex dump of the filesystem image, the LITTLEFS_IMAGE environment variable overrides it
+LITTLEFS_IMAGE_PATH = os.environ.get(
+    "LITTLEFS_IMAGE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "littlefs_blob"))
+SIDECAR_SUFFIX = ".bin"
+SIDECAR_TRAILER = struct.Struct("<Q32s")  # size and sha256 of the hex dump the sidecar was built from
+
+IMAGE_SIZE = FS_TOTAL
+HEADER_SERIAL_OFFSET = 20
+HEADER_CHECKSUM_OFFSET = 31
+
+# batch file layout: a fixed header then IMAGE_SIZE bytes per serial
+BATCH_MAGIC = b'THEXBTCH'
+BATCH_HEADER = struct.Struct("<8sII32s")  # magic, first serial, count, filesystem sha256
+BATCH_HEADER_SIZE = 64
 
 
 def generate_header_data(serial: int):
@@ -33,22 +59,266 @@ def generate_header_data(serial: int):
     return header
 
 
-def check_littlefs_dump_against_file(data):
+def validate_littlefs_image(image: "bytes|bytearray|memoryview"):
+    """Checks a filesystem image fits the EEPROM layout, raises ValueError if not"""
+    if len(image) != FS_SIZE:
+        raise ValueError("littlefs image is {} bytes, expected {}".format(len(image), FS_SIZE))
+    if bytes(image[LITTLEFS_MAGIC_OFFSET:LITTLEFS_MAGIC_OFFSET + len(LITTLEFS_MAGIC)]) != LITTLEFS_MAGIC:
+        raise ValueError("littlefs superblock not found")
+
+    block_size, block_count = LITTLEFS_GEOMETRY.unpack_from(image, LITTLEFS_GEOMETRY_OFFSET)
+    if (block_size, block_count) != (LITTLEFS_BLOCK_SIZE, LITTLEFS_BLOCK_COUNT):
+        raise ValueError("littlefs image has {} blocks of {} bytes, expected {} of {}".format(
+            block_count, block_size, LITTLEFS_BLOCK_COUNT, LITTLEFS_BLOCK_SIZE))
+
+
+class littlefs_image_store:
+    """
+    Loads the hex dump filesystem image once and keeps a binary sidecar next to it,
+    later runs memory map the sidecar instead of parsing the hex again, the sidecar
+    records the size and hash of its source and is rebuilt when they no longer match
+    fixture and prepare threads share one store, a lock keeps them from loading it at once
+    """
+
+    path: str
+    sidecar_path: str
 
-    with open("littlefs_blob", "r") as output:
-        fs_dump = bytearray.fromhex(output.read())
-        if list(fs_dump) == list(data):
+    _source_stat: "tuple[int, int, int]|None"  # (mtime_ns, ctime_ns, size) of the loaded source
+    _image: "memoryview|None"
+    _digest: "bytes|None"
+    _mmap: "mmap.mmap|None"
+
+    def __init__(self, path: str = LITTLEFS_IMAGE_PATH):
+        self.path = path
+        self.sidecar_path = path + SIDECAR_SUFFIX
+
+        self._source_stat = None
+        self._image = None
+        self._digest = None
+        self._mmap = None
+        self._lock = threading.Lock()
+
+    def image(self) -> memoryview:
+        """Gets a read only view of the filesystem image"""
+        with self._lock:
+            self._reload_if_changed()
+            return self._image
+
+    def digest(self) -> bytes:
+        """Gets the sha256 digest of the filesystem image"""
+        with self._lock:
+            self._reload_if_changed()
+            return self._digest
+
+    def _reload_if_changed(self):
+        # call with self._lock held
+        # ctime changes on any write, so a copy that keeps the mtime (cp -p, touch -r) still reloads
+        stat = os.stat(self.path)
+        if self._image is None or self._source_stat != (stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size):
+            self._load(stat)
+
+    def _sidecar_fresh(self, trailer: bytes) -> bool:
+        # the sidecar ends with the size and hash of the source it was built from
+        try:
+            with open(self.sidecar_path, "rb") as sidecar:
+                if os.fstat(sidecar.fileno()).st_size != FS_SIZE + SIDECAR_TRAILER.size:
+                    return False
+                sidecar.seek(FS_SIZE)
+                return sidecar.read() == trailer
+        except OSError:
+            return False
+
+    def _write_sidecar(self, image: bytes, trailer: bytes) -> bool:
+        temp_path = self.sidecar_path + ".tmp"
+        try:
+            with open(temp_path, "wb") as sidecar:
+                sidecar.write(image)
+                sidecar.write(trailer)
+            os.replace(temp_path, self.sidecar_path)
             return True
-        else:
+        except OSError:
+            # read only checkout, fall back to keeping the image in memory
             return False
 
+    def _load(self, stat: os.stat_result):
+        # call with self._lock held
+        self._release()
+
+        with open(self.path, "rb") as source:
+            hex_dump = source.read()
+        trailer = SIDECAR_TRAILER.pack(len(hex_dump), hashlib.sha256(hex_dump).digest())
+
+        if not self._sidecar_fresh(trailer):
+            image = bytes.fromhex(hex_dump.decode())
+            validate_littlefs_image(image)
+
+            if not self._write_sidecar(image, trailer):
+                self._image = memoryview(image)
+
+        if self._image is None:
+            with open(self.sidecar_path, "rb") as sidecar:
+                self._mmap = mmap.mmap(sidecar.fileno(), 0, access=mmap.ACCESS_READ)
+            self._image = memoryview(self._mmap)[:FS_SIZE]
+            validate_littlefs_image(self._image)
+
+        self._digest = hashlib.sha256(self._image).digest()
+        self._source_stat = (stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size)
+
+    def close(self):
+        """Releases the memory map, views handed out before stay valid until they are released"""
+        with self._lock:
+            self._release()
+
+    def _release(self):
+        self._image = None
+        self._digest = None
+        self._source_stat = None
+
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a caller still holds a view, the map is freed with it
+                pass
+            self._mmap = None
+
+
+_image_store = None
+_image_store_lock = threading.Lock()
+
+
+def set_littlefs_image_path(path: str):
+    """Changes the filesystem image used by get_littlefs_image"""
+    global _image_store
+    with _image_store_lock:
+        if _image_store is not None:
+            _image_store.close()
+        _image_store = littlefs_image_store(path)
+
 
-def get_littlefs_image():
-    with open("littlefs_blob", "r") as output:
-        fs_dump = bytearray.fromhex(output.read())
+def get_image_store() -> littlefs_image_store:
+    global _image_store
+    with _image_store_lock:
+        if _image_store is None:
+            _image_store = littlefs_image_store()
+        return _image_store
 
-    return fs_dump
+
+_header_template = None
+
+
+def get_header_template() -> bytes:
+    """Gets the header for serial 0, every other header differs only in the serial and checksum bytes"""
+    global _header_template
+    if _header_template is None:
+        _header_template = bytes(generate_header_data(0))
+    return _header_template
+
+
+def compile_header(serial: int, image: "bytearray|memoryview", offset: int = 0):
+    """Writes the header for serial into image at offset by patching the template"""
+    template = get_header_template()
+    low, high = serial.to_bytes(2, 'little')
+
+    image[offset:offset + FS_OFFSET] = template
+    image[offset + HEADER_SERIAL_OFFSET] = low
+    image[offset + HEADER_SERIAL_OFFSET + 1] = high
+    # the template checksum covers zero serial bytes, so xor the new ones in
+    image[offset + HEADER_CHECKSUM_OFFSET] = template[HEADER_CHECKSUM_OFFSET] ^ low ^ high
+
+
+def compile_image(serial: int, filesystem: "bytes|memoryview|None" = None) -> bytearray:
+    """Builds the complete EEPROM contents (header and filesystem) for serial as one buffer"""
+    if filesystem is None:
+        filesystem = get_littlefs_image()
+    validate_littlefs_image(filesystem)
+
+    image = bytearray(IMAGE_SIZE)
+    compile_header(serial, image)
+    image[FS_OFFSET:] = filesystem
+    return image
+
+
+def compile_batch(path: str, first_serial: int, count: int):
+    """
+    Pre-generates the images for count serials starting at first_serial into a batch file,
+    the filesystem is copied once and only the headers are patched per serial
+    """
+    if count < 1 or first_serial < 0 or first_serial + count > 0x10000:
+        raise ValueError("serials {:04X}+{} do not fit in 16 bits".format(first_serial, count))
+
+    filesystem = get_littlefs_image()
+    image = compile_image(first_serial, filesystem)
+
+    header = bytearray(BATCH_HEADER_SIZE)
+    BATCH_HEADER.pack_into(header, 0, BATCH_MAGIC, first_serial, count, hashlib.sha256(filesystem).digest())
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as batch:
+        batch.write(header)
+        for serial in range(first_serial, first_serial + count):
+            compile_header(serial, image)
+            batch.write(image)
+    os.replace(temp_path, path)
+
+
+class image_batch:
+    """Memory maps a batch file from compile_batch and hands out the image for each serial"""
+
+    path: str
+    first_serial: int
+    count: int
+    digest: bytes
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, "rb") as batch:
+            if os.fstat(batch.fileno()).st_size < BATCH_HEADER_SIZE:
+                raise ValueError("{} is not an EEPROM image batch".format(path))
+            self._mmap = mmap.mmap(batch.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.first_serial, self.count, self.digest = BATCH_HEADER.unpack_from(self._mmap, 0)
+        if magic != BATCH_MAGIC:
+            self.close()
+            raise ValueError("{} is not an EEPROM image batch".format(path))
+        if len(self._mmap) != BATCH_HEADER_SIZE + self.count * IMAGE_SIZE:
+            self.close()
+            raise ValueError("{} is truncated".format(path))
+
+    def is_current(self) -> bool:
+        """Checks the batch was compiled from the current filesystem image"""
+        return self.digest == get_image_store().digest()
+
+    def image(self, serial: int) -> "memoryview|None":
+        """Gets the image for serial, None if the serial is not in the batch"""
+        if not self.first_serial <= serial < self.first_serial + self.count:
+            return None
+        start = BATCH_HEADER_SIZE + (serial - self.first_serial) * IMAGE_SIZE
+        return memoryview(self._mmap)[start:start + IMAGE_SIZE]
+
+    def close(self):
+        try:
+            self._mmap.close()
+        except BufferError:
+            # a caller still holds an image, the map is freed with it
+            pass
+
+
+def check_littlefs_dump_against_file(data):
+    return get_littlefs_image() == memoryview(bytes(data))
+
+
+def get_littlefs_image() -> memoryview:
+    """Gets a read only, zero copy view of the filesystem image"""
+    return get_image_store().image()
 
 
 if __name__ == "__main__":
     print(utils.hexString(generate_header_data(0x0000)))
+
+    # the patched template has to match the header built from scratch
+    for serial in (0x0000, 0x0001, 0x00FF, 0x1234, 0xFFFF):
+        image = compile_image(serial)
+        assert list(image[:FS_OFFSET]) == generate_header_data(serial)
+        assert image[FS_OFFSET:] == get_littlefs_image()
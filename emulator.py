@@ -0,0 +1,783 @@
+import hashlib
+import os
+import time
+import atsha204a
+import provisioner
+import pyftdi.i2c
+import tca9548a
+import threading
+from atsha204a import atasha204A_command, atasha204A_zone
+
+
+# I2C addresses (7 bit) of the devices on a hexpansion
+ATSHA_ADDRESS = 0xC8 >> 1
+EEPROM_ADDRESS = 0x57
+GENERAL_CALL_ADDRESS = 0x00
+
+# ATSHA204A status codes
+STATUS_SUCCESS = 0x00
+STATUS_MISCOMPARE = 0x01
+STATUS_PARSE_ERROR = 0x03
+STATUS_EXECUTION_ERROR = 0x0F
+
+WATCHDOG_TIMEOUT = 1.3  # typical watchdog period of a real chip
+EEPROM_WRITE_CYCLE = 0.005  # zd24c64a maximum write cycle time
+POWER_UP_DELAY = 0.002  # after insertion nothing on the board answers until its supply settles
+
+EEPROM_SIZE = 1024 * 8
+EEPROM_PAGE_SIZE = 32
+
+
+class atsha204A_emulator:
+    """
+    Emulates an ATSHA204A at the I2C packet level with the commands this project uses
+    (READ, WRITE, LOCK, NONCE, GENDIG, MAC, CHECKMAC), zone locking, slot permissions,
+    the watchdog and command execution delays
+    """
+
+    config: bytearray
+    otp: bytearray
+    data: bytearray
+
+    tempkey: "bytes|None"
+    tempkey_source_flag: int  # 0 random nonce, 1 pass-through input
+    tempkey_key_id: "int|None"  # slot used by the last GenDig, None if not generated by GenDig
+
+    execution_times: "dict[atasha204A_command, float]"
+    watchdog_timeout: "float|None"
+
+    state: str  # "sleep", "idle" or "awake"
+    wake_time: float
+    busy_until: float
+    output: bytes
+    output_pointer: int
+
+    def __init__(
+            self,
+            serial: "bytes|None" = None,
+            execution_times: "dict[atasha204A_command, float]|None" = None,
+            time_scale: float = 1.0,
+            watchdog_timeout: "float|None" = WATCHDOG_TIMEOUT):
+        """
+        Creates a factory fresh chip, serial is the 9 byte serial number (random by default)
+        execution times default to the datasheet typical times scaled by time_scale
+        """
+        if serial is None:
+            serial = bytes([0x01, 0x23]) + os.urandom(6) + bytes([0xEE])
+
+        self.config = bytearray(88)
+        self.config[0:4] = serial[0:4]
+        self.config[4:8] = bytes([0x00, 0x09, 0x04, 0x00])  # revision
+        self.config[8:13] = serial[4:9]
+        self.config[14] = 0x01  # I2C enable
+        self.config[16:20] = bytes([0xC8, 0x00, 0x55, 0x00])
+        self.config[20:52] = bytes([0x8F, 0x80]) * 16
+        self.config[52:68] = bytes([0xFF, 0x00]) * 8
+        self.config[68:84] = bytes([0xFF]) * 16
+        self.config[atsha204a.CONFIG_LOCK_VALUE] = atsha204a.LOCK_UNLOCKED
+        self.config[atsha204a.CONFIG_LOCK_CONFIG] = atsha204a.LOCK_UNLOCKED
+
+        self.otp = bytearray([0xFF] * atsha204a.ZONE_SIZE[atasha204A_zone.OTP])
+        self.data = bytearray([0xFF] * atsha204a.ZONE_SIZE[atasha204A_zone.DATA])
+
+        self.tempkey = None
+        self.tempkey_source_flag = 0
+        self.tempkey_key_id = None
+
+        self.execution_times = {
+            command: times[0] * time_scale for command, times in atsha204a.COMMAND_EXECUTION_TIME.items()
+        }
+        if execution_times is not None:
+            self.execution_times.update(execution_times)
+        self.watchdog_timeout = watchdog_timeout
+
+        self.state = "sleep"
+        self.wake_time = 0.0
+        self.busy_until = 0.0
+        self.output = bytes()
+        self.output_pointer = 0
+
+    @property
+    def serial(self) -> bytes:
+        return bytes(self.config[0:4] + self.config[8:13])
+
+    def config_locked(self) -> bool:
+        return self.config[atsha204a.CONFIG_LOCK_CONFIG] != atsha204a.LOCK_UNLOCKED
+
+    def data_locked(self) -> bool:
+        return self.config[atsha204a.CONFIG_LOCK_VALUE] != atsha204a.LOCK_UNLOCKED
+
+    def slot_config(self, slot: int) -> int:
+        return self.config[20 + slot * 2] | (self.config[21 + slot * 2] << 8)
+
+#
+# Bus level behaviour
+#
+
+    def _update_state(self):
+        """Applies the watchdog, which sends an awake chip to sleep"""
+        if (self.state == "awake" and self.watchdog_timeout is not None and
+                time.monotonic() - self.wake_time > self.watchdog_timeout):
+            self.sleep()
+
+    def wake(self):
+        """Handles a wake pulse (SDA held low)"""
+        self._update_state()
+        if self.state != "awake":
+            self.state = "awake"
+            self.wake_time = time.monotonic()
+            self.busy_until = 0.0
+            self._set_output([0x11])
+
+    def sleep(self):
+        self.state = "sleep"
+        self.tempkey = None
+        self.tempkey_key_id = None
+
+    def acknowledges(self) -> bool:
+        """Checks if the chip would ACK its address"""
+        self._update_state()
+        return self.state == "awake" and time.monotonic() >= self.busy_until
+
+    def write(self, packet: bytes):
+        """Handles an addressed I2C write"""
+        if not self.acknowledges():
+            raise pyftdi.i2c.I2cNackError("ATSHA204A NACK")
+
+        if len(packet) == 0:
+            return
+
+        word_address = packet[0]
+        if word_address == 0x00:  # reset the output buffer pointer
+            self.output_pointer = 0
+        elif word_address == atsha204a.WORD_ADDRESS_SLEEP:
+            self.sleep()
+        elif word_address == atsha204a.WORD_ADDRESS_IDLE:
+            self.state = "idle"
+        elif word_address == atsha204a.WORD_ADDRESS_COMMAND:
+            self._command_packet(bytes(packet[1:]))
+
+    def read(self, length: int) -> bytes:
+        """Handles an addressed I2C read"""
+        if not self.acknowledges():
+            raise pyftdi.i2c.I2cNackError("ATSHA204A NACK")
+
+        result = bytes(self.output[self.output_pointer:self.output_pointer + length])
+        self.output_pointer += length
+        return result + bytes([0xFF] * (length - len(result)))
+
+    def _set_output(self, payload: "bytes|list[int]"):
+        packet = [len(payload) + 3] + list(payload)
+        crc = atsha204a.atsha204A.calculate_crc(packet, 0, len(packet))
+        self.output = bytes(packet + [crc & 0xFF, crc >> 8])
+        self.output_pointer = 0
+
+    def _command_packet(self, packet: bytes):
+        if len(packet) < 7 or packet[0] != len(packet):
+            self._set_output([STATUS_PARSE_ERROR])
+            return
+
+        crc = atsha204a.atsha204A.calculate_crc(packet, 0, len(packet) - 2)
+        if packet[-2] != crc & 0xFF or packet[-1] != crc >> 8:
+            self._set_output([atsha204a.STATUS_COMMS_ERROR])
+            return
+
+        try:
+            oppcode = atasha204A_command(packet[1])
+        except ValueError:
+            self._set_output([STATUS_PARSE_ERROR])
+            return
+
+        param1 = packet[2]
+        param2 = packet[3] | (packet[4] << 8)
+        data = packet[5:-2]
+
+        handler = {
+            atasha204A_command.CHECK_MAC: self._checkmac,
+            atasha204A_command.GEN_DIG: self._gendig,
+            atasha204A_command.LOCK: self._lock,
+            atasha204A_command.MAC: self._mac,
+            atasha204A_command.NONCE: self._nonce,
+            atasha204A_command.READ: self._read,
+            atasha204A_command.WRITE: self._write,
+        }.get(oppcode)
+
+        if handler is None:
+            self._set_output([STATUS_PARSE_ERROR])
+            return
+
+        self._set_output(handler(param1, param2, data))
+        self.busy_until = time.monotonic() + self.execution_times[oppcode]
+
+#
+# Commands, each returns the response payload
+#
+
+    def _zone_memory(self, zone_id: int) -> "bytearray|None":
+        return {
+            atasha204A_zone.CONFIG.value: self.config,
+            atasha204A_zone.OTP.value: self.otp,
+            atasha204A_zone.DATA.value: self.data,
+        }.get(zone_id)
+
+    def _address(self, param1: int, param2: int) -> "tuple[int, int]":
+        """Gets the byte address and length of a read or write"""
+        if param1 & 0x80:
+            return ((param2 >> 3) * atsha204a.BLOCK_SIZE, atsha204a.BLOCK_SIZE)
+        return (param2 * atsha204a.WORD_SIZE, atsha204a.WORD_SIZE)
+
+    def _tempkey_from_gendig(self, slot: int) -> bool:
+        return self.tempkey is not None and self.tempkey_key_id == slot
+
+    def _read(self, param1: int, param2: int, data: bytes):
+        zone_id = param1 & 0x03
+        memory = self._zone_memory(zone_id)
+        address, length = self._address(param1, param2)
+        if memory is None or address + length > len(memory):
+            return [STATUS_PARSE_ERROR]
+
+        if zone_id == atasha204A_zone.CONFIG.value:
+            return memory[address:address + length]
+
+        if not self.data_locked():
+            return [STATUS_EXECUTION_ERROR]
+
+        if zone_id == atasha204A_zone.OTP.value:
+            return memory[address:address + length]
+
+        slot_config = self.slot_config(address // 32)
+        if slot_config & 0x40:  # encrypted read
+            read_key = slot_config & 0x0F
+            if length != 32 or not self._tempkey_from_gendig(read_key):
+                return [STATUS_EXECUTION_ERROR]
+            return bytes(a ^ b for a, b in zip(memory[address:address + 32], self.tempkey))
+
+        if slot_config & 0x80:  # secret
+            return [STATUS_EXECUTION_ERROR]
+
+        return memory[address:address + length]
+
+    def _write(self, param1: int, param2: int, data: bytes):
+        zone_id = param1 & 0x03
+        memory = self._zone_memory(zone_id)
+        address, length = self._address(param1, param2)
+        if memory is None or address + length > len(memory) or len(data) not in (length, length + 32):
+            return [STATUS_PARSE_ERROR]
+
+        value = data[0:length]
+
+        if zone_id == atasha204A_zone.CONFIG.value:
+            if self.config_locked() or address + length > 84 or (length == 4 and address < 16):
+                return [STATUS_EXECUTION_ERROR]
+            # serial and revision bytes are read only
+            start = max(address, 16)
+            self.config[start:address + length] = value[start - address:]
+            return [STATUS_SUCCESS]
+
+        if not self.config_locked():
+            return [STATUS_EXECUTION_ERROR]
+
+        if not self.data_locked():
+            memory[address:address + length] = value
+            return [STATUS_SUCCESS]
+
+        if zone_id == atasha204A_zone.OTP.value:
+            return [STATUS_EXECUTION_ERROR]  # OTP is read only once locked
+
+        slot_config = self.slot_config(address // 32)
+        write_config = slot_config >> 12
+
+        if write_config & 0x08:  # never
+            return [STATUS_EXECUTION_ERROR]
+
+        if write_config & 0x04:  # encrypted writes with a MAC
+            write_key = (slot_config >> 8) & 0x0F
+            if length != 32 or len(data) != 64 or not self._tempkey_from_gendig(write_key):
+                return [STATUS_EXECUTION_ERROR]
+
+            plain = bytes(a ^ b for a, b in zip(value, self.tempkey))
+            serial = self.serial
+            mac = hashlib.sha256(
+                self.tempkey +
+                bytes([0x12, param1, param2 & 0xFF, param2 >> 8, serial[8], serial[0], serial[1]]) +
+                bytes(25) + plain
+            ).digest()
+            if mac != bytes(data[32:64]):
+                return [STATUS_MISCOMPARE]
+            value = plain
+
+        memory[address:address + length] = value
+        return [STATUS_SUCCESS]
+
+    def _lock(self, param1: int, param2: int, data: bytes):
+        if param1 & 0x01:
+            if not self.config_locked() or self.data_locked():
+                return [STATUS_EXECUTION_ERROR]
+            crc = atsha204a.atsha204A_crc().update(self.data).update(self.otp).value
+            lock_byte = atsha204a.CONFIG_LOCK_VALUE
+        else:
+            if self.config_locked():
+                return [STATUS_EXECUTION_ERROR]
+            crc = atsha204a.atsha204A_crc().update(self.config).value
+            lock_byte = atsha204a.CONFIG_LOCK_CONFIG
+
+        if not (param1 & 0x80) and crc != param2:
+            return [STATUS_EXECUTION_ERROR]
+
+        self.config[lock_byte] = 0x00
+        return [STATUS_SUCCESS]
+
+    def _nonce(self, param1: int, param2: int, data: bytes):
+        mode = param1 & 0x03
+        if mode == 0x03:
+            if len(data) != 32:
+                return [STATUS_PARSE_ERROR]
+            self.tempkey = bytes(data)
+            self.tempkey_source_flag = 1
+            self.tempkey_key_id = None
+            return [STATUS_SUCCESS]
+
+        if mode == 0x02 or len(data) != 20:
+            return [STATUS_PARSE_ERROR]
+
+        random = os.urandom(32)
+        self.tempkey = hashlib.sha256(random + bytes(data) + bytes([0x16, mode, 0x00])).digest()
+        self.tempkey_source_flag = 0
+        self.tempkey_key_id = None
+        return random
+
+    def _gendig(self, param1: int, param2: int, data: bytes):
+        if param1 != atasha204A_zone.DATA.value or param2 > 0x0F or len(data) not in (0, 4):
+            return [STATUS_PARSE_ERROR]
+        if self.tempkey is None or not self.config_locked():
+            return [STATUS_EXECUTION_ERROR]
+
+        # check only keys must be given the 4 bytes that replace the opcode and parameters
+        if self.slot_config(param2) & 0x10 and len(data) != 4:
+            return [STATUS_EXECUTION_ERROR]
+
+        if len(data) == 4:
+            header = bytes(data)
+        else:
+            header = bytes([0x15, param1, param2 & 0xFF, param2 >> 8])
+
+        serial = self.serial
+        key = bytes(self.data[param2 * 32:param2 * 32 + 32])
+        self.tempkey = hashlib.sha256(
+            key + header + bytes([serial[8], serial[0], serial[1]]) + bytes(25) + self.tempkey
+        ).digest()
+        self.tempkey_key_id = param2
+        return [STATUS_SUCCESS]
+
+    def _mac_inputs(self, mode: int, slot: int, challenge: bytes, check_only: bool = False) -> "bytes|None":
+        """
+        Gets the first 64 bytes hashed by MAC/CHECKMAC, None if the mode is not usable
+        check_only keys can only be used when check_only is set (CHECKMAC)
+        """
+        if mode & 0x03:
+            if self.tempkey is None or ((mode >> 2) & 0x01) != self.tempkey_source_flag:
+                return None
+
+        if mode & 0x02:
+            first = self.tempkey
+        else:
+            if slot > 0x0F or (self.slot_config(slot) & 0x10 and not check_only):
+                return None
+            first = bytes(self.data[slot * 32:slot * 32 + 32])
+
+        second = self.tempkey if mode & 0x01 else bytes(challenge)
+
+        return first + second
+
+    def _mac(self, param1: int, param2: int, data: bytes):
+        if len(data) != (0 if param1 & 0x01 else 32):
+            return [STATUS_PARSE_ERROR]
+        if not self.config_locked():
+            return [STATUS_EXECUTION_ERROR]
+
+        inputs = self._mac_inputs(param1, param2, data)
+        if inputs is None:
+            return [STATUS_EXECUTION_ERROR]
+
+        serial = self.serial
+        otp_low = bytes(self.otp[0:8]) if param1 & 0x30 else bytes(8)
+        otp_high = bytes(self.otp[8:11]) if param1 & 0x10 else bytes(3)
+        sn_mid = bytes(serial[4:8]) if param1 & 0x40 else bytes(4)
+        sn_low = bytes(serial[2:4]) if param1 & 0x40 else bytes(2)
+
+        return hashlib.sha256(
+            inputs + bytes([0x08, param1, param2 & 0xFF, param2 >> 8]) + otp_low + otp_high +
+            bytes([serial[8]]) + sn_mid + bytes([serial[0], serial[1]]) + sn_low
+        ).digest()
+
+    def _checkmac(self, param1: int, param2: int, data: bytes):
+        if len(data) != 77:
+            return [STATUS_PARSE_ERROR]
+        if not self.config_locked():
+            return [STATUS_EXECUTION_ERROR]
+
+        challenge, response, other = data[0:32], data[32:64], data[64:77]
+
+        inputs = self._mac_inputs(param1, param2, challenge, check_only=True)
+        if inputs is None:
+            return [STATUS_EXECUTION_ERROR]
+
+        serial = self.serial
+        otp_low = bytes(self.otp[0:8]) if param1 & 0x20 else bytes(8)
+
+        expected = hashlib.sha256(
+            inputs + bytes(other[0:4]) + otp_low + bytes(other[4:7]) + bytes([serial[8]]) +
+            bytes(other[7:11]) + bytes([serial[0], serial[1]]) + bytes(other[11:13])
+        ).digest()
+
+        return [STATUS_SUCCESS if expected == bytes(response) else STATUS_MISCOMPARE]
+
+
+class zd24c64a_emulator:
+    """Emulates the 8KB EEPROM with page writes, the internal write cycle and write protect"""
+
+    memory: bytearray
+    pointer: int
+    busy_until: float
+    write_cycle: float
+    write_protected: callable
+
+    def __init__(self, write_protected: callable = lambda: False, write_cycle: float = EEPROM_WRITE_CYCLE):
+        self.memory = bytearray([0xFF] * EEPROM_SIZE)
+        self.pointer = 0
+        self.busy_until = 0.0
+        self.write_cycle = write_cycle
+        self.write_protected = write_protected
+
+    def acknowledges(self) -> bool:
+        return time.monotonic() >= self.busy_until
+
+    def write(self, packet: bytes):
+        if not self.acknowledges():
+            raise pyftdi.i2c.I2cNackError("EEPROM busy")
+        if len(packet) < 2:
+            return
+
+        self.pointer = ((packet[0] << 8) | packet[1]) % EEPROM_SIZE
+        data = packet[2:]
+        if len(data) == 0:
+            return
+
+        if self.write_protected():
+            raise pyftdi.i2c.I2cNackError("EEPROM write protected")
+
+        # page writes wrap around within the page
+        page = self.pointer - (self.pointer % EEPROM_PAGE_SIZE)
+        for byte in data[-EEPROM_PAGE_SIZE:]:
+            self.memory[self.pointer] = byte
+            self.pointer = page + (self.pointer + 1 - page) % EEPROM_PAGE_SIZE
+
+        self.busy_until = time.monotonic() + self.write_cycle
+
+    def read(self, length: int) -> bytes:
+        if not self.acknowledges():
+            raise pyftdi.i2c.I2cNackError("EEPROM busy")
+
+        result = bytearray()
+        for x in range(length):
+            result.append(self.memory[self.pointer])
+            self.pointer = (self.pointer + 1) % EEPROM_SIZE
+        return bytes(result)
+
+
+class tca9548a_emulator:
+    """Emulates the TCA9548A control register, a bit per connected channel"""
+
+    selection: int
+
+    def __init__(self):
+        self.selection = 0
+
+    def acknowledges(self) -> bool:
+        return True
+
+    def write(self, packet: bytes):
+        if len(packet):
+            self.selection = packet[-1]
+
+    def read(self, length: int) -> bytes:
+        return bytes([self.selection] * length)
+
+
+class emulated_board:
+    """The devices on one hexpansion"""
+
+    crypto: atsha204A_emulator
+    eeprom: zd24c64a_emulator
+    ready_at: float  # monotonic time the board powers up
+
+    def __init__(self, crypto: atsha204A_emulator, eeprom: zd24c64a_emulator):
+        self.crypto = crypto
+        self.eeprom = eeprom
+        self.ready_at = 0.0
+
+    def powered(self) -> bool:
+        return time.monotonic() >= self.ready_at
+
+
+class emulated_i2c_port:
+    """
+    I2cPort stand-in that routes transfers to the device at an address
+    on whichever board is currently inserted in the emulated provisioner
+    """
+
+    def __init__(self, provisioner_device: "emulated_provisioner", address: int):
+        self._provisioner = provisioner_device
+        self._address = address
+
+    def _device(self):
+        if self._address == tca9548a.TCA9548A_ADDRESS and self._provisioner.mux is not None:
+            return self._provisioner.mux
+
+        board = self._provisioner.board
+        if board is None or not board.powered():
+            return None
+        if self._address == ATSHA_ADDRESS:
+            return board.crypto
+        if self._address == EEPROM_ADDRESS:
+            return board.eeprom
+        return None
+
+    def write(self, out: "bytes|bytearray|list[int]", relax: bool = True, start: bool = True):
+        # an int is treated like pyftdi would, as an empty write
+        packet = bytes(out) if not isinstance(out, int) else bytes()
+
+        board = self._provisioner.board
+        if self._address == GENERAL_CALL_ADDRESS:
+            # a zero byte holds SDA low long enough to wake the ATSHA204A, nothing ACKs it
+            if board is not None and board.powered() and (len(packet) == 0 or packet[0] == 0x00):
+                board.crypto.wake()
+            raise pyftdi.i2c.I2cNackError("general call NACK")
+
+        device = self._device()
+        if device is None:
+            raise pyftdi.i2c.I2cNackError("no device at 0x{:02x}".format(self._address))
+
+        if board is not None and device is board.crypto and len(packet) == 0:
+            # empty address only write, long enough low time to count as a wake pulse
+            device.wake()
+            return
+
+        device.write(packet)
+
+    def read(self, readlen: int = 0, relax: bool = True, start: bool = True) -> bytes:
+        device = self._device()
+        if device is None:
+            raise pyftdi.i2c.I2cNackError("no device at 0x{:02x}".format(self._address))
+        return device.read(readlen)
+
+    def exchange(self, out: "bytes|bytearray|list[int]" = b'', readlen: int = 0,
+                 relax: bool = True, start: bool = True) -> bytes:
+        self.write(out)
+        return self.read(readlen)
+
+    def poll(self, write: bool = False, relax: bool = True, start: bool = True) -> bool:
+        # a real poll waits on a USB round trip, yield so other fixture threads run meanwhile
+        time.sleep(0)
+        device = self._device()
+        return device is not None and device.acknowledges()
+
+
+class emulated_provisioner:
+    """
+    Stand-in for provisioner.provisioner that provides emulated hexpansions,
+    a fresh board is inserted for each of the requested number of boards
+    """
+
+    slots: "list[emulated_board|None]"  # the board in each slot, one slot unless behind a mux
+    mux: "tca9548a_emulator|None"
+    boards_remaining: "int|None"
+    eeprom_write_cycle: float
+    power_up_delay: float
+    crypto_options: dict
+    detector: provisioner.board_detector
+
+    gpio_direction: int
+    gpio_output: int
+    gpio_writes: int  # port writes a real provisioner would have made
+
+    def __init__(self, boards: "int|None" = 1, eeprom_write_cycle: float = EEPROM_WRITE_CYCLE,
+                 power_up_delay: float = POWER_UP_DELAY, poll_interval: float = 0.0, debounce: float = 0.0,
+                 channels: "int|None" = None, **crypto_options):
+        """
+        boards is the number of boards to provision (None for unlimited), crypto_options go to each chip,
+        the emulated detect pin does not bounce so detection does not wait by default
+        channels puts that many slots behind an emulated TCA9548A, see mux_channels
+        """
+        self.url = "emulated"
+        self.mux = None if channels is None else tca9548a_emulator()
+        self.slots = [None] * (channels or 1)
+        self._slots_lock = threading.Lock()
+        self.boards_remaining = boards
+        self.eeprom_write_cycle = eeprom_write_cycle
+        self.power_up_delay = power_up_delay
+        self.crypto_options = crypto_options
+        self.detector = provisioner.board_detector(self.get_board_detect, poll_interval, debounce)
+
+        self.gpio_direction = 0
+        self.gpio_output = 0
+        self.gpio_writes = 0
+        self._gpio_written = (0, 0)
+
+        self.set_gpio_modes({
+            provisioner.provisioner_pinmap.STATUS_LED: True,
+            provisioner.provisioner_pinmap.HEXPANSION_DETECT: False})
+        self.set_gpio_pin(provisioner.provisioner_pinmap.STATUS_LED, False)
+
+        if channels is None:
+            self.insert_board()
+
+    @property
+    def board(self) -> "emulated_board|None":
+        """The board on the bus, behind a mux the one in the selected slot"""
+        if self.mux is None:
+            return self.slots[0]
+
+        selected = [board for channel, board in enumerate(self.slots)
+                    if self.mux.selection & (1 << channel) and board is not None]
+        return selected[0] if len(selected) == 1 else None
+
+    def insert_board(self, board: "emulated_board|None" = None, channel: int = 0):
+        """Inserts a board in a slot, a new factory fresh one by default"""
+        with self._slots_lock:
+            if board is None:
+                if self.boards_remaining is not None:
+                    if self.boards_remaining == 0:
+                        self.slots[channel] = None
+                        return
+                    self.boards_remaining -= 1
+                board = emulated_board(
+                    atsha204A_emulator(**self.crypto_options),
+                    zd24c64a_emulator(self._eeprom_write_protected, self.eeprom_write_cycle))
+            board.ready_at = time.monotonic() + self.power_up_delay
+            self.slots[channel] = board
+
+    def remove_board(self, channel: int = 0) -> "emulated_board|None":
+        with self._slots_lock:
+            board = self.slots[channel]
+            self.slots[channel] = None
+            return board
+
+    def mux_channels(self) -> "list[emulated_mux_channel]":
+        """The slots behind the emulated multiplexer, each used like a provisioner"""
+        fixture = tca9548a.mux_fixture(self, len(self.slots), poll_interval=self.detector.poll_interval,
+                                       debounce=self.detector.debounce, channel_class=emulated_mux_channel)
+        return fixture.channels
+
+    def _eeprom_write_protected(self) -> bool:
+        # WP is pulled up on the hexpansion unless driven low
+        pin = provisioner.provisioner_pinmap.HEXPANSION_LS2.value
+        return not (self.gpio_direction & pin) or bool(self.gpio_output & pin)
+
+    def getInfo(self):
+        print("emulated provisioner")
+
+    def get_i2c_port(self, address: int, shift=False) -> emulated_i2c_port:
+        if shift:
+            return emulated_i2c_port(self, address >> 1)
+        else:
+            return emulated_i2c_port(self, address)
+
+    def resync(self):
+        # the emulated port only changes through the shadows
+        pass
+
+    def set_gpio_mode(self, pin: provisioner.provisioner_pinmap, output: bool):
+        self.set_gpio_modes({pin: output})
+
+    def set_gpio_modes(self, modes: "dict[provisioner.provisioner_pinmap, bool]"):
+        for pin, output in modes.items():
+            if output:
+                self.gpio_direction |= pin.value
+            else:
+                self.gpio_direction &= ~(pin.value)
+
+    def set_gpio_pin(self, pin: provisioner.provisioner_pinmap, state: bool):
+        self.set_gpio_pins({pin: state})
+
+    def set_gpio_pins(self, states: "dict[provisioner.provisioner_pinmap, bool]"):
+        """Sets several outputs, counting the port writes the real provisioner would make"""
+        for pin, state in states.items():
+            if state:
+                self.gpio_output |= pin.value
+            else:
+                self.gpio_output &= ~(pin.value)
+
+        written = (self.gpio_output & self.gpio_direction, self.gpio_direction)
+        if written != self._gpio_written:
+            self.gpio_writes += 1
+            self._gpio_written = written
+
+    def get_gpio_pin(self, pin: provisioner.provisioner_pinmap):
+        if pin == provisioner.provisioner_pinmap.HEXPANSION_DETECT:
+            return any(board is not None for board in self.slots)
+        return (self.gpio_output & self.gpio_direction & pin.value) > 0
+
+    def wait_for_detect(self, timeout: "float|None" = None) -> bool:
+        """Inserts the next board, returns False once all the boards have been used"""
+        if self.slots[0] is None:
+            self.insert_board()
+        if self.slots[0] is None:
+            return False
+        return self.detector.wait(True, timeout)
+
+    def wait_for_no_detect(self, timeout: "float|None" = None) -> bool:
+        # the operator swaps in the next board straight away
+        self.remove_board()
+        return self.detector.wait(False, timeout)
+
+    def set_status_led(self, status: bool):
+        self.set_gpio_pin(provisioner.provisioner_pinmap.STATUS_LED, status)
+
+    def get_board_detect(self):
+        return self.get_gpio_pin(provisioner.provisioner_pinmap.HEXPANSION_DETECT)
+
+
+class emulated_mux_channel(tca9548a.mux_channel):
+    """A slot behind the emulated multiplexer, the operator refills it as soon as its board is taken out"""
+
+    def wait_for_detect(self, timeout: "float|None" = None) -> bool:
+        device = self.fixture.device
+        if device.slots[self.channel] is None:
+            device.insert_board(channel=self.channel)
+        if device.slots[self.channel] is None:
+            return False
+        return self.detector.wait(True, timeout)
+
+    def wait_for_no_detect(self, timeout: "float|None" = None) -> bool:
+        self.fixture.device.remove_board(self.channel)
+        return self.detector.wait(False, timeout)
+
+
+# Provisions and checks emulated boards end to end with random keys if run on its own
+if __name__ == "__main__":
+    import sys
+    import questMarker
+
+    board_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+
+    keys = {slot: os.urandom(32) for slot in range(16)}
+
+    device = emulated_provisioner(boards=board_count)
+    quest_marker = questMarker.quest_marker(device)
+
+    start = time.monotonic()
+    for serial in range(board_count):
+        device.wait_for_detect()
+        board_start = time.monotonic()
+        quest_marker.wait_until_ready()
+
+        quest_marker.provision(keys, serial)
+        checks = quest_marker.check_config(keys)
+
+        print("{:04X} {} in {:.2f}s".format(serial, "passed" if checks else "FAILED", time.monotonic() - board_start))
+
+        device.wait_for_no_detect()
+        quest_marker.board_removed()
+
+    print("{} boards in {:.2f}s".format(board_count, time.monotonic() - start))
@@ -0,0 +1,194 @@
+import concurrent.futures
+import enum
+import os
+import threading
+import time
+
+
+class serial_allocator:
+    """
+    Hands out board serials to several fixtures at once, a serial that was not used
+    (e.g. the board was resumed with the serial already in its OTP) is given back with release
+    and handed out again before any new one
+    """
+
+    next_serial: int
+
+    def __init__(self, first_serial: int):
+        self.next_serial = first_serial
+        self._released = list()
+        self._lock = threading.Lock()
+
+    def allocate(self) -> int:
+        with self._lock:
+            if self._released:
+                return self._released.pop(0)
+            serial = self.next_serial
+            self.next_serial += 1
+            return serial
+
+    def release(self, serial: int):
+        with self._lock:
+            self._released.append(serial)
+            self._released.sort()
+
+
+class fixture_log:
+    """Prints messages prefixed with the fixture name and appends them to the fixture's log file"""
+
+    name: str
+    path: "str|None"
+
+    _print_lock = threading.Lock()  # keeps lines from different fixtures whole
+
+    def __init__(self, name: str, log_dir: "str|None" = None):
+        self.name = name
+        self.path = None
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
+            self.path = os.path.join(log_dir, "{}.log".format(name))
+
+    def __call__(self, message: str):
+        with self._print_lock:
+            for line in str(message).splitlines() or [""]:
+                print("[{}] {}".format(self.name, line))
+
+        if self.path is not None:
+            with open(self.path, "a") as log:
+                log.write("{} {}\n".format(time.strftime("%Y-%m-%d %H:%M:%S"), message))
+
+
+class fixture:
+    """A provisioner and the thread driving it"""
+
+    name: str
+    device: object  # provisioner.provisioner or emulator.emulated_provisioner
+    log: fixture_log
+    error: "Exception|None"  # what stopped the worker, None if it finished normally
+
+    def __init__(self, name: str, device, log: fixture_log):
+        self.name = name
+        self.device = device
+        self.log = log
+        self.error = None
+        self._thread = None
+
+    def start(self, worker: "callable"):
+        """Runs worker(fixture) on its own thread"""
+        self._thread = threading.Thread(target=self._run, args=(worker,), name=self.name, daemon=True)
+        self._thread.start()
+
+    def _run(self, worker: "callable"):
+        try:
+            worker(self)
+        except Exception as e:
+            self.error = e
+            self.log("fixture stopped: {}".format(e))
+
+    def join(self, timeout: "float|None" = None):
+        self._thread.join(timeout)
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+
+class board_stage(enum.Enum):
+    """
+    The stages a board goes through on a fixture in order, the host stages run
+    alongside the hardware stages of the boards either side of it
+    """
+    PREPARE = "prepare"  # host, serial, EEPROM image and OTP data, while the board before is in the fixture
+    READY = "ready"
+    PROVISION = "provision"
+    READ_SERIAL = "read serial"
+    CHECK = "check"  # the last hardware stage, the board can be taken out after it
+    REGISTER = "register"  # host, ledger and API, while the board after is in the fixture
+
+
+def run_stage(stage: board_stage, stage_timings: "dict[str, float]", action: "callable", *args):
+    """Runs action(*args) as stage, adds the seconds it took to stage_timings and returns its result"""
+    start = time.monotonic()
+    try:
+        return action(*args)
+    finally:
+        stage_timings[stage.value] = time.monotonic() - start
+
+
+class board_pipeline:
+    """
+    Takes the host stages of a fixture off it, the next board is prepared and the last one
+    registered on their own threads while the board in the fixture has its hardware stages,
+    so a board only holds the fixture for as long as the hardware needs it
+    """
+
+    allocator: serial_allocator
+    prepare: "callable"  # prepare(serial), the host side data for provisioning serial
+    log: "callable"
+
+    def __init__(self, allocator: serial_allocator, prepare: "callable", log: "callable" = print,
+                 name: str = "fixture"):
+        self.allocator = allocator
+        self.prepare = prepare
+        self.log = log
+
+        # one thread each, boards are prepared and registered in the order they reach the fixture
+        self._host = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix=name + " prepare")
+        self._post = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix=name + " register")
+        self._next = None  # (serial, future of (prepared, seconds)) for the next board
+
+    def _prepare(self, serial: int) -> "tuple[object, float]":
+        start = time.monotonic()
+        return (self.prepare(serial), time.monotonic() - start)
+
+    def prefetch(self):
+        """Allocates the serial for the next board and starts preparing it, if that is not under way already"""
+        if self._next is None:
+            serial = self.allocator.allocate()
+            self._next = (serial, self._host.submit(self._prepare, serial))
+
+    def take(self) -> "tuple[int, object|None, float]":
+        """
+        The serial for the board now in the fixture, its prepared data and the seconds preparing took,
+        waits if it is still being prepared, the data is None if preparing failed
+        """
+        self.prefetch()
+        serial, future = self._next
+        self._next = None
+        try:
+            prepared, seconds = future.result()
+        except Exception as e:
+            # provisioning works it out again on the fixture and reports it there if it fails again
+            self.log("preparing {:04X} failed: {}".format(serial, e))
+            return (serial, None, 0.0)
+        return (serial, prepared, seconds)
+
+    def _run_post(self, action: "callable", args):
+        try:
+            action(*args)
+        except Exception as e:
+            self.log("{} failed: {}".format(board_stage.REGISTER.value, e))
+
+    def post(self, action: "callable", *args):
+        """Runs action(*args) after the board has been released, failures are logged"""
+        self._post.submit(self._run_post, action, args)
+
+    def close(self):
+        """Waits for the registrations still queued and gives back the serial of a board that never came"""
+        if self._next is not None:
+            serial, future = self._next
+            self._next = None
+            future.cancel()
+            self.allocator.release(serial)
+        self._host.shutdown(wait=True)
+        self._post.shutdown(wait=True)
+
+
+def run_fixtures(fixtures: "list[fixture]", worker: "callable"):
+    """Runs worker(fixture) for every fixture side by side and waits for them all to finish"""
+    for item in fixtures:
+        item.start(worker)
+
+    # join with a timeout so ctrl-c still reaches the main thread
+    while any(item.is_alive() for item in fixtures):
+        for item in fixtures:
+            item.join(0.2)
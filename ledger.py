@@ -0,0 +1,265 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+LEDGER_PATH = os.environ.get("PROVISION_LEDGER", "provision.sqlite")
+
+COMMIT_BATCH = 16  # records held before a commit
+COMMIT_INTERVAL = 1.0  # longest a record waits for its commit in seconds
+
+LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"  # provision.log timestamps
+
+
+def atsha_key(atsha_serial: "bytes|bytearray|str") -> str:
+    """The ledger key for an ATSHA204A serial, lower case hex without separators"""
+    if isinstance(atsha_serial, str):
+        return bytes.fromhex(atsha_serial).hex()
+    return bytes(atsha_serial).hex()
+
+
+def parse_log_line(line: str) -> "tuple[int, str, float]":
+    """Parses a provision.log line, board serial,ATSHA serial hex,timestamp"""
+    board_serial, atsha_serial, timestamp = line.strip().split(",")
+    return (int(board_serial, 16), atsha_key(atsha_serial),
+            time.mktime(time.strptime(timestamp, LOG_TIME_FORMAT)))
+
+
+class ledger:
+    """
+    Record of every provisioned board in SQLite (WAL, so lookups run while the line writes),
+    keyed by ATSHA204A serial with an index on the board serial so lookups and duplicate checks
+    stay quick however many boards there are, records are committed in batches, at the latest
+    COMMIT_INTERVAL after they were made, and fixtures share one ledger from their threads
+    """
+
+    path: str
+    commit_batch: int
+    commit_interval: float
+
+    def __init__(self, path: str = LEDGER_PATH, commit_batch: int = COMMIT_BATCH,
+                 commit_interval: float = COMMIT_INTERVAL):
+        self.path = path
+        self.commit_batch = commit_batch
+        self.commit_interval = commit_interval
+
+        self._lock = threading.RLock()
+        self._uncommitted = 0
+        self._commit_timer = None
+
+        # other stations or a lookup may hold the database briefly, wait for them rather than fail
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS boards (
+                    atsha_serial TEXT NOT NULL,
+                    board_serial INTEGER NOT NULL,
+                    fixture TEXT,
+                    provisioned REAL NOT NULL,
+                    stage_timings TEXT,
+                    checks_passed INTEGER,
+                    check_failures TEXT,
+                    submission TEXT,
+                    source TEXT NOT NULL
+                )""")
+            self._db.execute("CREATE UNIQUE INDEX IF NOT EXISTS boards_atsha_serial ON boards (atsha_serial)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS boards_board_serial ON boards (board_serial)")
+
+    def _changed(self):
+        # call with the lock held after a write
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_batch:
+            self.commit()
+        elif self._commit_timer is None:
+            self._commit_timer = threading.Timer(self.commit_interval, self.commit)
+            self._commit_timer.daemon = True
+            self._commit_timer.start()
+
+    def commit(self):
+        """Commits every record made so far"""
+        with self._lock:
+            if self._commit_timer is not None:
+                self._commit_timer.cancel()
+                self._commit_timer = None
+            if self._uncommitted:
+                self._db.commit()
+                self._uncommitted = 0
+
+    def record(self, board_serial: int, atsha_serial: "bytes|bytearray|str", fixture: "str|None" = None,
+               stage_timings: "dict[str, float]|None" = None, submission: "str|None" = None) -> "list[str]":
+        """
+        Records a provisioned board, a board already in the ledger (e.g. resumed) is updated
+        returns the ATSHA serials of any other boards that have the same board serial
+        """
+        key = atsha_key(atsha_serial)
+        with self._lock:
+            self._db.execute("""
+                INSERT INTO boards (atsha_serial, board_serial, fixture, provisioned, stage_timings, submission, source)
+                VALUES (?, ?, ?, ?, ?, ?, 'line')
+                ON CONFLICT (atsha_serial) DO UPDATE SET
+                    board_serial = excluded.board_serial,
+                    fixture = excluded.fixture,
+                    provisioned = excluded.provisioned,
+                    stage_timings = COALESCE(excluded.stage_timings, stage_timings),
+                    submission = COALESCE(excluded.submission, submission),
+                    source = 'line'
+                """, (key, board_serial, fixture, time.time(),
+                      None if stage_timings is None else json.dumps(stage_timings), submission))
+            self._changed()
+
+            return [row["atsha_serial"] for row in self.find_board(board_serial) if row["atsha_serial"] != key]
+
+    def set_checks(self, atsha_serial: "bytes|bytearray|str", passed: bool, failures: "list[str]|None" = None,
+                   stage_timings: "dict[str, float]|None" = None):
+        """Records the check_config result for a board, stage_timings are added to those already recorded"""
+        key = atsha_key(atsha_serial)
+        with self._lock:
+            if stage_timings:
+                row = self.find_atsha(key)
+                if row is not None and row["stage_timings"]:
+                    stage_timings = dict(json.loads(row["stage_timings"]), **stage_timings)
+
+            self._db.execute(
+                "UPDATE boards SET checks_passed = ?, check_failures = ?,"
+                " stage_timings = COALESCE(?, stage_timings) WHERE atsha_serial = ?",
+                (int(passed), json.dumps(failures or []),
+                 json.dumps(stage_timings) if stage_timings else None, key))
+            self._changed()
+
+    def set_submission(self, atsha_serial: "bytes|bytearray|str", state: str, only_unset: bool = False):
+        """
+        Records where the API registration of a board has got to,
+        only_unset leaves a board that already has a registration state as it is
+        """
+        query = "UPDATE boards SET submission = ? WHERE atsha_serial = ?"
+        if only_unset:
+            query += " AND submission IS NULL"
+        with self._lock:
+            self._db.execute(query, (state, atsha_key(atsha_serial)))
+            self._changed()
+
+    def find_atsha(self, atsha_serial: "bytes|bytearray|str") -> "sqlite3.Row|None":
+        with self._lock:
+            return self._db.execute(
+                "SELECT * FROM boards WHERE atsha_serial = ?", (atsha_key(atsha_serial),)).fetchone()
+
+    def find_board(self, board_serial: int) -> "list[sqlite3.Row]":
+        with self._lock:
+            return self._db.execute(
+                "SELECT * FROM boards WHERE board_serial = ? ORDER BY provisioned", (board_serial,)).fetchall()
+
+    def highest_board_serial(self, low: int, high: int) -> "int|None":
+        """The highest board serial in the ledger from low up to (not including) high, None if there are none"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT MAX(board_serial) FROM boards WHERE board_serial >= ? AND board_serial < ?",
+                (low, high)).fetchone()[0]
+
+    def duplicates(self) -> "list[tuple[int, int]]":
+        """(board serial, count) for each board serial given to more than one chip"""
+        with self._lock:
+            return [tuple(row) for row in self._db.execute(
+                "SELECT board_serial, COUNT(*) FROM boards GROUP BY board_serial HAVING COUNT(*) > 1"
+                " ORDER BY board_serial").fetchall()]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM boards").fetchone()[0]
+
+    def import_log(self, path: str) -> "tuple[int, int, list[int]]":
+        """
+        Imports a provision.log, boards already in the ledger are left as they are
+        returns (imported, already present, line numbers that could not be parsed)
+        """
+        imported = 0
+        present = 0
+        bad_lines = list()
+
+        with self._lock:
+            self.commit()
+            with open(path) as log, self._db:
+                for number, line in enumerate(log, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        board_serial, key, provisioned = parse_log_line(line)
+                    except ValueError:
+                        bad_lines.append(number)
+                        continue
+
+                    cursor = self._db.execute(
+                        "INSERT OR IGNORE INTO boards (atsha_serial, board_serial, provisioned, source)"
+                        " VALUES (?, ?, ?, ?)", (key, board_serial, provisioned, "import " + os.path.basename(path)))
+                    if cursor.rowcount:
+                        imported += 1
+                    else:
+                        present += 1
+
+        return (imported, present, bad_lines)
+
+    def close(self):
+        self.commit()
+        with self._lock:
+            self._db.close()
+
+
+def describe_timings(stage_timings: "dict[str, object]") -> str:
+    """Formats stage timings, a stage holding its own sub-stage timings is shown as a bracketed group"""
+    return ", ".join(
+        "{} ({})".format(stage, describe_timings(seconds)) if isinstance(seconds, dict)
+        else "{} {:.2f}s".format(stage, seconds)
+        for stage, seconds in stage_timings.items())
+
+
+def describe(row: sqlite3.Row) -> str:
+    """A printable summary of a ledger record"""
+    checks = {None: "not checked", 0: "checks FAILED", 1: "checks passed"}[row["checks_passed"]]
+    lines = ["{:04X} ATSHA {} provisioned {} on {} ({}), {}, registration {}".format(
+        row["board_serial"], row["atsha_serial"], time.strftime(LOG_TIME_FORMAT, time.localtime(row["provisioned"])),
+        row["fixture"] or "unknown fixture", row["source"], checks, row["submission"] or "not queued")]
+    if row["stage_timings"]:
+        lines.append("  " + describe_timings(json.loads(row["stage_timings"])))
+    for failure in json.loads(row["check_failures"] or "[]"):
+        lines.append("  " + failure)
+    return "\n".join(lines)
+
+
+# Times inserts and lookups on a ledger of many boards if run on its own
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    board_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    with tempfile.TemporaryDirectory() as directory:
+        book = ledger(os.path.join(directory, "ledger.sqlite"))
+
+        start = time.monotonic()
+        for serial in range(board_count):
+            book.record(serial, serial.to_bytes(9, 'little'), "fixture{}".format(serial % 3), {"provision": 1.6})
+        book.commit()
+        print("{} records in {:.2f}s".format(book.count(), time.monotonic() - start))
+
+        start = time.monotonic()
+        for serial in range(0, board_count, 7):
+            assert book.find_atsha(serial.to_bytes(9, 'little'))["board_serial"] == serial
+            assert len(book.find_board(serial)) == 1
+        lookups = len(range(0, board_count, 7)) * 2
+        print("{} lookups, {:.1f}us each".format(lookups, (time.monotonic() - start) / lookups * 1e6))
+
+        assert book.record(5, bytes(8) + b'\xff') == [(5).to_bytes(9, 'little').hex()]
+        print("duplicates", book.duplicates())
+
+        log_path = os.path.join(directory, "provision.log")
+        with open(log_path, "w") as log:
+            log.write("0005,05 00 00 00 00 00 00 00 00,2024-05-01 12:00:00\n")
+            log.write("BEEF,01 23 45 67 89 ab cd ef ee,2024-05-01 12:00:01\n")
+            log.write("not a record\n")
+        print("import (imported, present, bad lines)", book.import_log(log_path))
+        print(describe(book.find_board(0xBEEF)[0]))
+        book.close()
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import eeprom
+
+
+# the superblock of the shipped image records disk version 2.1
+LITTLEFS_DISK_VERSION = 0x00020001
+LITTLEFS_NAME_MAX = 255
+LITTLEFS_PROG_SIZE = eeprom.FS_PAGE_SZE  # one EEPROM page
+LITTLEFS_AREA = eeprom.LITTLEFS_BLOCK_SIZE * eeprom.LITTLEFS_BLOCK_COUNT  # the rest of FS_SIZE stays erased
+ERASED = 0xFF
+
+BOARD_METADATA_PATH = "hexpansion.json"
+
+# built images are kept here by the content hash of their inputs
+BUILD_CACHE_DIR = os.environ.get(
+    "LITTLEFS_BUILD_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".littlefs_cache"))
+
+
+def _import_littlefs():
+    # optional dependency, only needed when building images rather than using a hex dump
+    try:
+        import littlefs
+    except ImportError:
+        raise ImportError(
+            "building filesystem images needs littlefs-python, install it with 'pip install littlefs-python'"
+        ) from None
+    return littlefs
+
+
+def collect_files(source_dir: str) -> "dict[str, bytes]":
+    """Reads every file under source_dir, keyed by its path relative to source_dir using / separators"""
+    files = dict()
+    for root, dirs, names in os.walk(source_dir):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, source_dir).replace(os.sep, "/")
+            with open(path, "rb") as file:
+                files[relative] = file.read()
+    return files
+
+
+def tree_stamp(source_dir: str) -> "tuple[tuple[str, int, int], ...]":
+    """
+    The path, mtime and size of every file and directory under source_dir, cheap to take
+    and changes whenever a file is edited, added or removed
+    """
+    stamp = list()
+    for root, dirs, names in os.walk(source_dir):
+        dirs.sort()
+        for name in [""] + sorted(names):
+            stat = os.stat(os.path.join(root, name))
+            stamp.append((os.path.join(root, name), stat.st_mtime_ns, stat.st_size))
+    return tuple(stamp)
+
+
+def content_hash(files: "dict[str, bytes]") -> str:
+    """Hashes the files and the filesystem geometry, equal hashes build identical images"""
+    digest = hashlib.sha256()
+    digest.update("{} {} {} {} {}".format(
+        eeprom.LITTLEFS_BLOCK_SIZE, eeprom.LITTLEFS_BLOCK_COUNT, LITTLEFS_DISK_VERSION,
+        LITTLEFS_NAME_MAX, LITTLEFS_PROG_SIZE).encode())
+    for path in sorted(files):
+        data = files[path]
+        digest.update(path.encode() + b"\0" + len(data).to_bytes(4, 'little'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def board_files(serial: int) -> "dict[str, bytes]":
+    """Per board files, a metadata file stamped with the board serial"""
+    metadata = {"serial": "{:04X}".format(serial), "vid": eeprom.VID, "pid": eeprom.PID}
+    return {BOARD_METADATA_PATH: json.dumps(metadata).encode()}
+
+
+def _open_filesystem(buffer: bytearray, format: bool):
+    littlefs = _import_littlefs()
+
+    filesystem = littlefs.LittleFS(
+        littlefs.UserContext(buffer=buffer),
+        mount=False,
+        block_size=eeprom.LITTLEFS_BLOCK_SIZE,
+        block_count=eeprom.LITTLEFS_BLOCK_COUNT,
+        read_size=LITTLEFS_PROG_SIZE,
+        prog_size=LITTLEFS_PROG_SIZE,
+        name_max=LITTLEFS_NAME_MAX,
+        disk_version=LITTLEFS_DISK_VERSION)
+    if format:
+        filesystem.format()
+    filesystem.mount()
+    return filesystem
+
+
+def _add_files(filesystem, files: "dict[str, bytes]"):
+    for path in sorted(files):
+        directory = os.path.dirname(path)
+        if directory:
+            filesystem.makedirs(directory, exist_ok=True)
+        with filesystem.open(path, "wb") as file:
+            file.write(files[path])
+
+
+def build_image(files: "dict[str, bytes]") -> bytes:
+    """Builds a filesystem image holding files, padded with erased bytes to the EEPROM filesystem size"""
+    buffer = bytearray([ERASED] * LITTLEFS_AREA)
+
+    filesystem = _open_filesystem(buffer, format=True)
+    _add_files(filesystem, files)
+    filesystem.unmount()
+
+    image = bytes(buffer) + bytes([ERASED] * (eeprom.FS_SIZE - len(buffer)))
+    eeprom.validate_littlefs_image(image)
+    return image
+
+
+def write_hex_dump(path: str, image: "bytes|bytearray|memoryview"):
+    """Writes an image in the hex dump format of littlefs_blob"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as dump:
+        dump.write(bytes(image).hex(" "))
+    os.replace(temp_path, path)
+
+
+class littlefs_builder:
+    """
+    Builds the filesystem image from a directory of files, builds are cached by a hash of the
+    inputs so an unchanged directory is only built once, per board files are added on top of
+    the cached base image
+    """
+
+    source_dir: str
+    cache_dir: "str|None"
+
+    _base: "tuple[str, bytes]|None"  # (content hash, image) of the last base build
+    _base_stamp: "tuple|None"  # tree_stamp of the source directory when _base was built
+
+    def __init__(self, source_dir: str, cache_dir: "str|None" = BUILD_CACHE_DIR):
+        """cache_dir None keeps builds in memory only"""
+        if not os.path.isdir(source_dir):
+            raise ValueError("{} is not a directory".format(source_dir))
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self._base = None
+        self._base_stamp = None
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".bin")
+
+    def _load_cached(self, key: str) -> "bytes|None":
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._cache_path(key), "rb") as cached:
+                image = cached.read()
+            eeprom.validate_littlefs_image(image)
+            return image
+        except (OSError, ValueError):
+            return None
+
+    def _store_cached(self, key: str, image: bytes):
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = self._cache_path(key) + ".tmp"
+            with open(temp_path, "wb") as cached:
+                cached.write(image)
+            os.replace(temp_path, self._cache_path(key))
+        except OSError:
+            # an unwritable cache only costs a rebuild next time
+            pass
+
+    def build(self) -> bytes:
+        """Builds the image for the source directory, reusing a cached build when the contents are unchanged"""
+        # stamped before reading, so a file changed while it is read is seen by the next build_board
+        stamp = tree_stamp(self.source_dir)
+        files = collect_files(self.source_dir)
+        key = content_hash(files)
+
+        if self._base is not None and self._base[0] == key:
+            self._base_stamp = stamp
+            return self._base[1]
+
+        image = self._load_cached(key)
+        if image is None:
+            image = build_image(files)
+            self._store_cached(key, image)
+
+        self._base = (key, image)
+        self._base_stamp = stamp
+        return image
+
+    def build_board(self, serial: int, files: "dict[str, bytes]|None" = None) -> bytes:
+        """
+        Builds the image for one board, the base image with board_files (or files) added,
+        the base is only rebuilt when a file in the source directory has changed
+        """
+        if files is None:
+            files = board_files(serial)
+
+        if self._base is None or tree_stamp(self.source_dir) != self._base_stamp:
+            self.build()
+        base = self._base[1]
+        buffer = bytearray(base[:LITTLEFS_AREA])
+
+        filesystem = _open_filesystem(buffer, format=False)
+        _add_files(filesystem, files)
+        filesystem.unmount()
+
+        return bytes(buffer) + base[LITTLEFS_AREA:]
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import time
+
+    # rebuild the shipped image contents and time a cold, cached and per board build
+    source = eeprom.get_littlefs_image()
+    filesystem = _open_filesystem(bytearray(source[:LITTLEFS_AREA]), format=False)
+
+    with tempfile.TemporaryDirectory() as source_dir:
+        for root, dirs, names in filesystem.walk("/"):
+            for name in names:
+                path = os.path.join(root, name).lstrip("/")
+                os.makedirs(os.path.join(source_dir, os.path.dirname(path)), exist_ok=True)
+                with filesystem.open(path, "rb") as file, open(os.path.join(source_dir, path), "wb") as out:
+                    out.write(file.read())
+
+        builder = littlefs_builder(source_dir, cache_dir=sys.argv[1] if len(sys.argv) > 1 else None)
+        for name, build in (("cold", builder.build), ("cached", builder.build),
+                            ("board", lambda: builder.build_board(0x1233)),
+                            ("next board", lambda: builder.build_board(0x1234))):
+            start = time.monotonic()
+            image = build()
+            print("{} build {:.1f}ms".format(name, (time.monotonic() - start) * 1000))
+
+        board = _open_filesystem(bytearray(image[:LITTLEFS_AREA]), format=False)
+        print(sorted(board.listdir("/")))
+        with board.open(BOARD_METADATA_PATH, "r") as file:
+            print(file.read())
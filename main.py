@@ -1,29 +1,142 @@
 import click
+import eeprom
+import emulator
+import fixtures
 import json
+import ledger
+import littlefs_builder
+import outbox
 import provisioner
 import questMarker
+import serial_journal
 import server_validator
+import tca9548a
 import time
 import utils
+import zd24c64a
 from utils import hexString
 
 
+# commands that never touch the keys, so they run without a secrets file
+PROVISION_STAGES = "provision stages"  # stage_timings key of the provision sub-stage timings
+KEYLESS_COMMANDS = ("compile-images", "build-littlefs", "outbox", "ledger")
+
+
+def load_keys(secrets: str) -> "dict[int, bytearray]":
+    try:
+        with open(secrets) as file:
+            raw_keys = json.load(file)
+    except FileNotFoundError:
+        raise click.FileError(secrets, hint="secrets file not found")
+
+    keys = dict()
+    for id in raw_keys:
+        keys[bytearray.fromhex(id)[0]] = bytearray.fromhex(raw_keys[id])
+    return keys
+
+
 @click.group()
-@click.option('-s', '--secrets', type=click.Path(exists=True), default="secrets.json")
+@click.option('-s', '--secrets', type=click.Path(), default="secrets.json")
 @click.option('--api-key')
+@click.option('--api-server', default=utils.API_SERVER, show_default=True,
+              help="API host, or a base URL such as http://127.0.0.1:8000 for a local stand-in")
+@click.option('--outbox', 'outbox_path', type=click.Path(dir_okay=False), default=outbox.OUTBOX_PATH,
+              show_default=True, help="Queue of registrations waiting for the API")
+@click.option('--ledger', 'ledger_path', type=click.Path(dir_okay=False), default=ledger.LEDGER_PATH,
+              show_default=True, help="Record of every provisioned board")
+@click.option('--emulate', type=int, help="Use this many emulated boards instead of the FTDI provisioner")
+@click.option('--littlefs-image', type=click.Path(exists=True), help="Hex dump of the EEPROM filesystem image")
+@click.option('--littlefs-source', type=click.Path(exists=True, file_okay=False),
+              help="Build each board its own filesystem from this directory, with a serial stamped metadata file")
 @click.pass_context
-def cli(ctx, secrets, api_key):
+def cli(ctx, secrets, api_key, api_server, outbox_path, ledger_path, emulate, littlefs_image, littlefs_source):
 
     ctx.ensure_object(dict)
 
-    with open(secrets) as file:
-        raw_keys = json.load(file)
-        keys = dict()
-        for id in raw_keys:
-            keys[bytearray.fromhex(id)[0]] = bytearray.fromhex(raw_keys[id])
-
-    ctx.obj['keys'] = keys
+    if ctx.invoked_subcommand not in KEYLESS_COMMANDS:
+        ctx.obj['keys'] = load_keys(secrets)
     ctx.obj['api_key'] = api_key
+    ctx.obj['api_server'] = api_server
+    ctx.obj['outbox_path'] = outbox_path
+    ctx.obj['ledger_path'] = ledger_path
+    ctx.obj['emulate'] = emulate
+
+    if littlefs_image is not None:
+        eeprom.set_littlefs_image_path(littlefs_image)
+
+    ctx.obj['filesystem_builder'] = None
+    if littlefs_source is not None:
+        ctx.obj['filesystem_builder'] = littlefs_builder.littlefs_builder(littlefs_source)
+
+
+def open_provisioner(ctx) -> provisioner.provisioner:
+    """Connects to the provisioner, or creates an emulated one"""
+    if ctx.obj['emulate'] is not None:
+        return emulator.emulated_provisioner(boards=ctx.obj['emulate'])
+    return provisioner.provisioner()
+
+
+def open_ledger(ctx) -> ledger.ledger:
+    """Opens the ledger once per command, it is committed and closed when the command finishes"""
+    if ctx.obj.get('ledger') is None:
+        ctx.obj['ledger'] = ledger.ledger(ctx.obj['ledger_path'])
+        ctx.find_root().call_on_close(ctx.obj['ledger'].close)
+    return ctx.obj['ledger']
+
+
+def open_outbox(ctx) -> "outbox.outbox|None":
+    """Opens the registration outbox, None without an API key as there is nothing to register with"""
+    if ctx.obj['api_key'] is None:
+        return None
+
+    book = open_ledger(ctx)
+    return outbox.outbox(ctx.obj['outbox_path'], ctx.obj['api_server'], ctx.obj['api_key'],
+                         on_result=lambda atsha_serial, state: book.set_submission(atsha_serial, state.value))
+
+
+def register(ctx, board_serial: int, atsha_serial: bytes):
+    """Registers one board through the outbox and sends it straight away, it stays queued if that fails"""
+    box = open_outbox(ctx)
+    duplicates = utils.register_provision(
+        board_serial, atsha_serial, ctx.obj['api_key'], open_ledger(ctx), ctx.obj['api_server'], box)
+    for other in duplicates:
+        print("WARNING board serial {:04X} was also given to ATSHA {}".format(board_serial, other))
+    if box is not None:
+        box.flush()
+        box.close()
+
+
+def open_fixtures(ctx, count: int, log_dir: "str|None", mux_channels: "int|None" = None) -> "list[fixtures.fixture]":
+    """
+    Connects to count attached provisioners (all of them for 0), or creates emulated ones,
+    with mux_channels each provisioner's slots behind a TCA9548A are fixtures of their own
+    """
+    if ctx.obj['emulate'] is not None:
+        devices = [("emulated{}".format(x),
+                    emulator.emulated_provisioner(boards=ctx.obj['emulate'], channels=mux_channels))
+                   for x in range(max(count, 1))]
+    else:
+        urls = provisioner.list_provisioner_urls()
+        if count > len(urls):
+            raise click.ClickException("{} fixtures requested, {} attached".format(count, len(urls)))
+        if count == 1 and len(urls) == 1:
+            urls = [provisioner.DEFAULT_URL]
+        elif count:
+            urls = urls[:count]
+        # the URL ends in /1, the name is the serial number or bus and address before it
+        devices = [(url.split(':')[-1].split('/')[0], provisioner.provisioner(url)) for url in urls]
+
+    if mux_channels is not None:
+        channels = list()
+        for name, device in devices:
+            if isinstance(device, emulator.emulated_provisioner):
+                device_channels = device.mux_channels()
+            else:
+                device_channels = tca9548a.mux_fixture(device, mux_channels).channels
+            channels += [("{}ch{}".format(name, channel.channel), channel) for channel in device_channels]
+        devices = channels
+
+    return [fixtures.fixture(name, device, fixtures.fixture_log(name, log_dir)) for name, device in devices]
 
 
 @cli.command()
@@ -31,16 +144,13 @@ def cli(ctx, secrets, api_key):
 def crypto_config_test(ctx):
     """Performs checks on the config of the crypto IC"""
 
-    device = provisioner.provisioner()
+    device = open_provisioner(ctx)
     quest_marker = questMarker.quest_marker(device)
 
     # check OTP read
-    otp_data_low = utils.auto_retry(
-        quest_marker.crypto.command_read, 5,
-        questMarker.atsha204a.atasha204A_zone.OTP, 0, 0, False)
-    otp_data_high = utils.auto_retry(
-        quest_marker.crypto.command_read, 5,
-        questMarker.atsha204a.atasha204A_zone.OTP, 1, 0, False)
+    otp_data = quest_marker.crypto.read_otp()
+    otp_data_low = otp_data[0:32]
+    otp_data_high = otp_data[32:64]
 
     print("OTP low =", otp_data_low)
     print("OTP high =", otp_data_high)
@@ -148,7 +258,7 @@ def perform_challenge(ctx):
     Performs a test challenge against the chip
     and validates agaisnt the test server
     """
-    device = provisioner.provisioner()
+    device = open_provisioner(ctx)
     quest_marker = questMarker.quest_marker(device)
 
     badge_mac = [0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
@@ -182,7 +292,7 @@ def check_diversified_key(ctx):
     """
     Checks a diversified key in slot 0 is correct
     """
-    device = provisioner.provisioner()
+    device = open_provisioner(ctx)
     quest_marker = questMarker.quest_marker(device)
 
     div_key = quest_marker.crypto.generate_diversified_key(
@@ -201,8 +311,8 @@ def check_diversified_key(ctx):
 def provision_single_hexpansion(ctx, id: int):
     """provisions a single hexpansion"""
 
-    device = provisioner.provisioner()
-    quest_marker = questMarker.quest_marker(device)
+    device = open_provisioner(ctx)
+    quest_marker = questMarker.quest_marker(device, filesystem_builder=ctx.obj['filesystem_builder'])
 
     device.set_status_led(False)
 
@@ -210,58 +320,196 @@ def provision_single_hexpansion(ctx, id: int):
 
     print("provisioning as {:04X}".format(serial))
 
-    quest_marker.provision(ctx.obj['keys'], serial)
+    serial = quest_marker.provision(ctx.obj['keys'], serial)
 
-    print("provisioning complete")
+    print("provisioning complete ({:04X})".format(serial))
 
     atsha_serial = utils.auto_retry(quest_marker.crypto.get_serial_number, 5)
 
     device.set_status_led(True)
-    utils.register_provision(serial, atsha_serial, ctx.obj['api_key'])
+    register(ctx, serial, atsha_serial)
 
 
 @cli.command
-@click.argument("starting-id")
+@click.argument("starting-id", required=False)
+@click.option('--journal', type=click.Path(dir_okay=False), default=serial_journal.JOURNAL_PATH, show_default=True,
+              help="Journal of leased serials, share it between stations so they never hand out the same serial")
+@click.option('--image-batch', type=click.Path(exists=True), help="Precompiled EEPROM images from compile-images")
+@click.option('--fixtures', 'fixture_count', type=int, default=1, show_default=True,
+              help="Number of provisioners to drive at once, 0 for every attached one")
+@click.option('--log-dir', type=click.Path(file_okay=False), help="Write a log file per fixture here")
+@click.option('--mux-channels', type=click.IntRange(1, tca9548a.CHANNEL_COUNT),
+              help="Provision this many slots behind a TCA9548A on each provisioner side by side")
 @click.pass_context
-def provision_multiple_hexpansions(ctx, starting_id: str):
-    """provisions a set of hexpansions"""
+def provision_multiple_hexpansions(ctx, starting_id: "str|None", journal, image_batch, fixture_count: int, log_dir,
+                                   mux_channels):
+    """
+    provisions a set of hexpansions, serials carry on from the journal and the ledger
+    unless starting-id is given
+    """
 
-    device = provisioner.provisioner()
-    quest_marker = questMarker.quest_marker(device)
+    batch = None
+    if image_batch is not None:
+        batch = eeprom.image_batch(image_batch)
+        if not batch.is_current():
+            print("image batch was compiled from a different filesystem, compiling images per board")
+
+    book = open_ledger(ctx)
+    allocator = serial_journal.lease_allocator(
+        journal, None if starting_id is None else int(starting_id, 0), ledger=book)
+    print("first serial {:04X}".format(allocator.peek()))
+
+    box = open_outbox(ctx)
+    if box is not None:
+        box.start()
+
+    def prepare(serial: int) -> questMarker.prepared_board:
+        return questMarker.prepared_board(serial, batch, ctx.obj['filesystem_builder'])
+
+    def warn_duplicates(fixture: fixtures.fixture, board_serial: int, others: "list[str]"):
+        for other in others:
+            fixture.log("WARNING board serial {:04X} was also given to ATSHA {}".format(board_serial, other))
+
+    def register_board(fixture: fixtures.fixture, board_serial: int, atsha_serial, checks: bool,
+                       check_failures: "list[str]", stage_timings: "dict[str, object]", warned: "list[str]"):
+        register_timings = dict()
+        duplicates = fixtures.run_stage(
+            fixtures.board_stage.REGISTER, register_timings, utils.register_provision,
+            board_serial, atsha_serial, ctx.obj['api_key'], book, ctx.obj['api_server'], box,
+            fixture.name, stage_timings)
+        # boards recorded by another fixture since the check on this one
+        warn_duplicates(fixture, board_serial, [other for other in duplicates if other not in warned])
+
+        book.set_checks(atsha_serial, checks, check_failures, register_timings)
+
+    def provision_boards(fixture: fixtures.fixture):
+        device = fixture.device
+        log = fixture.log
+        quest_marker = questMarker.quest_marker(
+            device, image_batch=batch, filesystem_builder=ctx.obj['filesystem_builder'], log=log)
+        pipeline = fixtures.board_pipeline(allocator, prepare, log, fixture.name)
+        stage = fixtures.board_stage
 
-    serial = int(starting_id, 0)
+        try:
+            while True:
+
+                log("waiting for next board")
+
+                if not device.wait_for_detect():
+                    break
+
+                serial, prepared, prepare_time = pipeline.take()
+                # the next board is prepared while this one is provisioned
+                pipeline.prefetch()
+
+                board_serial = serial
+                atsha_serial = None
+                checks = None
+                check_failures = list()
+                warned = list()
+                stage_timings = {stage.PREPARE.value: prepare_time}
+                try:
+                    if not fixtures.run_stage(stage.READY, stage_timings, quest_marker.wait_until_ready):
+                        raise IOError("board did not answer after insertion")
+
+                    log("provisioning as {:04X}".format(serial))
+
+                    board_serial = fixtures.run_stage(
+                        stage.PROVISION, stage_timings, quest_marker.provision, ctx.obj['keys'], serial, prepared)
+                    # the provision sub-stages are kept apart from the pipeline stages
+                    stage_timings[PROVISION_STAGES] = dict(quest_marker.stage_timings)
+
+                    log("provisioning complete ({:04X})".format(board_serial))
+
+                    atsha_serial = fixtures.run_stage(
+                        stage.READ_SERIAL, stage_timings, utils.auto_retry, quest_marker.crypto.get_serial_number, 5)
+
+                    # an indexed lookup, so the warning comes while the board is still in the fixture
+                    key = ledger.atsha_key(atsha_serial)
+                    warned = [
+                        row["atsha_serial"] for row in book.find_board(board_serial) if row["atsha_serial"] != key]
+                    warn_duplicates(fixture, board_serial, warned)
+
+                    checks = fixtures.run_stage(stage.CHECK, stage_timings, quest_marker.check_config, ctx.obj['keys'])
+                    check_failures = list(quest_marker.check_failures)
+                    quest_marker.crypto.sendSleep()
+
+                    if checks:
+                        log("checks passed")
+                    else:
+                        log("Config checks failed ({:04X})".format(board_serial))
+
+                    device.set_status_led(True)
+                except Exception as e:
+                    log("FAILED TO PROVISION ({:04X})".format(board_serial))
+                    log(e)
+                    if checks is None:
+                        checks = False
+                        check_failures.append("checks did not complete: {}".format(e))
+
+                # a board that got as far as its ATSHA serial is recorded, while the next one is provisioned
+                if atsha_serial is not None:
+                    pipeline.post(register_board, fixture, board_serial, atsha_serial, checks,
+                                  check_failures, stage_timings, warned)
+
+                retry_summary = utils.RETRY_STATS.summary()
+                if retry_summary:
+                    log(retry_summary)
+                utils.RETRY_STATS.reset()
+
+                device.wait_for_no_detect()
+                quest_marker.board_removed()
+                device.set_status_led(False)
+
+                # a resumed board keeps the serial already in its OTP, the new one goes to the next board
+                if board_serial != serial:
+                    allocator.release(serial)
+        finally:
+            pipeline.close()
 
-    while True:
+    try:
+        fixtures.run_fixtures(open_fixtures(ctx, fixture_count, log_dir, mux_channels), provision_boards)
+    finally:
+        allocator.close()
+        if box is not None:
+            box.stop(timeout=outbox.REQUEST_TIMEOUT)
+            pending = box.status()["counts"][outbox.submission_state.PENDING.value]
+            if pending:
+                print("{} registrations still queued, send them with 'outbox flush'".format(pending))
+            box.close()
 
-        print("provisioning next as {:04X}".format(serial))
 
-        device.wait_for_detect()
-        time.sleep(0.5)
+@cli.command
+@click.argument("starting-id")
+@click.argument("count", type=int)
+@click.argument("output", type=click.Path())
+def compile_images(starting_id: str, count: int, output: str):
+    """precompiles the EEPROM images for a range of serials into a batch file"""
 
-        try:
-            quest_marker.provision(ctx.obj['keys'], serial)
+    first_serial = int(starting_id, 0)
 
-            print("provisioning complete ({:04X})".format(serial))
+    start = time.monotonic()
+    eeprom.compile_batch(output, first_serial, count)
 
-            atsha_serial = utils.auto_retry(quest_marker.crypto.get_serial_number, 5)
+    print("compiled {:04X}-{:04X} into {} in {:.2f}s".format(
+        first_serial, first_serial + count - 1, output, time.monotonic() - start))
 
-            utils.register_provision(serial, atsha_serial, ctx.obj['api_key'])
 
-            checks = quest_marker.check_config(ctx.obj['keys'])
+@cli.command
+@click.argument("source", type=click.Path(exists=True, file_okay=False))
+@click.option('-o', '--output', type=click.Path(), default=eeprom.LITTLEFS_IMAGE_PATH,
+              help="Hex dump to write, the default is the image used for provisioning")
+def build_littlefs(source: str, output: str):
+    """builds the EEPROM filesystem image from a directory of files"""
 
-            if checks:
-                print("checks passed")
-            else:
-                print("Config checks failed ({:04X})".format(serial))
+    builder = littlefs_builder.littlefs_builder(source)
 
-            device.set_status_led(True)
-        except Exception as e:
-            print("FAILED TO PROVISION ({:04X})".format(serial))
-            print(e)
+    start = time.monotonic()
+    image = builder.build()
+    littlefs_builder.write_hex_dump(output, image)
 
-        device.wait_for_no_detect()
-        device.set_status_led(False)
-        serial += 1
+    print("built {} from {} files in {:.1f}ms".format(
+        output, len(littlefs_builder.collect_files(source)), (time.monotonic() - start) * 1000))
 
 
 @cli.command
@@ -269,7 +517,7 @@ def provision_multiple_hexpansions(ctx, starting_id: str):
 def set_diversified_key(ctx):
     """diversifies the slot 0 key"""
 
-    device = provisioner.provisioner()
+    device = open_provisioner(ctx)
     quest_marker = questMarker.quest_marker(device)
 
     div_key = quest_marker.crypto.generate_diversified_key(
@@ -277,12 +525,11 @@ def set_diversified_key(ctx):
         0x00
         )
 
-    quest_marker.crypto.sendWake()
-
-    quest_marker.crypto.encrypted_write(
-        0x00, div_key, 0x0F,
-        ctx.obj['keys'][0x0F]
-        )
+    with quest_marker.crypto.session():
+        quest_marker.crypto.encrypted_write(
+            0x00, div_key, 0x0F,
+            ctx.obj['keys'][0x0F]
+            )
 
     print("Diversified key set for slot 0")
 
@@ -290,8 +537,8 @@ def set_diversified_key(ctx):
 @cli.command
 @click.pass_context
 def check_config(ctx):
-    device = provisioner.provisioner()
-    quest_marker = questMarker.quest_marker(device)
+    device = open_provisioner(ctx)
+    quest_marker = questMarker.quest_marker(device, filesystem_builder=ctx.obj['filesystem_builder'])
 
     board_serial, atsha_serial = quest_marker.get_serial_numbers()
 
@@ -306,16 +553,29 @@ def check_config(ctx):
 
 
 @cli.command
+@click.option('--full', is_flag=True, help="Rewrite every page rather than only the pages that differ")
+@click.option('--dry-run', is_flag=True, help="Only report the pages that differ")
 @click.pass_context
-def update_config(ctx):
-    device = provisioner.provisioner()
-    quest_marker = questMarker.quest_marker(device)
+def update_config(ctx, full, dry_run):
+    device = open_provisioner(ctx)
+    quest_marker = questMarker.quest_marker(device, filesystem_builder=ctx.obj['filesystem_builder'])
 
     board_serial, atsha_serial = quest_marker.get_serial_numbers()
 
     print("updating {:04X} (atsha: {})".format(board_serial, hexString(atsha_serial)))
 
-    quest_marker.update(ctx.obj['keys'])
+    pages = quest_marker.update(ctx.obj['keys'], incremental=not full, dry_run=dry_run)
+
+    for address, length, seconds in pages:
+        if seconds is None:
+            print("differs {:04X} ({} bytes)".format(address, length))
+        else:
+            print("wrote {:04X} ({} bytes) in {:.1f}ms".format(address, length, seconds * 1000))
+    print("{} pages {}".format(len(pages), "differ" if dry_run else "written"))
+
+    slow = zd24c64a.slow_pages(pages)
+    if slow:
+        print("{} slow pages, over {:.0f}ms".format(len(slow), zd24c64a.SLOW_PAGE_WRITE * 1000))
 
 
 @cli.command
@@ -327,7 +587,93 @@ def register_provision(ctx, board_sn, atsha_sn):
     board_serial = int(board_sn, 0)
     atsha_serial = bytearray.fromhex(atsha_sn)
 
-    utils.register_provision(board_serial, atsha_serial, ctx.obj['api_key'])
+    register(ctx, board_serial, atsha_serial)
+
+
+@cli.group("ledger")
+def ledger_command():
+    """Record of provisioned boards"""
+
+
+@ledger_command.command("lookup")
+@click.argument("serial")
+@click.pass_context
+def ledger_lookup(ctx, serial):
+    """Finds a board by its board serial (hex, as printed) or its 9 byte ATSHA serial"""
+    book = open_ledger(ctx)
+
+    digits = serial.replace(" ", "").replace(":", "")
+    if len(digits) == 18:
+        rows = [row for row in [book.find_atsha(digits)] if row is not None]
+    else:
+        rows = book.find_board(int(digits, 16))
+
+    if not rows:
+        print("{} is not in the ledger".format(serial))
+    for row in rows:
+        print(ledger.describe(row))
+
+
+@ledger_command.command("import")
+@click.argument("logs", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def ledger_import(ctx, logs):
+    """Imports provision.log files, boards already in the ledger are kept as they are"""
+    book = open_ledger(ctx)
+    for path in logs:
+        imported, present, bad_lines = book.import_log(path)
+        print("{}: {} imported, {} already in the ledger".format(path, imported, present))
+        if bad_lines:
+            print("  could not read lines {}".format(", ".join(str(number) for number in bad_lines)))
+
+
+@ledger_command.command("duplicates")
+@click.pass_context
+def ledger_duplicates(ctx):
+    """Lists board serials given to more than one chip"""
+    book = open_ledger(ctx)
+    for board_serial, count in book.duplicates():
+        print("{:04X} on {} chips".format(board_serial, count))
+        for row in book.find_board(board_serial):
+            print("  " + ledger.describe(row).replace("\n", "\n  "))
+
+
+@cli.group("outbox")
+def outbox_command():
+    """Registrations waiting for the API"""
+
+
+@outbox_command.command("status")
+@click.pass_context
+def outbox_status(ctx):
+    """Shows how many registrations are pending, sent and rejected"""
+    box = outbox.outbox(ctx.obj['outbox_path'])
+    status = box.status()
+    box.close()
+
+    print(", ".join("{} {}".format(count, state) for state, count in status["counts"].items()))
+    if status["oldest_pending"] is not None:
+        print("oldest pending {:.0f}s ago".format(status["oldest_pending"]))
+    for board_serial, state, attempts, error in status["errors"]:
+        print("{:04X} {} after {} attempts: {}".format(board_serial, state, attempts, error))
+
+
+@outbox_command.command("flush")
+@click.option('--retry-failed', is_flag=True, help="Also resend registrations the API rejected")
+@click.pass_context
+def outbox_flush(ctx, retry_failed):
+    """Sends every pending registration now"""
+    box = open_outbox(ctx)
+    if box is None:
+        raise click.UsageError("flushing the outbox needs --api-key")
+
+    if retry_failed:
+        box.retry_failed()
+    sent = box.flush()
+    pending = box.status()["counts"][outbox.submission_state.PENDING.value]
+    box.close()
+
+    print("{} sent, {} still pending".format(sent, pending))
 
 
 @cli.command
@@ -338,7 +684,7 @@ def submit_capture(ctx, badge_mac):
     Performs a test challenge against the chip
     and submits to the server
     """
-    device = provisioner.provisioner()
+    device = open_provisioner(ctx)
     quest_marker = questMarker.quest_marker(device)
 
     badge_mac = bytes.fromhex(badge_mac.replace("-", ""))
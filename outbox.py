@@ -0,0 +1,325 @@
+import enum
+import json
+import os
+import sqlite3
+import threading
+import time
+import requests
+import requests.adapters
+import utils
+from uuid import UUID
+
+
+OUTBOX_PATH = os.environ.get("PROVISION_OUTBOX", "outbox.sqlite")
+
+HEXPANSIONS_PATH = "/api/hexpansions/"
+BATCH_SIZE = 20  # submissions sent per batch, their results are committed together
+REQUEST_TIMEOUT = 5
+RETRY_BACKOFF = 2.0  # delay before the first retry of a submission in seconds
+RETRY_BACKOFF_MAX = 300.0
+IDLE_WAIT = 5.0  # longest the worker sleeps with nothing due, an append wakes it straight away
+
+# statuses worth trying again later, anything else from 400 up is the submission's own fault
+RETRY_STATUS = (408, 425, 429)
+# the API already has a hexpansion with this serial number
+ALREADY_REGISTERED_STATUS = (409,)
+
+
+class submission_state(enum.Enum):
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"  # rejected by the API, kept for outbox flush --retry-failed
+
+
+class outbox:
+    """
+    Persistent queue of hexpansion registrations, appending is a local SQLite insert so
+    the line never waits on the API, a background worker drains it over one pooled session
+    each board is keyed by its ATSHA serial so a board queued twice is only submitted once,
+    the same key goes to the API as the Idempotency-Key of every attempt
+    """
+
+    path: str
+    api_server: str
+    api_key: "str|None"
+    batch_size: int
+    retry_backoff: float
+    retry_backoff_max: float
+    log: "callable"
+    on_result: "callable|None"  # on_result(atsha_serial, state) after each attempt, e.g. to update the ledger
+
+    def __init__(self, path: str = OUTBOX_PATH, api_server: str = utils.API_SERVER, api_key: "str|None" = None,
+                 batch_size: int = BATCH_SIZE, retry_backoff: float = RETRY_BACKOFF,
+                 retry_backoff_max: float = RETRY_BACKOFF_MAX, log: "callable" = print,
+                 on_result: "callable|None" = None):
+        self.path = path
+        self.api_server = api_server
+        self.api_key = api_key
+        self.batch_size = batch_size
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.log = log
+        self.on_result = on_result
+
+        self._lock = threading.Lock()  # one connection shared by the fixture threads and the worker
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")  # outbox status from another process does not block the line
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS submissions (
+                    atsha_serial TEXT PRIMARY KEY,
+                    board_serial INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    last_error TEXT,
+                    created REAL NOT NULL,
+                    sent REAL
+                )""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS submissions_due ON submissions (state, next_attempt)")
+
+        self._session = None
+        self._worker = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def append(self, board_serial: int, atsha_serial: "bytes|bytearray") -> bool:
+        """Queues a board for registration, returns False if it was already queued or sent"""
+        payload = utils.hexpansion_payload(
+            "{:04X}".format(board_serial), board_serial, int.from_bytes(atsha_serial, 'little'))
+
+        now = time.time()
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO submissions (atsha_serial, board_serial, payload, state, next_attempt, created)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (payload["serial_number"], board_serial, json.dumps(payload), submission_state.PENDING.value, now, now))
+        self._wake.set()
+        return cursor.rowcount == 1
+
+    def _take(self, due_only: bool, after: str = "") -> "list[tuple[str, str, int]]":
+        # (atsha_serial, payload, attempts) of the next batch, by key so a flush goes through each once
+        query = "SELECT atsha_serial, payload, attempts FROM submissions WHERE state = ? AND atsha_serial > ?"
+        args = [submission_state.PENDING.value, after]
+        if due_only:
+            query += " AND next_attempt <= ?"
+            args.append(time.time())
+        query += " ORDER BY atsha_serial LIMIT ?"
+        args.append(self.batch_size)
+
+        with self._lock:
+            return self._db.execute(query, args).fetchall()
+
+    def _get_session(self) -> requests.Session:
+        if self._session is None:
+            self._session = requests.Session()
+            self._session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=1, max_retries=0))
+            self._session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=1, max_retries=0))
+            self._session.headers.update({"Accept": "application/json", "Authorization": f"Token {self.api_key}"})
+        return self._session
+
+    def _send(self, atsha_serial: str, payload: str) -> "tuple[submission_state, str|None]":
+        """Submits one registration, returns the state it moves to and the error for a failed attempt"""
+        try:
+            resp = self._get_session().post(
+                utils.api_url(self.api_server, HEXPANSIONS_PATH),
+                data=payload,
+                headers={"Content-Type": "application/json", "Idempotency-Key": atsha_serial},
+                timeout=REQUEST_TIMEOUT,
+            )
+        except requests.RequestException as e:
+            # the exception text repeats the whole URL and pool state, the type says enough
+            return (submission_state.PENDING, type(e).__name__)
+
+        if resp.status_code in (200, 201) or resp.status_code in ALREADY_REGISTERED_STATUS:
+            return (submission_state.SENT, None)
+
+        error = "HTTP {} {}".format(resp.status_code, resp.text[:200])
+        if resp.status_code >= 500 or resp.status_code in RETRY_STATUS:
+            return (submission_state.PENDING, error)
+        return (submission_state.FAILED, error)
+
+    def _send_batch(self, batch: "list[tuple[str, str, int]]", stopping: "threading.Event|None" = None) -> int:
+        """
+        Sends a batch and commits all the results in one transaction, returns the number sent
+        once stopping is set the rest of the batch is left pending
+        """
+        results = list()
+        for atsha_serial, payload, attempts in batch:
+            if stopping is not None and stopping.is_set():
+                break
+            state, error = self._send(atsha_serial, payload)
+            results.append((atsha_serial, attempts + 1, state, error))
+
+        now = time.time()
+        with self._lock, self._db:
+            for atsha_serial, attempts, state, error in results:
+                delay = min(self.retry_backoff * 2 ** (attempts - 1), self.retry_backoff_max)
+                self._db.execute(
+                    "UPDATE submissions SET state = ?, attempts = ?, next_attempt = ?, last_error = ?, sent = ?"
+                    " WHERE atsha_serial = ?",
+                    (state.value, attempts, now + delay, error,
+                     now if state == submission_state.SENT else None, atsha_serial))
+
+        for atsha_serial, attempts, state, error in results:
+            if self.on_result is not None:
+                self.on_result(UUID(atsha_serial).int.to_bytes(9, 'little'), state)
+            if error is not None:
+                self.log("registration of {} {} ({})".format(
+                    atsha_serial, "rejected" if state == submission_state.FAILED else "will be retried", error))
+
+        return sum(1 for result in results if result[2] == submission_state.SENT)
+
+    def flush(self, due_only: bool = False) -> int:
+        """
+        Tries every pending registration once (only those whose backoff has run out if due_only),
+        returns the number sent
+        """
+        return self._flush(due_only)
+
+    def _flush(self, due_only: bool, stopping: "threading.Event|None" = None) -> int:
+        if self.api_key is None:
+            raise ValueError("registering hexpansions needs an API key")
+
+        sent = 0
+        after = ""
+        while stopping is None or not stopping.is_set():
+            batch = self._take(due_only, after)
+            if not batch:
+                break
+            sent += self._send_batch(batch, stopping)
+            after = batch[-1][0]
+        return sent
+
+    def retry_failed(self) -> int:
+        """Moves rejected registrations back to pending, returns how many"""
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "UPDATE submissions SET state = ?, next_attempt = ? WHERE state = ?",
+                (submission_state.PENDING.value, time.time(), submission_state.FAILED.value))
+        return cursor.rowcount
+
+    def status(self) -> "dict[str, object]":
+        """Counts per state, the age of the oldest pending registration and the latest errors"""
+        with self._lock:
+            counts = dict(self._db.execute("SELECT state, COUNT(*) FROM submissions GROUP BY state").fetchall())
+            oldest = self._db.execute(
+                "SELECT MIN(created) FROM submissions WHERE state = ?", (submission_state.PENDING.value,)).fetchone()[0]
+            errors = self._db.execute(
+                "SELECT board_serial, state, attempts, last_error FROM submissions"
+                " WHERE state != ? AND last_error IS NOT NULL ORDER BY next_attempt DESC LIMIT 5",
+                (submission_state.SENT.value,)).fetchall()
+
+        return {
+            "counts": {state.value: counts.get(state.value, 0) for state in submission_state},
+            "oldest_pending": None if oldest is None else time.time() - oldest,
+            "errors": errors,
+        }
+
+    def _next_due(self) -> "float|None":
+        with self._lock:
+            return self._db.execute(
+                "SELECT MIN(next_attempt) FROM submissions WHERE state = ?",
+                (submission_state.PENDING.value,)).fetchone()[0]
+
+    def start(self):
+        """Starts the background worker"""
+        if self._worker is not None:
+            return
+        self._stopping.clear()
+        self._worker = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self._flush(True, self._stopping)
+                next_due = self._next_due()
+            except Exception as e:
+                # a locked or unreadable outbox is retried on the next wake
+                self.log("outbox worker: {}".format(e))
+                next_due = None
+
+            wait = IDLE_WAIT if next_due is None else min(max(next_due - time.time(), 0.0), IDLE_WAIT)
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    def stop(self, timeout: "float|None" = None):
+        """
+        Stops the worker after the registration it is sending, those it did not send stay queued,
+        returns before the worker has stopped if timeout runs out
+        """
+        if self._worker is None:
+            return
+        self._stopping.set()
+        self._wake.set()
+        self._worker.join(timeout)
+        if not self._worker.is_alive():
+            self._worker = None
+
+    def close(self):
+        # the worker commits what it has sent before it stops, so wait for it however long it takes
+        self.stop()
+        if self._session is not None:
+            self._session.close()
+        with self._lock:
+            self._db.close()
+
+
+# Drains an outbox into a local stand-in for the API that fails each first attempt if run on its own
+if __name__ == "__main__":
+    import http.server
+    import tempfile
+
+    received = dict()  # Idempotency-Key -> number of requests
+    received_lock = threading.Lock()
+
+    class stand_in_api(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, so the session's pooled connection is reused
+        disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            key = self.headers["Idempotency-Key"]
+            assert json.loads(body)["serial_number"] == key
+
+            with received_lock:
+                received[key] = received.get(key, 0) + 1
+                attempt = received[key]
+
+            status = 503 if attempt == 1 else 201 if attempt == 2 else 409
+            response = json.dumps({"attempt": attempt}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), stand_in_api)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        box = outbox(os.path.join(directory, "outbox.sqlite"), "http://127.0.0.1:{}".format(server.server_port),
+                     "test-key", retry_backoff=0.05, log=lambda message: None)
+        box.start()
+
+        start = time.monotonic()
+        for serial in range(50):
+            box.append(serial, serial.to_bytes(9, 'little'))
+        print("50 appends in {:.1f}ms".format((time.monotonic() - start) * 1000))
+        assert not box.append(0, bytes(9)), "a board queued twice must not be submitted twice"
+
+        while box.status()["counts"]["sent"] < 50 and time.monotonic() - start < 10:
+            time.sleep(0.05)
+        box.stop()
+        print(box.status()["counts"], "in {:.2f}s".format(time.monotonic() - start))
+
+        assert all(count == 2 for count in received.values()) and len(received) == 50
+        box.close()
+
+    server.shutdown()
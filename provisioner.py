@@ -1,6 +1,14 @@
 import enum
+import pyftdi.ftdi
 import pyftdi.i2c
 import pyftdi.eeprom
+import time
+
+
+DETECT_POLL_INTERVAL = 0.02  # seconds between reads of the detect pin, keeps the USB link mostly idle
+DETECT_DEBOUNCE = 0.1  # the detect pin has to hold its new state this long while the edge connector settles
+
+DEFAULT_URL = 'ftdi://ftdi:232h/1'
 
 
 class provisioner_pinmap(enum.Enum):
@@ -17,28 +25,105 @@ class provisioner_pinmap(enum.Enum):
     HEXPANSION_DETECT = 0x01 << 14  # ACBUS6
 
 
+def list_provisioner_urls() -> "list[str]":
+    """Finds the attached FT232H provisioners, returns a URL for each that stays valid while it is plugged in"""
+    urls = list()
+    for descriptor, interfaces in pyftdi.ftdi.Ftdi.list_devices('ftdi://ftdi:232h/?'):
+        if descriptor.sn:
+            urls.append('ftdi://ftdi:232h:{}/1'.format(descriptor.sn))
+        else:
+            # no serial number programmed, fall back to the USB bus and address
+            urls.append('ftdi://ftdi:232h:{:x}:{:x}/1'.format(descriptor.bus, descriptor.address))
+    return sorted(urls)
+
+
+class board_detector:
+    """
+    Polls a detect input at a fixed rate and debounces it,
+    on_insert and on_remove are called when a new state has settled
+    """
+
+    read_detect: "callable"
+    poll_interval: float
+    debounce: float
+    on_insert: "callable|None"
+    on_remove: "callable|None"
+    present: "bool|None"  # last settled state, None until the first wait
+
+    def __init__(self, read_detect: "callable", poll_interval: float = DETECT_POLL_INTERVAL,
+                 debounce: float = DETECT_DEBOUNCE, on_insert: "callable|None" = None,
+                 on_remove: "callable|None" = None):
+        self.read_detect = read_detect
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.on_insert = on_insert
+        self.on_remove = on_remove
+        self.present = None
+
+    def wait(self, present: bool, timeout: "float|None" = None) -> bool:
+        """Waits for the input to settle at present, returns False if timeout runs out first"""
+        start = time.monotonic()
+        stable_since = None
+
+        while True:
+            now = time.monotonic()
+            if bool(self.read_detect()) == present:
+                if stable_since is None:
+                    stable_since = now
+                if now - stable_since >= self.debounce:
+                    self._settled(present)
+                    return True
+            else:
+                # a bounce restarts the debounce time
+                stable_since = None
+
+            if timeout is not None and now - start >= timeout:
+                return False
+            time.sleep(self.poll_interval)
+
+    def _settled(self, present: bool):
+        changed = self.present != present
+        self.present = present
+
+        if changed and present and self.on_insert is not None:
+            self.on_insert()
+        elif changed and not present and self.on_remove is not None:
+            self.on_remove()
+
+
 class provisioner:
     """Class to control the Provisioner hardware and provide acces to its gpio control"""
 
     uri: str  # URL to the FTDI chip used on the provisioner
     i2c: pyftdi.i2c.I2cController  # pyftdi i2c object for provisioner
     gpio: pyftdi.i2c.I2cGpioPort
+    detector: board_detector
+
+    # shadows of the GPIO registers, so changing an output does not read the port first
+    gpio_pins: int  # pins configured as GPIO
+    gpio_direction: int  # set bits are outputs
+    gpio_output: int  # levels driven on the outputs
+    _gpio_written: "tuple[int, int]"  # (value, direction) of the last port write
 
-    def __init__(self, url: str = 'ftdi://ftdi:232h/1'):
-        """Connects to and configures a provisioner"""
+    def __init__(self, url: str = DEFAULT_URL, poll_interval: float = DETECT_POLL_INTERVAL,
+                 debounce: float = DETECT_DEBOUNCE):
+        """Connects to and configures a provisioner, poll_interval and debounce tune board detection"""
         self.url = url
+        self.detector = board_detector(self.get_board_detect, poll_interval, debounce)
 
         self.i2c = pyftdi.i2c.I2cController()
         self.i2c.configure(url)
         self.gpio = self.i2c.get_gpio()
+        self.resync()
+
+        # status LED as an output, detect as an input
+        self.set_gpio_modes({
+            provisioner_pinmap.STATUS_LED: True,
+            provisioner_pinmap.HEXPANSION_DETECT: False})
 
         # Deactivate status LED
-        self.set_gpio_mode(provisioner_pinmap.STATUS_LED, output=True)
         self.set_gpio_pin(provisioner_pinmap.STATUS_LED, False)
 
-        # Set detect as input
-        self.set_gpio_mode(provisioner_pinmap.HEXPANSION_DETECT, output=False)
-
     def getInfo(self):
         eeprom = pyftdi.eeprom.FtdiEeprom()
         eeprom.connect(self.i2c.ftdi)
@@ -52,43 +137,56 @@ class provisioner:
         else:
             return self.i2c.get_port(address)
 
-    def set_gpio_mode(self, pin: provisioner_pinmap, output: bool):
-        current = self.gpio.direction
+    def resync(self):
+        """Reloads the shadow registers from the port, for when something else changed it"""
+        self.gpio_pins = self.gpio.pins
+        self.gpio_direction = self.gpio.direction
+        self.gpio_output = self.gpio.read(with_output=True) & self.gpio_direction
+        self._gpio_written = (self.gpio_output, self.gpio_direction)
 
-        if output:
-            current |= pin.value
-        else:
-            current &= ~(pin.value)
+    def set_gpio_mode(self, pin: provisioner_pinmap, output: bool):
+        self.set_gpio_modes({pin: output})
 
-        pin_mask = self.gpio.pins | pin.value
+    def set_gpio_modes(self, modes: "dict[provisioner_pinmap, bool]"):
+        """Sets the direction of several pins, True for output, this does not touch the port until the next write"""
+        for pin, output in modes.items():
+            self.gpio_pins |= pin.value
+            if output:
+                self.gpio_direction |= pin.value
+            else:
+                self.gpio_direction &= ~(pin.value)
 
-        self.gpio.set_direction(pin_mask, current)
+        self.gpio.set_direction(self.gpio_pins, self.gpio_direction)
 
     def set_gpio_pin(self, pin: provisioner_pinmap, state: bool):
-        current = self.gpio.read(with_output=True)
+        self.set_gpio_pins({pin: state})
 
-        if state:
-            current |= pin.value
-        else:
-            current &= ~(pin.value)
+    def set_gpio_pins(self, states: "dict[provisioner_pinmap, bool]"):
+        """Sets several outputs in a single port write, skipped when neither levels nor directions changed"""
+        for pin, state in states.items():
+            if state:
+                self.gpio_output |= pin.value
+            else:
+                self.gpio_output &= ~(pin.value)
 
-        self.gpio.write(current & self.gpio.direction)
+        value = self.gpio_output & self.gpio_direction
+        if (value, self.gpio_direction) != self._gpio_written:
+            self.gpio.write(value)
+            self._gpio_written = (value, self.gpio_direction)
 
     def get_gpio_pin(self, pin: provisioner_pinmap):
-        current = self.gpio.read(with_output=True)
-        if ((current & pin.value) > 0):
-            return True
-        return False
+        # outputs come from the shadow, only inputs are read from the port
+        if self.gpio_direction & pin.value:
+            return (self.gpio_output & pin.value) > 0
+        return (self.gpio.read() & pin.value) > 0
 
-    def wait_for_detect(self):
-        while (True):
-            if (self.get_gpio_pin(provisioner_pinmap.HEXPANSION_DETECT)):
-                return True
+    def wait_for_detect(self, timeout: "float|None" = None) -> bool:
+        """Waits for a board to be inserted, returns False on timeout"""
+        return self.detector.wait(True, timeout)
 
-    def wait_for_no_detect(self):
-        while (True):
-            if (not self.get_gpio_pin(provisioner_pinmap.HEXPANSION_DETECT)):
-                return True
+    def wait_for_no_detect(self, timeout: "float|None" = None) -> bool:
+        """Waits for the board to be removed, returns False on timeout"""
+        return self.detector.wait(False, timeout)
 
     def set_status_led(self, status: bool):
         self.set_gpio_pin(provisioner_pinmap.STATUS_LED, status)
@@ -99,5 +197,6 @@ class provisioner:
 
 # Print device info if run on its own
 if __name__ == "__main__":
-    device = provisioner()
-    device.getInfo()
+    for url in list_provisioner_urls():
+        print(url)
+        provisioner(url).getInfo()
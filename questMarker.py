@@ -1,14 +1,20 @@
+import enum
 import eeprom
+import littlefs_builder
 import provisioner
 import atsha204a
 import zd24c64a
 import pyftdi
+import time
 import utils
 
 
 PIN_STATUS_LED = provisioner.provisioner_pinmap.HEXPANSION_LS1
 PIN_EEPROM_WP = provisioner.provisioner_pinmap.HEXPANSION_LS2
 
+READY_TIMEOUT = 1.0  # a board that has not answered by now is faulty or badly seated
+READY_POLL_INTERVAL = 0.005
+
 
 ATSHA_CONFIG = [
     0xC8,  # I2C Address (default)
@@ -54,21 +60,138 @@ ATSHA_CONFIG = [
 ]
 
 
+def otp_data(serial: int) -> "tuple[bytes, bytes]":
+    """Gets the (low, high) 32 byte OTP blocks for a board serial"""
+    otp_low = bytes("SN:{:04X} HW:{} CONF:{} ".format(serial, "1.0", "1.0"), "ascii")
+    otp_high = bytes("GCHQ.NET HEXPANSION", "ascii")
+
+    otp_low = (otp_low + b'\x00'*32)[0:32]
+    otp_high = (otp_high + b'\x00'*32)[0:32]
+    return (otp_low, otp_high)
+
+
+def config_lock_crc(config: "list[int]") -> int:
+    """Calculates the config zone lock CRC for ATSHA_CONFIG written over the current config"""
+    targetconfig = list(config[0:16]) + ATSHA_CONFIG + list(config[84:88])
+    return atsha204a.atsha204A.calculate_crc(targetconfig, 0, 88)
+
+
+def data_lock_crc(div_key: bytes, keys, otp_low: bytes, otp_high: bytes) -> int:
+    """Calculates the data and OTP zone lock CRC, slot 0 holds div_key and slots 1-15 the keys"""
+    data_crc = atsha204a.atsha204A_crc()
+    data_crc.update(div_key)
+    for x in range(1, 16):
+        data_crc.update(keys[x])
+    data_crc.update(otp_low)
+    data_crc.update(otp_high)
+    return data_crc.value
+
+
+def challenge_data(badge_mac: "bytearray|list[int]") -> "list[int]":
+    """Formats a badge MAC address as the 32 byte NONCE input of a challenge"""
+    formatted_mac = bytearray("{:02X}-{:02X}-{:02X}-{:02X}-{:02X}-{:02X}".format(
+        badge_mac[0], badge_mac[1], badge_mac[2],
+        badge_mac[3], badge_mac[4], badge_mac[5]
+        ), "ascii")
+
+    return list(formatted_mac) + [0x00] * 3
+
+
+def board_image(serial: int, image_batch: "eeprom.image_batch|None" = None,
+                filesystem_builder: "littlefs_builder.littlefs_builder|None" = None) -> "bytearray|memoryview":
+    """Gets the complete EEPROM contents for serial, built, taken from the batch or compiled"""
+    image = None
+    if filesystem_builder is not None:
+        image = eeprom.compile_image(serial, filesystem_builder.build_board(serial))
+    elif image_batch is not None and image_batch.is_current():
+        image = image_batch.image(serial)
+    if image is None:
+        image = eeprom.compile_image(serial)
+    return image
+
+
+class prepared_board:
+    """The host side data for provisioning a board serial, worked out before the board is in the fixture"""
+
+    serial: int
+    image: "bytearray|memoryview"
+    otp: "tuple[bytes, bytes]"  # (low, high) OTP blocks
+
+    def __init__(self, serial: int, image_batch: "eeprom.image_batch|None" = None,
+                 filesystem_builder: "littlefs_builder.littlefs_builder|None" = None):
+        self.serial = serial
+        self.image = board_image(serial, image_batch, filesystem_builder)
+        self.otp = otp_data(serial)
+
+
+class provision_stage(enum.Enum):
+    """Provisioning stages in the order they are performed"""
+    CRYPTO_CONFIG = "crypto config"
+    CRYPTO_DATA = "crypto data"
+    EEPROM = "eeprom"
+
+
 class quest_marker:
     """Wrapper for interfacing with a quest marker board"""
 
     _provisioner: provisioner.provisioner
     crypto: atsha204a.atsha204A
     eeprom: zd24c64a.zd24c64a
-
-    def __init__(self, provisioner_device: provisioner.provisioner):
-        """Initialises a quest marker board based on the provisioner"""
+    image_batch: "eeprom.image_batch|None"
+    filesystem_builder: "littlefs_builder.littlefs_builder|None"
+    log: "callable"
+    _image: "tuple[int, bytearray|memoryview]|None"  # (serial, contents) for the board in the fixture
+    stage_timings: "dict[str, float]"  # seconds taken by each stage the last provision ran
+    check_failures: "list[str]"  # what the last check_config found wrong
+
+    def __init__(self, provisioner_device: provisioner.provisioner,
+                 execution_times: "dict[atsha204a.atasha204A_command, tuple[float, float]]|None" = None,
+                 image_batch: "eeprom.image_batch|None" = None,
+                 filesystem_builder: "littlefs_builder.littlefs_builder|None" = None,
+                 log: "callable" = print):
+        """
+        Initialises a quest marker board based on the provisioner
+        execution_times tunes the ATSHA204A command waits (see atsha204a.COMMAND_EXECUTION_TIME)
+        image_batch supplies precompiled EEPROM images, serials outside it are compiled on demand
+        filesystem_builder builds each board its own filesystem with the per board files added,
+        it takes the place of both the batch and the shared filesystem image
+        log reports progress and check failures, a fixture's own log when several run at once
+        """
         self._provisioner = provisioner_device
+        self.image_batch = image_batch
+        self.filesystem_builder = filesystem_builder
+        self.log = log
+        self._image = None
+        self.stage_timings = dict()
+        self.check_failures = list()
 
         self.eeprom = zd24c64a.zd24c64a(
             self._provisioner.get_i2c_port(0x57))
         self.crypto = atsha204a.atsha204A(
-            self._provisioner.get_i2c_port(0xC8, shift=True))
+            self._provisioner.get_i2c_port(0xC8, shift=True),
+            execution_times,
+            wake_port=self._provisioner.get_i2c_port(0x00))
+
+    def board_removed(self):
+        """Drops any cached chip contents so the next board is read fresh"""
+        self.crypto.snapshot.invalidate()
+        self.crypto.last_wake = None
+        self._image = None
+
+    def wait_until_ready(self, timeout: float = READY_TIMEOUT) -> bool:
+        """
+        Probes a newly inserted board until the ATSHA204A acknowledges after a wake
+        and the EEPROM acknowledges its address, returns False if it does not within timeout
+        """
+        start = time.monotonic()
+        while True:
+            self.crypto.sendWake()
+            if self.crypto.i2c_port.poll(write=True) and self.eeprom.i2c_port.poll(write=True):
+                return True
+
+            if time.monotonic() - start >= timeout:
+                return False
+            time.sleep(READY_POLL_INTERVAL)
 
     def set_status_led(self, status: bool):
         """Sets the Status LED on the board"""
@@ -149,45 +272,23 @@ class quest_marker:
     def write_crypto_config(self):
         """Configures the data zone for the atsha204A"""
 
-        # configure the ATSHA204A config zone
-
-        config_zone_data = ATSHA_CONFIG.copy()
-
-        for x in range(17):
-
-            addr = x+4
-            block = addr >> 3
-            offset = addr & 0x07
-
-            # print(addr, block, offset)
-            utils.auto_retry(
-                self.crypto.command_write, 5,
-                atsha204a.atasha204A_zone.CONFIG, block, offset, config_zone_data[x*4:x*4+4], four_byte=True
-                )
-
-        # lock the config zone TODO can replace with just reading start and end
+        # configure the ATSHA204A config zone, the current config is read once
+        # and used to skip words that are already correct and to calculate the lock CRC
 
         config = self.crypto.read_config()
 
-        # config_low = self.crypto.command_read(atsha204a.atasha204A_zone.CONFIG, 0, 0)
-        # config_end = self.crypto.command_read(atsha204a.atasha204A_zone.CONFIG, 2, 5, four_byte=True)
-
-        targetconfig = config[0:16] + config_zone_data + config[84:88]
+        self.crypto.write_range(atsha204a.atasha204A_zone.CONFIG, 16, ATSHA_CONFIG)
 
-        config_crc = atsha204a.atsha204A.calculate_crc(targetconfig, 0, 88)
+        # lock the config zone
 
-        utils.auto_retry(self.crypto.command_lock, 5, False, config_crc)
+        utils.auto_retry(self.crypto.command_lock, 5, False, config_lock_crc(config))
 
-    def write_crypto_data(self, serial, keys):
-        """writes the data to the atsha204A"""
+    def write_crypto_data(self, serial, keys, otp: "tuple[bytes, bytes]|None" = None):
+        """writes the data to the atsha204A, otp is the (low, high) OTP data for serial if already worked out"""
 
         # generate OTP data
 
-        otp_low = bytes("SN:{:04X} HW:{} CONF:{} ".format(serial, "1.0", "1.0"), "ascii")
-        otp_high = bytes("GCHQ.NET HEXPANSION", "ascii")
-
-        otp_low = (otp_low + b'\x00'*32)[0:32]
-        otp_high = (otp_high + b'\x00'*32)[0:32]
+        otp_low, otp_high = otp_data(serial) if otp is None else otp
 
         # program data and otp
 
@@ -207,60 +308,151 @@ class quest_marker:
 
         # lock data
 
-        crcstream = list()
-        crcstream += div_key
-        for x in range(1, 16):
-            crcstream += list(keys[x])
-        crcstream += list(otp_low)
-        crcstream += list(otp_high)
-
-        # print(len(crcstream))
-
-        data_crc = atsha204a.atsha204A.calculate_crc(crcstream, 0, len(crcstream))
-
-        utils.auto_retry(self.crypto.command_lock, 5, True, data_crc)
-
-    def write_eeprom(self, serial):
-        """Writes the eeprom contnents"""
+        utils.auto_retry(self.crypto.command_lock, 5, True, data_lock_crc(div_key, keys, otp_low, otp_high))
+
+    def eeprom_image(self, serial) -> "bytearray|memoryview":
+        """
+        Gets the complete EEPROM contents for serial, from the batch when it has them,
+        the image is kept until the board is removed so it is only built once per board
+        """
+        if self._image is not None and self._image[0] == serial:
+            return self._image[1]
+
+        image = board_image(serial, self.image_batch, self.filesystem_builder)
+
+        self._image = (serial, image)
+        return image
+
+    def write_eeprom(self, serial, incremental=False, dry_run=False,
+                     image: "bytearray|memoryview|None" = None) -> "list[tuple[int, int, float|None]]":
+        """
+        Writes the eeprom contnents, incremental only writes the pages that differ
+        from what is already on the EEPROM and dry_run only reports them
+        image is the precompiled contents for serial, built here if not given
+        returns (address, length, seconds) for each page that was written,
+        seconds is None for the pages a dry run would write
+        """
+
+        if image is None:
+            image = self.eeprom_image(serial)
+        image = memoryview(image)
+
+        # filesystem first then the header, so a valid header marks a completed write
+        regions = ((eeprom.FS_OFFSET, image[eeprom.FS_OFFSET:]), (0, image[:eeprom.FS_OFFSET]))
+
+        if dry_run:
+            differing = list()
+            for offset, data in regions:
+                if incremental:
+                    differing += self.eeprom.update_image(offset, data, dry_run=True)[0]
+                else:
+                    differing += zd24c64a.pages(offset, len(data))
+            return [(address, length, None) for address, length in differing]
 
         # disable write protect
         self.set_eeprom_wp(False)
 
-        # write header
-        header_data = eeprom.generate_header_data(serial)
-        self.eeprom.writeAddr(0, header_data)
-
-        # write filesystem
-        filesystem = eeprom.get_littlefs_image()
-
-        for x in range(0, len(filesystem), 32):
-            self.eeprom.writeAddr(32+x, filesystem[x:x+32])
-
-        self.set_eeprom_wp(True)
-
-    def provision(self, keys, serial):
-        """Performs first time setup for the hexpansion"""
-
-        self.write_crypto_config()
-        self.write_crypto_data(serial, keys)
-        self.write_eeprom(serial)
-
-    def update(self, keys):
+        try:
+            timings = list()
+            for offset, data in regions:
+                if incremental:
+                    timings += self.eeprom.update_image(offset, data)[1]
+                else:
+                    timings += self.eeprom.write_image(offset, data)
+        finally:
+            self.set_eeprom_wp(True)
+
+        return timings
+
+    def get_provision_state(self, serial) -> "tuple[int, list[provision_stage]]":
+        """
+        Detects which provisioning stages are still needed from the ATSHA204A lock bytes
+        and the EEPROM header, returns the board serial (the one already in OTP for
+        boards with a locked data zone) and the pending stages in order
+        """
+
+        pending = list()
+
+        if not self.crypto.is_config_locked():
+            pending.append(provision_stage.CRYPTO_CONFIG)
+        elif self.crypto.read_config()[16:84] != ATSHA_CONFIG:
+            raise RuntimeError("config zone is locked with a different configuration")
+
+        if not self.crypto.is_data_locked():
+            pending.append(provision_stage.CRYPTO_DATA)
+        else:
+            serial, atsha_serial = self.get_serial_numbers()
+
+        expected_header = bytearray(eeprom.FS_OFFSET)
+        eeprom.compile_header(serial, expected_header)
+
+        eeprom_header = utils.auto_retry(self.eeprom.readAddr, 5, 0, eeprom.FS_OFFSET)
+        if bytes(eeprom_header) != expected_header:
+            pending.append(provision_stage.EEPROM)
+
+        return (serial, pending)
+
+    def provision(self, keys, serial, prepared: "prepared_board|None" = None) -> int:
+        """
+        Performs first time setup for the hexpansion, stages that are already
+        complete are skipped so a partially provisioned board is resumed
+        prepared is the host side data for serial, it is not used for a board resumed with another serial
+        returns the board serial, which is the existing one if the data zone was already locked
+        """
+
+        with self.crypto.session():
+            serial, pending = self.get_provision_state(serial)
+
+            otp = None
+            if prepared is not None and prepared.serial == serial:
+                self._image = (serial, prepared.image)
+                otp = prepared.otp
+
+            self.stage_timings = dict()
+            for stage in provision_stage:
+                if stage not in pending:
+                    self.log("{} already complete ({:04X})".format(stage.value, serial))
+                    continue
+
+                start = time.monotonic()
+                if stage == provision_stage.CRYPTO_CONFIG:
+                    self.write_crypto_config()
+                elif stage == provision_stage.CRYPTO_DATA:
+                    self.write_crypto_data(serial, keys, otp)
+                elif stage == provision_stage.EEPROM:
+                    timings = self.write_eeprom(serial, image=self.eeprom_image(serial))
+                    for address, length, seconds in zd24c64a.slow_pages(timings):
+                        self.log("slow EEPROM page {:04X} ({} bytes) took {:.1f}ms".format(
+                            address, length, seconds * 1000))
+                self.stage_timings[stage.value] = time.monotonic() - start
+
+            return serial
+
+    def update(self, keys, incremental=True, dry_run=False) -> "list[tuple[int, int, float|None]]":
+        """Rewrites the EEPROM for the board serial, returns the (address, length, seconds) pages written"""
 
         board_serial, atsha_serial = self.get_serial_numbers()
 
-        self.write_eeprom(board_serial)
+        return self.write_eeprom(board_serial, incremental, dry_run)
+
+    def _check_failed(self, message: str):
+        self.log(message)
+        self.check_failures.append(message)
 
-    def check_config(self, keys):
-        """Validates the configurtion of an app"""
+    def check_config(self, keys, image: "bytearray|memoryview|None" = None):
+        """
+        Validates the configurtion of an app
+        image is the expected EEPROM contents, the one written for this board is used if not given
+        """
 
         configCorrect = True
+        self.check_failures = list()
 
         # check config
         config = self.crypto.read_config()
 
         if (config[16:84] != ATSHA_CONFIG):
-            print("config mismatch")
+            self._check_failed("config mismatch")
             configCorrect = False
 
         # validate data
@@ -272,33 +464,29 @@ class quest_marker:
         try:
             utils.auto_retry(self.crypto.check_key, 5, 0, div_key)
         except Exception:
-            print("Incorrect key in slot 0")
+            self._check_failed("Incorrect key in slot 0")
             configCorrect = False
 
         for x in range(1, 16):
             try:
                 utils.auto_retry(self.crypto.check_key, 5, x, keys[x])
             except Exception:
-                print("Incorrect key in slot {}".format(x))
+                self._check_failed("Incorrect key in slot {}".format(x))
                 configCorrect = False
 
-        # check EEPROM header
+        # check EEPROM header and filesystem in one pass, stops reading at the first difference
 
         board_serial, atsha_serial = self.get_serial_numbers()
 
-        eeprom_data = self.eeprom.readAddr(0, 32)
-        expected_eeprom_header = eeprom.generate_header_data(board_serial)
+        if image is None:
+            image = self.eeprom_image(board_serial)
+        mismatch = self.eeprom.verify_image(0, image)
 
-        if list(eeprom_data) != list(expected_eeprom_header):
-            print("EEPROM header mismatch")
+        if mismatch is not None and mismatch < eeprom.FS_OFFSET:
+            self._check_failed("EEPROM header mismatch at {:04X}".format(mismatch))
             configCorrect = False
-
-        # check EEPROM filesystem
-
-        fs_data = self.eeprom.readAddr(32, (1024*8) - 32)
-
-        if not eeprom.check_littlefs_dump_against_file(fs_data):
-            print("EEPROM litltefs mismatch")
+        elif mismatch is not None:
+            self._check_failed("EEPROM litltefs mismatch at {:04X}".format(mismatch))
             configCorrect = False
 
         return configCorrect
@@ -310,15 +498,8 @@ class quest_marker:
             ) -> "tuple[bytearray, bytearray]":
         """performs a challenge against the badge"""
 
-        formatted_mac = bytearray("{:02X}-{:02X}-{:02X}-{:02X}-{:02X}-{:02X}".format(
-            badge_mac[0], badge_mac[1], badge_mac[2],
-            badge_mac[3], badge_mac[4], badge_mac[5]
-            ), "ascii")
-
-        challenge = list(formatted_mac) + [0x00] * 3
-
         # perform a nonce command
-        random = self.crypto.command_nonce(0x01, challenge)
+        random = self.crypto.command_nonce(0x01, challenge_data(badge_mac))
 
         # perform the mac command
         response = self.crypto.command_mac(slot, [], use_tempkey_end=True)
@@ -328,8 +509,9 @@ class quest_marker:
     def get_serial_numbers(self):
         atsha_serial = self.crypto.get_serial_number()
 
-        otp_low = utils.auto_retry(self.crypto.command_read, 5, atsha204a.atasha204A_zone.OTP, 0, 0)
+        # OTP starts "SN:XXXX"
+        otp_serial = self.crypto.read_range(atsha204a.atasha204A_zone.OTP, 3, 4)
 
-        board_serial = int(str(otp_low[3:7], "ascii"), 16)
+        board_serial = int(str(otp_serial, "ascii"), 16)
 
         return (board_serial, atsha_serial)
@@ -0,0 +1,239 @@
+import contextlib
+import os
+import socket
+import time
+import fixtures
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+    import msvcrt
+
+
+JOURNAL_PATH = os.environ.get("SERIAL_JOURNAL", "serials.journal")
+LEASE_BLOCK = 32  # serials taken from the journal at a time, a crash loses at most the rest of one block
+
+LEASE = "lease"
+RETURN = "return"
+
+
+def station_name() -> str:
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+@contextlib.contextmanager
+def _locked(journal):
+    """Holds an exclusive lock on the open journal so stations sharing it take leases one at a time"""
+    if fcntl is not None:
+        fcntl.flock(journal.fileno(), fcntl.LOCK_EX)
+    else:
+        journal.seek(0)
+        msvcrt.locking(journal.fileno(), msvcrt.LK_LOCK, 1)
+    try:
+        yield journal
+    finally:
+        if fcntl is not None:
+            fcntl.flock(journal.fileno(), fcntl.LOCK_UN)
+        else:
+            journal.seek(0)
+            msvcrt.locking(journal.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def read_journal(journal) -> "tuple[set[int], set[int]]":
+    """
+    Replays the journal, returns the serials leased and not given back and the serials
+    given back and not leased again, a line torn by a crash mid write is ignored
+    """
+    leased = set()
+    returned = set()
+
+    journal.seek(0)
+    for line in journal:
+        fields = line.strip().split(",")
+        try:
+            kind, first, count = fields[0], int(fields[1], 16), int(fields[2])
+        except (IndexError, ValueError):
+            continue
+
+        serials = range(first, first + count)
+        if kind == LEASE:
+            leased.update(serials)
+            returned.difference_update(serials)
+        elif kind == RETURN:
+            leased.difference_update(serials)
+            returned.update(serials)
+
+    return (leased, returned)
+
+
+def ranges(serials: "list[int]") -> "list[tuple[int, int]]":
+    """Groups serials into (first, count) runs"""
+    result = list()
+    for serial in sorted(serials):
+        if result and result[-1][0] + result[-1][1] == serial:
+            result[-1] = (result[-1][0], result[-1][1] + 1)
+        else:
+            result.append((serial, 1))
+    return result
+
+
+class lease_allocator(fixtures.serial_allocator):
+    """
+    serial_allocator backed by a journal, serials are leased from the journal a block at a time
+    (appended and fsynced before any is handed out) so allocating is an in memory increment,
+    and a restart or a second station sharing the journal never hands out a leased serial again
+    at close the unused rest of the block and released serials are given back to the journal,
+    after a crash only the rest of the block in use is skipped
+    board serials already in the ledger are skipped, so boards provisioned before the journal
+    (import their provision.log) or with a different starting serial are not collided with
+    """
+
+    journal_path: str
+    block_size: int
+    station: str
+    ledger: "object|None"  # ledger.ledger
+
+    def __init__(self, journal_path: str = JOURNAL_PATH, first_serial: "int|None" = None,
+                 block_size: int = LEASE_BLOCK, ledger=None, station: "str|None" = None):
+        """
+        first_serial is the lowest serial to hand out, by default carry on after the highest
+        serial in the journal or the ledger, reusing serials given back first
+        """
+        super().__init__(0)
+        self.journal_path = journal_path
+        self.block_size = block_size
+        self.ledger = ledger
+        self.station = station or station_name()
+        self._first_serial = first_serial
+        self._lease_end = 0  # next_serial up to here is leased to this allocator
+
+    def _ledger_highest(self, low: int, high: int) -> "int|None":
+        if self.ledger is None:
+            return None
+        return self.ledger.highest_board_serial(low, high)
+
+    def _floor(self, leased: "set[int]", returned: "set[int]") -> int:
+        if self._first_serial is not None:
+            return self._first_serial
+
+        free = [serial for serial in returned if self._ledger_highest(serial, serial + 1) is None]
+        if free:
+            return min(free)
+
+        highest = max(leased | returned, default=-1)
+        ledger_highest = self._ledger_highest(0, 1 << 32)
+        return max(highest, -1 if ledger_highest is None else ledger_highest) + 1
+
+    def _next_block(self, leased: "set[int]", floor: int) -> "tuple[int, int]":
+        """The first (first, count) run of up to block_size serials from floor not leased or in the ledger"""
+        start = floor
+        while True:
+            while start in leased:
+                start += 1
+            end = start
+            while end < start + self.block_size and end not in leased:
+                end += 1
+
+            used = self._ledger_highest(start, end)
+            if used is None:
+                return (start, end - start)
+            start = used + 1
+
+    def _append(self, journal, kind: str, first: int, count: int):
+        journal.seek(0, os.SEEK_END)
+        journal.write("{},{:04X},{},{},{}\n".format(
+            kind, first, count, self.station, time.strftime("%Y-%m-%d %H:%M:%S")))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    def _lease(self):
+        # call with self._lock held
+        with open(self.journal_path, "a+") as journal, _locked(journal):
+            leased, returned = read_journal(journal)
+            first, count = self._next_block(leased, max(self._floor(leased, returned), self.next_serial))
+            self._append(journal, LEASE, first, count)
+
+        self.next_serial = first
+        self._lease_end = first + count
+
+    def allocate(self) -> int:
+        with self._lock:
+            if self._released:
+                return self._released.pop(0)
+            if self.next_serial >= self._lease_end:
+                self._lease()
+            serial = self.next_serial
+            self.next_serial += 1
+            return serial
+
+    def peek(self) -> int:
+        """The serial the next allocate will hand out, leasing a block if needed"""
+        with self._lock:
+            if self._released:
+                return self._released[0]
+            if self.next_serial >= self._lease_end:
+                self._lease()
+            return self.next_serial
+
+    def close(self):
+        """Gives the serials this allocator leased and did not hand out back to the journal"""
+        with self._lock:
+            unused = self._released + list(range(self.next_serial, self._lease_end))
+            self._released = list()
+            self._lease_end = self.next_serial
+            if not unused:
+                return
+
+            with open(self.journal_path, "a+") as journal, _locked(journal):
+                for first, count in ranges(unused):
+                    self._append(journal, RETURN, first, count)
+
+
+# Hands out serials from several threads and two allocators sharing a journal if run on its own
+if __name__ == "__main__":
+    import tempfile
+    import threading
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "serials.journal")
+
+        station_a = lease_allocator(path, first_serial=0x100, station="a")
+        station_b = lease_allocator(path, first_serial=0x100, station="b")
+
+        handed_out = list()
+        handed_out_lock = threading.Lock()
+
+        def take(allocator: lease_allocator, count: int):
+            for x in range(count):
+                serial = allocator.allocate()
+                with handed_out_lock:
+                    handed_out.append(serial)
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=take, args=(allocator, 500)) for allocator in (station_a, station_b) * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        assert len(set(handed_out)) == len(handed_out) == 2000
+        print("2000 serials on 2 stations in {:.1f}ms, {:.1f}us each".format(elapsed * 1000, elapsed / 2000 * 1e6))
+
+        station_a.release(handed_out[0])
+        station_a.close()
+        station_b.close()
+
+        # a restart reuses what was given back, then carries on after the highest serial
+        restarted = lease_allocator(path)
+        reused = [restarted.allocate() for x in range(3)]
+        print("after restart {}".format(", ".join("{:04X}".format(serial) for serial in reused)))
+        assert reused[0] == handed_out[0] and not set(reused[1:]) & set(handed_out)
+
+        # a crash (no close) skips the rest of the block rather than reusing it
+        crashed_next = restarted.next_serial
+        after_crash = lease_allocator(path).allocate()
+        print("after crash {:04X}, {} serials skipped".format(after_crash, after_crash - crashed_next))
+        assert after_crash >= restarted._lease_end
@@ -0,0 +1,170 @@
+import threading
+import pyftdi.i2c
+import provisioner
+
+
+TCA9548A_ADDRESS = 0x70
+CHANNEL_COUNT = 8
+EEPROM_ADDRESS = 0x57  # answers on every populated channel, used to detect the board
+
+
+class tca9548a:
+    """
+    Interface class for the TCA9548A I2C multiplexer, lock is held for each transfer
+    so the channel selected for it can not change until it completes
+    """
+
+    i2c_port: pyftdi.i2c.I2cPort
+    lock: threading.RLock
+    channel: "int|None"  # selected channel, None for none or unknown
+
+    def __init__(self, i2c_port: pyftdi.i2c.I2cPort):
+        self.i2c_port = i2c_port
+        self.lock = threading.RLock()
+        self.channel = None
+
+    def select(self, channel: "int|None"):
+        """Routes the bus to channel, None disconnects them all, call with lock held"""
+        if channel == self.channel:
+            return
+
+        try:
+            self.i2c_port.write([0 if channel is None else 1 << channel])
+        except Exception:
+            # the selection is unknown until a write succeeds
+            self.channel = None
+            raise
+        self.channel = channel
+
+    def read_selection(self) -> int:
+        """Reads back the control register, a bit per connected channel"""
+        with self.lock:
+            return self.i2c_port.read(1)[0]
+
+    def port(self, channel: int, i2c_port: pyftdi.i2c.I2cPort) -> "muxed_i2c_port":
+        return muxed_i2c_port(self, channel, i2c_port)
+
+
+class muxed_i2c_port:
+    """I2cPort wrapper that selects its multiplexer channel before each transfer"""
+
+    def __init__(self, mux: tca9548a, channel: int, i2c_port: pyftdi.i2c.I2cPort):
+        self.mux = mux
+        self.channel = channel
+        self.i2c_port = i2c_port
+
+    def write(self, out: "bytes|bytearray|list[int]", relax: bool = True, start: bool = True):
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            return self.i2c_port.write(out, relax=relax, start=start)
+
+    def read(self, readlen: int = 0, relax: bool = True, start: bool = True) -> bytes:
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            return self.i2c_port.read(readlen, relax=relax, start=start)
+
+    def exchange(self, out: "bytes|bytearray|list[int]" = b'', readlen: int = 0,
+                 relax: bool = True, start: bool = True) -> bytes:
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            return self.i2c_port.exchange(out, readlen, relax=relax, start=start)
+
+    def poll(self, write: bool = False, relax: bool = True, start: bool = True) -> bool:
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            return self.i2c_port.poll(write=write, relax=relax, start=start)
+
+
+class mux_fixture:
+    """
+    A provisioner with hexpansion slots behind a TCA9548A, each slot is driven through its
+    own mux_channel on its own thread, the bus is only held for single transfers so while one
+    chip executes a command (or the EEPROM runs a write cycle) the others are talked to
+    the slots share the provisioner GPIOs, an output stays driven while any slot wants it
+    and the status LED lights once every slot has passed
+    """
+
+    device: provisioner.provisioner
+    mux: tca9548a
+    channels: "list[mux_channel]"
+
+    def __init__(self, device: provisioner.provisioner, channels: "int|list[int]" = CHANNEL_COUNT,
+                 poll_interval: float = provisioner.DETECT_POLL_INTERVAL,
+                 debounce: float = provisioner.DETECT_DEBOUNCE, channel_class: "type|None" = None):
+        if isinstance(channels, int):
+            channels = list(range(channels))
+
+        self.device = device
+        self.mux = tca9548a(device.get_i2c_port(TCA9548A_ADDRESS))
+        self._lock = threading.Lock()
+        self._output_requests = dict()  # pin -> channels that want it as an output
+        self._status = dict()  # channel -> status LED state
+
+        channel_class = channel_class or mux_channel
+        self.channels = [channel_class(self, channel, poll_interval, debounce) for channel in channels]
+
+    def set_output_request(self, channel: int, pin: provisioner.provisioner_pinmap, output: bool):
+        with self._lock:
+            requests = self._output_requests.setdefault(pin, set())
+            if output:
+                requests.add(channel)
+            else:
+                requests.discard(channel)
+            self.device.set_gpio_mode(pin, bool(requests))
+
+    def set_gpio_pin(self, pin: provisioner.provisioner_pinmap, state: bool):
+        with self._lock:
+            self.device.set_gpio_pin(pin, state)
+
+    def set_channel_status(self, channel: int, status: bool):
+        with self._lock:
+            self._status[channel] = status
+            self.device.set_status_led(all(self._status.get(item.channel, False) for item in self.channels))
+
+
+class mux_channel:
+    """One hexpansion slot behind the multiplexer, stands in for the provisioner for quest_marker"""
+
+    fixture: mux_fixture
+    channel: int
+    url: str
+    detector: provisioner.board_detector
+
+    def __init__(self, fixture: mux_fixture, channel: int,
+                 poll_interval: float = provisioner.DETECT_POLL_INTERVAL,
+                 debounce: float = provisioner.DETECT_DEBOUNCE):
+        self.fixture = fixture
+        self.channel = channel
+        self.url = "{}#{}".format(fixture.device.url, channel)
+        self.detector = provisioner.board_detector(self.get_board_detect, poll_interval, debounce)
+        self._detect_port = self.get_i2c_port(EEPROM_ADDRESS)
+
+    def getInfo(self):
+        print("channel {} of {}".format(self.channel, self.fixture.device.url))
+
+    def get_i2c_port(self, address: int, shift=False) -> muxed_i2c_port:
+        return self.fixture.mux.port(self.channel, self.fixture.device.get_i2c_port(address, shift))
+
+    def set_gpio_mode(self, pin: provisioner.provisioner_pinmap, output: bool):
+        self.fixture.set_output_request(self.channel, pin, output)
+
+    def set_gpio_pin(self, pin: provisioner.provisioner_pinmap, state: bool):
+        self.fixture.set_gpio_pin(pin, state)
+
+    def get_gpio_pin(self, pin: provisioner.provisioner_pinmap):
+        if pin == provisioner.provisioner_pinmap.HEXPANSION_DETECT:
+            return self.get_board_detect()
+        return self.fixture.device.get_gpio_pin(pin)
+
+    def get_board_detect(self) -> bool:
+        # the detect pin is shared by every slot, a board is present when its EEPROM answers
+        return self._detect_port.poll(write=True)
+
+    def wait_for_detect(self, timeout: "float|None" = None) -> bool:
+        return self.detector.wait(True, timeout)
+
+    def wait_for_no_detect(self, timeout: "float|None" = None) -> bool:
+        return self.detector.wait(False, timeout)
+
+    def set_status_led(self, status: bool):
+        self.fixture.set_channel_status(self.channel, status)
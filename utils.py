@@ -1,4 +1,7 @@
 # import requests
+import asyncio
+import inspect
+import threading
 import time
 import requests
 from uuid import UUID
@@ -9,28 +12,185 @@ def hexString(data):
     return ' '.join('{:02x}'.format(x) for x in data)
 
 
+class retry_stats:
+    """
+    Counts calls, retries and failures per retried function,
+    each thread (one per fixture) keeps its own counts
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def calls(self) -> "dict[str, int]":
+        return self._counts().calls
+
+    @property
+    def retries(self) -> "dict[str, int]":
+        return self._counts().retries
+
+    @property
+    def failures(self) -> "dict[str, int]":
+        return self._counts().failures
+
+    def _counts(self):
+        if not hasattr(self._local, "calls"):
+            self.reset()
+        return self._local
+
+    def reset(self):
+        self._local.calls = dict()
+        self._local.retries = dict()
+        self._local.failures = dict()
+
+    def record(self, name: str, retries: int, failed: bool):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.retries[name] = self.retries.get(name, 0) + retries
+        if failed:
+            self.failures[name] = self.failures.get(name, 0) + 1
+
+    def summary(self) -> str:
+        """Gets a printable line per function that needed retries or failed"""
+        lines = list()
+        for name in sorted(self.calls):
+            if self.retries[name] or self.failures.get(name, 0):
+                lines.append("{}: {} calls, {} retries, {} failures".format(
+                    name, self.calls[name], self.retries[name], self.failures.get(name, 0)))
+        return "\n".join(lines)
+
+
+RETRY_STATS = retry_stats()
+
+
+class retry_policy:
+    """
+    Retries transient bus errors (NACKs, CRC mismatches, no data, all IOErrors)
+    with an exponential backoff, any other exception such as a RuntimeError
+    status from the chip is deterministic and raised straight away
+    a transient error with a recover() method (e.g. a sleeping chip) is
+    recovered and retried without waiting
+    """
+
+    retries: int  # total attempts
+    backoff: float  # delay before the first retry in seconds
+    backoff_factor: float
+    backoff_max: float
+    budget: "float|None"  # total time allowed for all attempts in seconds
+    transient: "tuple[type, ...]"
+    stats: retry_stats
+
+    def __init__(
+            self,
+            retries: int = 5,
+            backoff: float = 0.002,
+            backoff_factor: float = 2.0,
+            backoff_max: float = 0.05,
+            budget: "float|None" = None,
+            transient: "tuple[type, ...]" = (IOError,),
+            stats: retry_stats = RETRY_STATS):
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.budget = budget
+        self.transient = transient
+        self.stats = stats
+
+    def call(self, function: callable, *args, **kwargs):
+        """Calls the function, retrying transient failures"""
+        name = getattr(function, "__qualname__", repr(function))
+        start = time.monotonic()
+        delay = self.backoff
+
+        for x in range(self.retries):
+            try:
+                result = function(*args, **kwargs)
+                self.stats.record(name, x, False)
+                return result
+            except self.transient as e:
+                out_of_time = self.budget is not None and time.monotonic() - start + delay > self.budget
+                if (x == self.retries-1 or out_of_time):
+                    self.stats.record(name, x, True)
+                    raise e
+
+                recover = getattr(e, "recover", None)
+                if recover is not None:
+                    recover()
+                    continue
+            except Exception:
+                self.stats.record(name, x, True)
+                raise
+
+            time.sleep(delay)
+            delay = min(delay * self.backoff_factor, self.backoff_max)
+
+    async def call_async(self, function: callable, *args, **kwargs):
+        """Awaits the coroutine function, retrying transient failures with an awaited backoff"""
+        name = getattr(function, "__qualname__", repr(function))
+        start = time.monotonic()
+        delay = self.backoff
+
+        for x in range(self.retries):
+            try:
+                result = await function(*args, **kwargs)
+                self.stats.record(name, x, False)
+                return result
+            except self.transient as e:
+                out_of_time = self.budget is not None and time.monotonic() - start + delay > self.budget
+                if (x == self.retries-1 or out_of_time):
+                    self.stats.record(name, x, True)
+                    raise e
+
+                recover = getattr(e, "recover", None)
+                if recover is not None:
+                    recovered = recover()
+                    if inspect.isawaitable(recovered):
+                        # the async driver recovers with a coroutine
+                        await recovered
+                    continue
+            except Exception:
+                self.stats.record(name, x, True)
+                raise
+
+            await asyncio.sleep(delay)
+            delay = min(delay * self.backoff_factor, self.backoff_max)
+
+
 def auto_retry(function: callable, retries: int, *args, **kwargs):
     """automatialy retries a command in the event of I2C failures"""
+    return retry_policy(retries).call(function, *args, **kwargs)
 
-    for x in range(retries):
-        try:
-            return function(*args, **kwargs)
-        except Exception as e:
-            if (x == retries-1):
-                raise e
 
+async def auto_retry_async(function: callable, retries: int, *args, **kwargs):
+    """auto_retry for coroutine functions"""
+    return await retry_policy(retries).call_async(function, *args, **kwargs)
 
-def submit_hexpansion(human_name: str, eeprom_serial: int, atsha_serial: int, api_key: str, api_server) -> None:
 
-    payload = {
+API_SERVER = "gchq.net"
+
+
+def api_url(api_server: str, path: str) -> str:
+    """URL of an API path, api_server is a host name (https) or a base URL such as http://127.0.0.1:8000"""
+    if "://" not in api_server:
+        api_server = "https://" + api_server
+    return api_server.rstrip("/") + path
+
+
+def hexpansion_payload(human_name: str, eeprom_serial: int, atsha_serial: int) -> dict:
+    return {
         "human_identifier": human_name,
         "eeprom_serial_number": eeprom_serial,
         "serial_number": str(UUID(int=atsha_serial)),
     }
 
+
+def submit_hexpansion(human_name: str, eeprom_serial: int, atsha_serial: int, api_key: str, api_server) -> bool:
+
+    payload = hexpansion_payload(human_name, eeprom_serial, atsha_serial)
+
     try:
         resp = requests.post(
-            f"https://{api_server}/api/hexpansions/",
+            api_url(api_server, "/api/hexpansions/"),
             json=payload,
             headers={"Accept": "application/json", "Authorization": f"Token {api_key}"},
             timeout=5,
@@ -38,8 +198,10 @@ def submit_hexpansion(human_name: str, eeprom_serial: int, atsha_serial: int, ap
         if resp.status_code != 201:
             print(resp.json())
         resp.raise_for_status()
+        return True
     except requests.HTTPError as e:
         print(f"Failed to submit Hexpansion {human_name} to server: {e}")
+        return False
 
 
 def submit_capture(
@@ -72,7 +234,7 @@ def submit_capture(
 
     try:
         resp = requests.post(
-            f"https://{api_server}/api/badge/capture/",
+            api_url(api_server, "/api/badge/capture/"),
             json=payload,
             headers={"Accept": "application/json"},
             timeout=5,
@@ -84,18 +246,32 @@ def submit_capture(
         print(f"Failed to submit Capture {badge_mac_string} to server: {e}")
 
 
-def register_provision(board_serial, atsha_serial, api_key, log_file="provision.log", api_server="gchq.net"):
+def register_provision(board_serial, atsha_serial, api_key, ledger, api_server=API_SERVER, outbox=None,
+                       fixture=None, stage_timings=None):
+    """
+    Records a provisioned board in the ledger and registers it with the API when there is an api_key,
+    through the outbox when one is given so a slow or unreachable API does not hold up the line
+    returns the ATSHA serials of other boards in the ledger with the same board serial
+    """
 
-    with open(log_file, "a") as provision_log:
-        provision_log.write("{:04X},{},{}\n".format(
-            board_serial, hexString(atsha_serial), time.strftime("%Y-%m-%d %H:%M:%S")
-            ))
+    duplicates = ledger.record(board_serial, atsha_serial, fixture, stage_timings)
 
-    if api_key is not None:
-        submit_hexpansion(
-            "{:04X}".format(board_serial),
-            board_serial,
-            int.from_bytes(atsha_serial, 'little'),
-            api_key,
-            api_server
-            )
+    if api_key is None:
+        return duplicates
+
+    if outbox is not None:
+        # a board already queued keeps the state the outbox gave it, and the worker
+        # may have sent this one and recorded it before it is marked pending here
+        if outbox.append(board_serial, atsha_serial):
+            ledger.set_submission(atsha_serial, "pending", only_unset=True)
+        return duplicates
+
+    submitted = submit_hexpansion(
+        "{:04X}".format(board_serial),
+        board_serial,
+        int.from_bytes(atsha_serial, 'little'),
+        api_key,
+        api_server
+        )
+    ledger.set_submission(atsha_serial, "sent" if submitted else "failed")
+    return duplicates
@@ -1,4 +1,52 @@
 import pyftdi.i2c
+import time
+
+
+PAGE_SIZE = 32  # bytes per page write
+SIZE = 1024 * 8
+WRITE_CYCLE_TIMEOUT = 0.02  # give up ACK polling well after the 5 ms maximum write cycle
+READ_CHUNK_SIZE = 256  # bytes per sequential read when comparing contents
+SLOW_PAGE_WRITE = 0.015  # a healthy page write, about 3ms transfer at 100kHz and 5ms write cycle, is well under this
+
+
+def pages(offset: int, length: int) -> "list[tuple[int, int]]":
+    """Splits a range into page aligned (address, length) pieces"""
+    result = list()
+    address = offset
+    while address < offset + length:
+        size = min(PAGE_SIZE - (address % PAGE_SIZE), offset + length - address)
+        result.append((address, size))
+        address += size
+    return result
+
+
+def slow_pages(timings: "list[tuple[int, int, float|None]]",
+               threshold: float = SLOW_PAGE_WRITE) -> "list[tuple[int, int, float]]":
+    """Picks the (address, length, seconds) page writes that took longer than threshold"""
+    return [timing for timing in timings if timing[2] is not None and timing[2] > threshold]
+
+
+def diff_chunk(differing: "list[tuple[int, int]]", address: int,
+               current: memoryview, expected: memoryview):
+    """Adds the (address, length) pages of a chunk read from address where current differs from expected"""
+    for page_address, length in pages(address, len(expected)):
+        x = page_address - address
+        if current[x:x + length] != expected[x:x + length]:
+            # a page split over two chunks is written whole
+            if differing and differing[-1][0] + differing[-1][1] == page_address and page_address % PAGE_SIZE:
+                previous = differing.pop()
+                differing.append((previous[0], previous[1] + length))
+            else:
+                differing.append((page_address, length))
+
+
+def first_difference(address: int, current: "bytes|bytearray", expected: memoryview) -> "int|None":
+    """Gets the address of the first byte of a chunk read from address that differs from expected"""
+    if memoryview(current) != expected:
+        for x in range(len(expected)):
+            if current[x] != expected[x]:
+                return address + x
+    return None
 
 
 class zd24c64a:
@@ -16,3 +64,84 @@ class zd24c64a:
         output = [(address >> 8) & 0xFF, address & 0xFF]
         self.i2c_port.write(output)
         return self.i2c_port.read(length)
+
+    def wait_for_write_cycle(self, timeout: float = WRITE_CYCLE_TIMEOUT) -> float:
+        """ACK polls until the internal write cycle completes, returns the time waited"""
+        start = time.monotonic()
+        while True:
+            # check the time before polling so the last poll is after the timeout,
+            # a thread descheduled mid wait does not give up on a finished write
+            expired = time.monotonic() - start > timeout
+            if self.i2c_port.poll(write=True):
+                return time.monotonic() - start
+            if expired:
+                raise IOError("EEPROM write cycle did not complete")
+
+    def write_image(self, offset: int, data: "bytes|bytearray|memoryview|list[int]") -> "list[tuple[int, int, float]]":
+        """
+        Writes data of any length split into page aligned page writes,
+        waiting for each write cycle by ACK polling
+        returns (address, length, seconds) for each page written
+        """
+        if offset < 0 or offset + len(data) > SIZE:
+            raise ValueError("image does not fit in the EEPROM")
+
+        return self.write_pages(offset, data, pages(offset, len(data)))
+
+    def write_pages(self, offset: int, data: "bytes|bytearray|memoryview|list[int]",
+                    page_list: "list[tuple[int, int]]") -> "list[tuple[int, int, float]]":
+        """Writes the listed (address, length) pages of an image that starts at offset"""
+        data = memoryview(bytes(data)) if isinstance(data, list) else memoryview(data)
+
+        timings = list()
+        for address, length in page_list:
+            x = address - offset
+
+            start = time.monotonic()
+            self.writeAddr(address, data[x:x + length])
+            self.wait_for_write_cycle()
+            timings.append((address, length, time.monotonic() - start))
+
+        return timings
+
+    def diff_pages(self, offset: int, data: "bytes|bytearray|memoryview|list[int]",
+                   chunk_size: int = READ_CHUNK_SIZE) -> "list[tuple[int, int]]":
+        """Reads the current contents and returns the (address, length) pages that differ from data"""
+        data = memoryview(bytes(data)) if isinstance(data, list) else memoryview(data)
+
+        differing = list()
+        for chunk_start in range(0, len(data), chunk_size):
+            chunk_length = min(chunk_size, len(data) - chunk_start)
+            current = memoryview(self.readAddr(offset + chunk_start, chunk_length))
+            diff_chunk(differing, offset + chunk_start, current, data[chunk_start:chunk_start + chunk_length])
+
+        return differing
+
+    def verify_image(self, offset: int, expected: "bytes|bytearray|memoryview|list[int]",
+                     chunk_size: int = READ_CHUNK_SIZE) -> "int|None":
+        """
+        Reads back and compares chunk by chunk, stopping at the first mismatch
+        returns the address of the first byte that differs or None if it all matches
+        """
+        expected = memoryview(bytes(expected)) if isinstance(expected, list) else memoryview(expected)
+
+        for chunk_start in range(0, len(expected), chunk_size):
+            chunk_length = min(chunk_size, len(expected) - chunk_start)
+            current = self.readAddr(offset + chunk_start, chunk_length)
+
+            mismatch = first_difference(offset + chunk_start, current, expected[chunk_start:chunk_start + chunk_length])
+            if mismatch is not None:
+                return mismatch
+
+        return None
+
+    def update_image(self, offset: int, data: "bytes|bytearray|memoryview|list[int]",
+                     dry_run: bool = False) -> "tuple[list[tuple[int, int]], list[tuple[int, int, float]]]":
+        """
+        Writes only the pages that differ from the current contents,
+        returns the differing (address, length) pages and the write timings (empty for a dry run)
+        """
+        differing = self.diff_pages(offset, data)
+        if dry_run:
+            return (differing, [])
+        return (differing, self.write_pages(offset, data, differing))